@@ -0,0 +1,375 @@
+"""
+Packs an export directory into a single columnar archive file, so reading it doesn't involve opening and decoding thousands of json files.
+
+The file consists of a magic header followed by append-only segments. Each segment is
+- 8 bytes: length of the json header (little endian)
+- json header describing the buffers (dtype/shape/offset), padded to 8 bytes
+- the buffers themselves, each aligned to 8 bytes
+
+Each segment contains a summary table (one column per Emfit field) and ragged per-night datapoints,
+stored as offsets + values buffers. New sessions are appended as a new segment, the rest of the file is left intact.
+The header also records size and mtime of each session file, so if a session changes in the export, it's appended again.
+If a sid is in several segments, the last one wins.
+
+E.g.: python3 -m emfitexport.archive pack /path/to/export /path/to/emfit.archive
+"""
+
+from __future__ import annotations
+
+import json
+import mmap
+import struct
+from collections.abc import Iterator
+from itertools import islice
+from pathlib import Path
+from typing import Any, Union
+
+import click
+import numpy as np
+
+from .dal import (
+    _DATETIME_FIELDS,
+    _FIELDS,
+    DAL,
+    Emfit,
+    EmfitParse,
+    FakeData,
+    Sid,
+    SleepTable,
+)
+from .exporthelpers.logging_helper import make_logger
+from .storage import read_bytes, session_paths, session_sid
+
+logger = make_logger(__name__)
+
+
+MAGIC = b'EMFITARCHIVE0001'
+_LEN = struct.Struct('<Q')
+_ALIGN = 8
+
+# ragged per-night datapoints: name -> (EmfitSeries attribute, dtype, number of columns)
+RAGGED = {
+    'measured': ('measured' , '<f8', 4),
+    'hrv'     : ('hrv_rmssd', '<f8', 6),
+    'epochs'  : ('epochs'   , '<i8', 2),
+}  # fmt: skip
+
+
+def _pad(n: int) -> int:
+    return -n % _ALIGN
+
+
+# size and mtime_ns of the session file
+Stamp = tuple[int, int]
+
+# summary, ragged datapoints and stamp of a session, i.e. everything that goes into the archive
+_Packed = tuple[Emfit, dict[str, 'np.ndarray'], Stamp]
+
+
+def _extract(em: EmfitParse, stamp: Stamp) -> _Packed:
+    """
+    Picks what's needed for the archive, so the raw json doesn't need to be kept around
+    """
+    series = em.series
+    return Emfit.from_json(em.raw), {name: getattr(series, attr) for name, (attr, _, _) in RAGGED.items()}, stamp
+
+
+def _encode_segment(sessions: list[_Packed]) -> bytes:
+    buffers: dict[str, np.ndarray] = {}
+
+    rows = [e._to_row() for e, _, _ in sessions]
+    for i, field in enumerate(_FIELDS):
+        column = [row[i] for row in rows]
+        if field == 'sid':
+            buffers[field] = np.array([s.encode('utf8') for s in column], dtype=np.bytes_)
+        else:
+            # NOTE: json doesn't have nans, so it's safe to use them for missing values
+            buffers[field] = np.array([np.nan if v is None else v for v in column], dtype='<f8')
+
+    for name, (_, dtype, columns) in RAGGED.items():
+        arrays = [ragged[name] for _, ragged, _ in sessions]
+        offsets = np.zeros(len(arrays) + 1, dtype='<i8')
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        buffers[name + '_offsets'] = offsets
+        values = np.concatenate(arrays) if len(arrays) > 0 else np.empty((0, columns))
+        buffers[name] = values.astype(dtype, copy=False).reshape(-1, columns)
+
+    descs = []
+    offset = 0
+    for name, arr in buffers.items():
+        descs.append({'name': name, 'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset})
+        offset += arr.nbytes + _pad(arr.nbytes)
+    stamps = [list(stamp) for _, _, stamp in sessions]
+    header = json.dumps({'count': len(sessions), 'buffers': descs, 'size': offset, 'stamps': stamps}).encode('utf8')
+    header += b' ' * _pad(len(header))
+
+    chunks = [_LEN.pack(len(header)), header]
+    for arr in buffers.values():
+        data = np.ascontiguousarray(arr).tobytes()
+        chunks.append(data + b'\0' * _pad(len(data)))
+    return b''.join(chunks)
+
+
+def _scan(buf: Union[bytes, mmap.mmap]) -> Iterator[tuple[dict[str, Any], int, int]]:
+    """
+    Yields segment headers along with the data offset and the segment end.
+    Stops at a truncated segment (e.g. if appending was interrupted).
+    """
+    pos = len(MAGIC)
+    size = len(buf)
+    while pos + _LEN.size <= size:
+        [hlen] = _LEN.unpack_from(buf, pos)
+        data_start = pos + _LEN.size + hlen
+        if data_start > size:
+            break
+        header = json.loads(bytes(buf[pos + _LEN.size : data_start]))
+        end = data_start + header['size']
+        if end > size:
+            break
+        yield header, data_start, end
+        pos = end
+    if pos != size:
+        logger.warning('archive has %d bytes of trailing garbage (interrupted append?)', size - pos)
+
+
+class _Segment:
+    def __init__(self, buf: mmap.mmap, header: dict[str, Any], data_start: int) -> None:
+        self.count: int = header['count']
+        self.stamps: list[Stamp] = [tuple(st) for st in header['stamps']]
+        self.arrays: dict[str, np.ndarray] = {}
+        for desc in header['buffers']:
+            dtype = np.dtype(desc['dtype'])
+            shape = desc['shape']
+            count = int(np.prod(shape))
+            # NOTE: frombuffer doesn't copy, so these are views into the mmap
+            arr = np.frombuffer(buf, dtype=dtype, count=count, offset=data_start + desc['offset'])
+            self.arrays[desc['name']] = arr.reshape(shape)
+
+    def sids(self) -> list[Sid]:
+        return [s.decode('utf8') for s in self.arrays['sid'].tolist()]
+
+    def emfits(self) -> Iterator[Emfit]:
+        columns = [self.sids() if field == 'sid' else self.arrays[field].tolist() for field in _FIELDS]
+        for row in zip(*columns):
+            # nans were used to encode missing values
+            yield Emfit._from_row([None if v != v else v for v in row])  # noqa: PLR0124
+
+    def ragged(self, name: str, i: int) -> np.ndarray:
+        offsets = self.arrays[name + '_offsets']
+        return self.arrays[name][offsets[i] : offsets[i + 1]]
+
+
+class Archive:
+    """
+    Memory mapped reader for the archive. Datapoints are served as zero-copy numpy views into the file.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        with path.open('rb') as fo:
+            # NOTE: mmap keeps its own handle, so fine to close the file
+            self._mm = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self._mm[: len(MAGIC)] == MAGIC, f'{path} is not an emfit archive'
+        self.segments = [_Segment(self._mm, header, data_start) for header, data_start, _ in _scan(self._mm)]
+
+        self._index: dict[Sid, tuple[int, int]] = {}
+        self.stamps: dict[Sid, Stamp] = {}
+        for si, seg in enumerate(self.segments):
+            for i, (sid, stamp) in enumerate(zip(seg.sids(), seg.stamps)):
+                self._index[sid] = (si, i)
+                self.stamps[sid] = stamp
+        # rows which weren't replaced by later segments, per segment
+        self._current = [np.zeros(seg.count, dtype=bool) for seg in self.segments]
+        for si, i in self._index.values():
+            self._current[si][i] = True
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, sid: Sid) -> bool:
+        return sid in self._index
+
+    @property
+    def sids(self) -> list[Sid]:
+        return sorted(self._index)
+
+    @property
+    def replaced(self) -> int:
+        """
+        Number of rows superseded by later segments
+        """
+        return sum(seg.count for seg in self.segments) - len(self._index)
+
+    def sleeps(self) -> Iterator[Emfit]:
+        # NOTE: keep the same order as DAL, appended segments might in principle have older sessions
+        emfits = [e for seg, current in zip(self.segments, self._current) for e, c in zip(seg.emfits(), current) if c]
+        yield from sorted(emfits, key=lambda e: e.sid)
+
+    def table(self) -> SleepTable:
+        """
+        Summary of all sessions as a SleepTable, built straight from the columns
+        """
+        columns = {}
+        current = np.concatenate(self._current) if len(self.segments) > 0 else np.empty(0, dtype=bool)
+        for field in _FIELDS:
+            column = np.concatenate([seg.arrays[field] for seg in self.segments]) if len(self.segments) > 0 else np.empty(0)
+            column = column[current]
+            if field == 'sid':
+                column = np.char.decode(column.astype(np.bytes_), 'utf8')
+            elif field in _DATETIME_FIELDS:
+                column = column.astype(np.int64)
+            columns[field] = column
+        order = np.argsort(columns['sid'], kind='stable')
+        return SleepTable({k: v[order] for k, v in columns.items()})
+
+    def _ragged(self, name: str, sid: Sid) -> np.ndarray:
+        si, i = self._index[sid]
+        return self.segments[si].ragged(name, i)
+
+    def measured(self, sid: Sid) -> np.ndarray:
+        """
+        Columns: timestamp, pulse, breath, activity (see EmfitSeries.measured)
+        """
+        return self._ragged('measured', sid)
+
+    def hrv(self, sid: Sid) -> np.ndarray:
+        """
+        Columns: timestamp, rmssd, ... (see EmfitSeries.hrv_rmssd)
+        """
+        return self._ragged('hrv', sid)
+
+    def epochs(self, sid: Sid) -> np.ndarray:
+        """
+        Columns: timestamp, sleep stage
+        """
+        return self._ragged('epochs', sid)
+
+
+def _packed(export_path: Path, *, existing: dict[Sid, Stamp]) -> Iterator[_Packed]:
+    for p in session_paths(export_path):
+        st = p.stat()
+        stamp = (st.st_size, st.st_mtime_ns)
+        if existing.get(session_sid(p)) == stamp:
+            continue
+        try:
+            j = json.loads(read_bytes(p))
+            # NOTE: also makes sure it's not malformed before it ends up in the archive
+            packed = _extract(EmfitParse(j['id'], raw=j), stamp)
+        except Exception as e:
+            logger.exception(e)
+            logger.error('skipping %s', p)
+            continue
+        yield packed
+
+
+def pack(export_path: Path, archive_path: Path, *, batch_size: int = 500) -> int:
+    """
+    Appends sessions from export_path which aren't in the archive yet, or changed since they were packed.
+    Returns the number of appended sessions.
+    Sessions are appended in segments of at most batch_size, so memory use doesn't grow with the size of the export.
+    """
+    existing: dict[Sid, Stamp] = {}
+    valid_end = len(MAGIC)
+    if archive_path.exists():
+        archive = Archive(archive_path)
+        existing = archive.stamps
+        valid_end = max((end for _, _, end in _scan(archive._mm)), default=valid_end)
+        del archive
+
+    packed = _packed(export_path, existing=existing)
+    batch = list(islice(packed, batch_size))
+    if len(batch) == 0:
+        return 0
+
+    if not archive_path.exists():
+        archive_path.write_bytes(MAGIC)
+    count = 0
+    with archive_path.open('r+b') as fo:
+        # drop anything after the last complete segment, e.g. if previous append was interrupted
+        fo.truncate(valid_end)
+        fo.seek(valid_end)
+        while len(batch) > 0:
+            # NOTE: segments are self-contained, so if interrupted, the ones written so far are still readable
+            fo.write(_encode_segment(batch))
+            count += len(batch)
+            logger.info('appended %d sessions to %s', len(batch), archive_path)
+            batch = list(islice(packed, batch_size))
+    return count
+
+
+@click.group()
+def main() -> None:
+    pass
+
+
+@main.command(name='pack')
+@click.argument('export_path', type=Path)
+@click.argument('archive_path', type=Path)
+@click.option('--batch-size', type=int, default=500, help='Max number of sessions per appended segment')
+def cmd_pack(*, export_path: Path, archive_path: Path, batch_size: int) -> None:
+    """
+    Append new (or changed) sessions from EXPORT_PATH to ARCHIVE_PATH
+    """
+    pack(export_path, archive_path, batch_size=batch_size)
+
+
+def test_pack(tmp_path: Path) -> None:
+    export_path = tmp_path / 'export'
+    export_path.mkdir()
+    archive_path = tmp_path / 'emfit.archive'
+
+    f = FakeData()
+    f.fill(export_path, count=5)
+    assert pack(export_path, archive_path) == 5
+
+    f.fill(export_path, count=3)
+    size = archive_path.stat().st_size
+    assert pack(export_path, archive_path) == 3
+    assert archive_path.stat().st_size > size  # appended, previous segment is intact
+    assert pack(export_path, archive_path) == 0
+
+    expected = list(DAL(export_path).sleeps())
+    assert len(expected) == 8
+    assert list(DAL(archive_path).sleeps()) == expected
+    assert list(DAL(archive_path).sleep_table()) == expected
+
+    archive = Archive(archive_path)
+    assert len(archive.segments) == 2
+    for p in sorted(export_path.glob('*.json')):
+        j = json.loads(p.read_text())
+        series = EmfitParse(j['id'], raw=j).series
+        assert np.array_equal(archive.measured(p.stem), series.measured, equal_nan=True)
+        assert np.array_equal(archive.hrv(p.stem), series.hrv_rmssd, equal_nan=True)
+        assert np.array_equal(archive.epochs(p.stem), series.epochs)
+    # should be zero-copy
+    assert not archive.measured('000000').flags.owndata
+
+    # truncated append shouldn't break reading
+    with archive_path.open('ab') as fo:
+        fo.write(b'\x10\x00')
+    assert len(Archive(archive_path)) == 8
+
+    batched_path = tmp_path / 'batched.archive'
+    assert pack(export_path, batched_path, batch_size=3) == 8
+    assert len(Archive(batched_path).segments) == 3
+    assert list(DAL(batched_path).sleeps()) == expected
+
+    # session changed in the export (e.g. fetched again), should replace the stale one
+    changed = export_path / '000002.json'
+    j = json.loads(changed.read_text())
+    j['measured_hr_avg'] += 1
+    j['measured_datapoints'] = j['measured_datapoints'][: len(j['measured_datapoints']) // 2]
+    changed.write_text(json.dumps(j))
+    assert pack(export_path, archive_path) == 1
+    assert pack(export_path, archive_path) == 0
+    archive = Archive(archive_path)
+    assert (len(archive), archive.replaced) == (8, 1)
+    expected = list(DAL(export_path).sleeps())
+    assert list(DAL(archive_path).sleeps()) == expected
+    assert list(DAL(archive_path).sleep_table()) == expected
+    assert np.array_equal(archive.measured('000002'), EmfitParse(j['id'], raw=j).series.measured, equal_nan=True)
+
+
+if __name__ == '__main__':
+    main()
+
@@ -0,0 +1,451 @@
+"""
+Benchmarks for DAL, run against synthetic data generated with FakeData.
+
+E.g.: python3 -m emfitexport.bench parse --count 100
+
+To compare between commits:
+    python3 -m emfitexport.bench suite --output before.json
+    (checkout, etc)
+    python3 -m emfitexport.bench suite --output after.json --baseline before.json --threshold 0.2
+"""
+
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any, Optional
+
+import click
+
+from .dal import DAL, Emfit, EmfitParse, FakeData, PoolKind, SleepTable, _loads_summary
+from .exporthelpers.export_helper import Json
+from .storage import SUFFIXES, Compression, recompress, session_paths
+
+
+def _best(fn: Callable[[], Any], *, repeat: int) -> float:
+    """
+    Returns best wall time (seconds) of the function.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _measure(fn: Callable[[], Any], *, repeat: int) -> tuple[float, int]:
+    """
+    Returns best wall time (seconds) and peak traced memory (bytes) of the function.
+    """
+    best = _best(fn, repeat=repeat)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def _report(name: str, seconds: float, peak: Optional[int], *, count: int) -> None:
+    mem = '' if peak is None else f'   peak {peak / 2**20:8.2f} MiB'
+    print(f'{name:<24} {seconds * 1000 / count:9.4f} ms/night{mem}')
+
+
+def bench_parse(path: Path, *, repeat: int) -> None:
+    texts = [p.read_text() for p in sorted(path.glob('*.json'))]
+
+    # NOTE: one night at a time, that's how DAL processes them, so peak memory is per night
+    def decode(loads: Callable[[str], Any], *, emfit: bool) -> Callable[[], None]:
+        def run() -> None:
+            for t in texts:
+                j = loads(t)
+                if emfit:
+                    Emfit.from_json(j)
+
+        return run
+
+    loaders: list[tuple[str, Callable[[str], Any]]] = [('json.loads', json.loads), ('summary_only', _loads_summary)]
+    for name, loads in loaders:
+        for emfit in [False, True]:
+            seconds, peak = _measure(decode(loads, emfit=emfit), repeat=repeat)
+            _report(name + (' + Emfit' if emfit else ''), seconds, peak, count=len(texts))
+
+
+# EmfitParse property -> EmfitSeries equivalent
+PROPERTIES = {
+    'sleep_start'      : 'sleep_bounds',
+    'sleep_hr'         : 'sleep_hr',
+    'hrv'              : 'hrv',
+    'epoch_series'     : 'epoch_series',
+    'sleep_hr_coverage': 'sleep_hr_coverage',
+}  # fmt: skip
+
+
+def bench_properties(path: Path, *, repeat: int) -> None:
+    import numpy as np  # noqa: F401, PLC0415  # fail early, series need numpy
+
+    jsons = [json.loads(p.read_text()) for p in sorted(path.glob('*.json'))]
+    count = len(jsons)
+
+    # NOTE: each property is measured on fresh instances, since derived values are cached per instance
+    def prop(name: str, *, series: bool) -> Callable[[], None]:
+        def run() -> None:
+            for j in jsons:
+                em = EmfitParse(j['id'], raw=j)
+                getattr(em.series if series else em, name)
+
+        return run
+
+    for name, series_name in PROPERTIES.items():
+        for series in [False, True]:
+            pname = series_name if series else name
+            seconds, peak = _measure(prop(pname, series=series), repeat=repeat)
+            _report(('series.' if series else '') + pname, seconds, peak, count=count)
+
+    seconds, peak = _measure(lambda: [Emfit.from_json(j) for j in jsons], repeat=repeat)
+    _report('Emfit.from_json', seconds, peak, count=count)
+
+
+def bench_parallel(path: Path, *, workers: int, repeat: int) -> None:
+    count = len(list(path.glob('*.json')))
+
+    # NOTE: peak memory isn't meaningful here, since tracemalloc doesn't see other processes
+    def run(dal: DAL) -> Callable[[], Any]:
+        return lambda: list(dal.sleeps())
+
+    serial, _ = _measure(run(DAL(path)), repeat=repeat)
+    _report('serial', serial, None, count=count)
+    pools: list[PoolKind] = ['thread', 'process']
+    for pool in pools:
+        dal = DAL(path, workers=workers, pool=pool)
+        seconds, _ = _measure(run(dal), repeat=repeat)
+        _report(f'{pool} x{workers}', seconds, None, count=count)
+        print(f'{"":<24} speedup {serial / seconds:.2f}x')
+
+
+def bench_table(*, count: int, repeat: int) -> None:
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    # NOTE: parsing isn't what's measured here, so just replicate a few distinct nights
+    f = FakeData()
+    base = [Emfit.from_json(f.generate())._to_row() for _ in range(50)]
+    rows = []
+    for i in range(count):
+        row = list(base[i % len(base)])
+        row[0] = f'{i:06}'
+        rows.append(row)
+
+    emfits: list[Emfit] = []
+    table: Optional[SleepTable] = None
+
+    def build_list() -> None:
+        nonlocal emfits
+        emfits = [Emfit._from_row(r) for r in rows]
+
+    def build_table() -> None:
+        nonlocal table
+        table = SleepTable.from_rows(rows)
+
+    # NOTE: peak includes intermediate allocations, but the result is what stays in memory
+    for name, fn in [('list[Emfit]', build_list), ('SleepTable', build_table)]:
+        seconds, peak = _measure(fn, repeat=repeat)
+        _report(f'build {name}', seconds, peak, count=count)
+    assert table is not None
+
+    def aggregate_list() -> None:
+        sum(e.recovery for e in emfits) / len(emfits)
+        sum(e.time_in_bed for e in emfits) / len(emfits)
+        {e.date for e in emfits}
+
+    def aggregate_table() -> None:
+        assert table is not None
+        table.recovery.mean()
+        table.time_in_bed.mean()
+        np.unique(table.date)
+
+    for name, fn in [('list[Emfit]', aggregate_list), ('SleepTable', aggregate_table)]:
+        seconds, peak = _measure(fn, repeat=repeat)
+        _report(f'aggregate {name}', seconds, peak, count=count)
+
+
+def bench_window(path: Path, *, windows: list[int], repeat: int) -> None:
+    dal = DAL(path)
+    # NOTE: building the index is a one-off cost, so not including it
+    list(dal.sleeps(since=datetime.now(tz=timezone.utc)))
+
+    last = max(e.end for e in dal.sleeps() if isinstance(e, Emfit))
+    for days in windows:
+        since = last - timedelta(days=days)
+        seconds, _ = _measure(lambda: list(dal.sleeps(since=since)), repeat=repeat)
+        print(f'last {days:>5} nights: {seconds * 1000:9.2f} ms')
+    seconds, _ = _measure(lambda: list(dal.sleeps()), repeat=repeat)
+    print(f'{"everything":<17}: {seconds * 1000:9.2f} ms')
+
+
+def bench_storage(path: Path, *, repeat: int) -> None:
+    count = len(session_paths(path))
+    # NOTE: FakeData writes uncompressed, so doing 'none' last to measure an actual rewrite
+    compressions: list[Compression] = [c for c in SUFFIXES if c != 'none'] + ['none']
+    try:
+        import zstandard  # noqa: F401, PLC0415
+    except ImportError:
+        print('zstandard is not installed, skipping zstd')
+        compressions.remove('zstd')
+
+    for compression in compressions:
+        start = time.perf_counter()
+        recompress(path, compression)
+        write = time.perf_counter() - start
+        size = sum(p.stat().st_size for p in session_paths(path))
+        print(f'{compression:<6} {size / count / 1024:8.1f} KiB/night')
+        _report(f'  {compression} write', write, None, count=count)
+        for summary_only in [False, True]:
+            seconds, peak = _measure(lambda: list(DAL(path, summary_only=summary_only).sleeps()), repeat=repeat)  # noqa: B023
+            _report(f'  {compression} read{" (summary)" if summary_only else ""}', seconds, peak, count=count)
+
+
+# suite: runs each case in a fresh process (so peak RSS is meaningful), and dumps results as json
+
+
+# per night costs of these don't depend on the archive size, so they are measured on a sample
+_SAMPLE = 100
+
+
+def _sample(path: Path) -> list[Json]:
+    return [json.loads(p.read_text()) for p in sorted(path.glob('*.json'))[:_SAMPLE]]
+
+
+def _case_sleeps(path: Path, *, pool: Optional[PoolKind], workers: int, repeat: int) -> tuple[float, int]:
+    dal = DAL(path) if pool is None else DAL(path, workers=workers, pool=pool)
+    return _best(lambda: list(dal.sleeps()), repeat=repeat), len(list(path.glob('*.json')))
+
+
+def _case_property(path: Path, *, prop: str, series: bool, repeat: int) -> tuple[float, int]:
+    jsons = _sample(path)
+
+    def run() -> None:
+        for j in jsons:
+            em = EmfitParse(j['id'], raw=j)
+            getattr(em.series if series else em, prop)
+
+    return _best(run, repeat=repeat), len(jsons)
+
+
+def _case_from_json(path: Path, *, repeat: int) -> tuple[float, int]:
+    jsons = _sample(path)
+    return _best(lambda: [Emfit.from_json(j) for j in jsons], repeat=repeat), len(jsons)
+
+
+def _case_export(path: Path, *, stream: bool, concurrency: int, repeat: int) -> tuple[float, int]:
+    from .export import Exporter, _stub_server  # noqa: PLC0415  # needs export extras
+
+    sleeps = {j['id']: j for j in _sample(path)}
+
+    def run() -> None:
+        with TemporaryDirectory() as td:
+            ex = Exporter(token='token', export_dir=Path(td), concurrency=concurrency, base_url=base_url, stream=stream)
+            errors = list(ex.update_sleeps())
+            assert len(errors) == 0, errors
+
+    # NOTE: the stub server runs in the same process, so it's included in the timings & RSS
+    with _stub_server(sleeps) as (base_url, _):
+        return _best(run, repeat=repeat), len(sleeps)
+
+
+def _isolated(case: Callable[..., tuple[float, int]], **kwargs: Any) -> dict[str, float]:
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(_run_case, case, **kwargs).result()
+
+
+def _run_case(case: Callable[..., tuple[float, int]], **kwargs: Any) -> dict[str, float]:
+    import resource  # noqa: PLC0415  # unix only
+
+    seconds, count = case(**kwargs)
+    # NOTE: ru_maxrss is in KiB on linux; for children it's the max over children (e.g. process pool workers)
+    return {
+        'count': count,
+        'ms_per_night': seconds * 1000 / count,
+        'rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children_rss_mib': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def _meta() -> dict[str, Any]:
+    try:
+        commit: Optional[str] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'timestamp': datetime.now(tz=timezone.utc).isoformat(),
+    }
+
+
+def bench_suite(*, counts: list[int], workers: int, repeat: int) -> dict[str, dict[str, float]]:
+    results: dict[str, dict[str, float]] = {}
+
+    def run(key: str, case: Callable[..., tuple[float, int]], **kwargs: Any) -> None:
+        res = _isolated(case, **kwargs, repeat=repeat)
+        results[key] = res
+        print(f'{key:<40} {res["ms_per_night"]:9.4f} ms/night   rss {res["rss_mib"]:8.1f} MiB   children rss {res["children_rss_mib"]:8.1f} MiB')
+
+    pools: list[tuple[str, Optional[PoolKind]]] = [('serial', None), (f'thread x{workers}', 'thread'), (f'process x{workers}', 'process')]
+    with TemporaryDirectory() as td:
+        tdir = Path(td)
+        generated = 0
+        f = FakeData()
+        for count in sorted(counts):
+            # NOTE: archives are nested, so only generating the difference
+            f.fill(tdir, count=count - generated, workers=workers)
+            generated = count
+            for pname, pool in pools:
+                run(f'dal.sleeps[{pname}]@{count}', _case_sleeps, path=tdir, pool=pool, workers=workers)
+
+        for name, series_name in PROPERTIES.items():
+            run(f'property[{name}]', _case_property, path=tdir, prop=name, series=False)
+            run(f'property[series.{series_name}]', _case_property, path=tdir, prop=series_name, series=True)
+        run('Emfit.from_json', _case_from_json, path=tdir)
+        for stream in [False, True]:
+            run(f'export[{"stream" if stream else "default"}]', _case_export, path=tdir, stream=stream, concurrency=workers)
+    return results
+
+
+def compare(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]], *, threshold: float) -> list[str]:
+    """
+    Returns cases which got slower than baseline by more than threshold (relative)
+    """
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = res['ms_per_night'] / base['ms_per_night']
+        if ratio > 1 + threshold:
+            regressions.append(name)
+        print(f'{name:<40} {base["ms_per_night"]:9.4f} -> {res["ms_per_night"]:9.4f} ms/night   {ratio:5.2f}x{"   REGRESSION" if ratio > 1 + threshold else ""}')
+    return regressions
+
+
+@click.group()
+def main() -> None:
+    pass
+
+
+@main.command(name='parse')
+@click.option('--count', type=int, default=100, help='Number of synthetic nights')
+@click.option('--repeat', type=int, default=3)
+def cmd_parse(*, count: int, repeat: int) -> None:
+    """
+    Compare full json.loads against summary-only parsing
+    """
+    with TemporaryDirectory() as td:
+        tdir = Path(td)
+        FakeData().fill(tdir, count=count)
+        bench_parse(tdir, repeat=repeat)
+
+
+@main.command(name='properties')
+@click.option('--count', type=int, default=100, help='Number of synthetic nights')
+@click.option('--repeat', type=int, default=3)
+def cmd_properties(*, count: int, repeat: int) -> None:
+    """
+    Per-property costs of EmfitParse, list based vs numpy series
+    """
+    with TemporaryDirectory() as td:
+        tdir = Path(td)
+        FakeData().fill(tdir, count=count)
+        bench_properties(tdir, repeat=repeat)
+
+
+@main.command(name='parallel')
+@click.option('--count', type=int, default=1000, help='Number of synthetic nights')
+@click.option('--workers', type=int, default=4)
+@click.option('--repeat', type=int, default=3)
+def cmd_parallel(*, count: int, workers: int, repeat: int) -> None:
+    """
+    DAL.sleeps with built-in thread/process pools against the serial path
+    """
+    with TemporaryDirectory() as td:
+        tdir = Path(td)
+        FakeData().fill(tdir, count=count)
+        bench_parallel(tdir, workers=workers, repeat=repeat)
+
+
+@main.command(name='table')
+@click.option('--count', type=int, default=10_000, help='Number of synthetic nights')
+@click.option('--repeat', type=int, default=3)
+def cmd_table(*, count: int, repeat: int) -> None:
+    """
+    SleepTable against list of Emfit objects: memory and time to build and aggregate
+    """
+    bench_table(count=count, repeat=repeat)
+
+
+@main.command(name='window')
+@click.option('--count', type=int, multiple=True, default=[100, 1000], help='Number of synthetic nights')
+@click.option('--window', type=int, multiple=True, default=[7, 30, 90], help='Query window, in nights')
+@click.option('--repeat', type=int, default=3)
+def cmd_window(*, count: list[int], window: list[int], repeat: int) -> None:
+    """
+    Time window queries through the sidecar index, for different archive sizes
+    """
+    for c in count:
+        print(f'archive of {c} nights')
+        with TemporaryDirectory() as td:
+            tdir = Path(td)
+            FakeData().fill(tdir, count=c)
+            bench_window(tdir, windows=window, repeat=repeat)
+
+
+@main.command(name='storage')
+@click.option('--count', type=int, default=100, help='Number of synthetic nights')
+@click.option('--repeat', type=int, default=3)
+def cmd_storage(*, count: int, repeat: int) -> None:
+    """
+    Size on disk and read/write costs for each session compression
+    """
+    with TemporaryDirectory() as td:
+        tdir = Path(td)
+        FakeData().fill(tdir, count=count)
+        bench_storage(tdir, repeat=repeat)
+
+
+@main.command(name='suite')
+@click.option('--count', type=int, multiple=True, default=[100, 1000, 10_000], help='Archive sizes, in nights')
+@click.option('--workers', type=int, default=4)
+@click.option('--repeat', type=int, default=3)
+@click.option('--output', type=Path, default=None, help='Write results as json')
+@click.option('--baseline', type=Path, default=None, help='Results of a previous run (json) to compare against')
+@click.option('--threshold', type=float, default=0.2, help='Relative slowdown against baseline which fails the run')
+def cmd_suite(*, count: list[int], workers: int, repeat: int, output: Optional[Path], baseline: Optional[Path], threshold: float) -> None:
+    """
+    Full benchmark suite: DAL.sleeps for different archive sizes and pool modes, per-property costs, Emfit.from_json and export
+    """
+    results = bench_suite(counts=list(count), workers=workers, repeat=repeat)
+    if output is not None:
+        output.write_text(json.dumps({'meta': _meta(), 'results': results}, indent=2))
+    if baseline is not None:
+        regressions = compare(results, json.loads(baseline.read_text())['results'], threshold=threshold)
+        if len(regressions) > 0:
+            raise click.ClickException(f'slower than baseline by more than {threshold:.0%}: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Persistent cache for parsed sleep summaries, so DAL doesn't have to re-parse old nights every time.
+Also an in-memory LRU cache for raw session data (see DAL.handles).
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Generic, Optional, TypeVar
+
+Row = list[Any]
+T = TypeVar('T')
+
+
+class SummaryCache:
+    """
+    Stores summary rows in sqlite, keyed on file identity (filename, size, mtime).
+
+    Entries for files that are gone (e.g. deleted, or archived to .json.old) are evicted by retain().
+    Hit/miss/eviction counters are cumulative across open() calls.
+    """
+
+    def __init__(self, path: Path, *, fields: Sequence[str]) -> None:
+        self.path = path
+        # if the set of fields changes, cached rows are meaningless, so we keep track of it
+        self.fields = list(fields)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._db: Optional[sqlite3.Connection] = None
+        # name -> (size, mtime_ns, row)
+        self._entries: dict[str, tuple[int, int, str]] = {}
+        # stats of files that missed, so we don't have to stat again on put()
+        self._pending: dict[str, tuple[int, int]] = {}
+
+    @contextmanager
+    def open(self) -> Iterator[SummaryCache]:
+        db = sqlite3.connect(str(self.path))
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS summaries (name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, row TEXT)')
+            fields = json.dumps(self.fields)
+            cached_fields = db.execute("SELECT value FROM meta WHERE key = 'fields'").fetchone()
+            if cached_fields != (fields,):
+                db.execute('DELETE FROM summaries')
+                db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('fields', ?)", (fields,))
+            self._entries = {name: (size, mtime_ns, row) for name, size, mtime_ns, row in db.execute('SELECT name, size, mtime_ns, row FROM summaries')}
+            self._pending = {}
+            self._db = db
+            yield self
+        finally:
+            self._db = None
+            # NOTE: committing even if the consumer stopped early (e.g. didn't exhaust DAL.sleeps), rows put so far are valid
+            db.commit()
+            db.close()
+
+    def get(self, path: Path) -> Optional[Row]:
+        st = path.stat()
+        key = (st.st_size, st.st_mtime_ns)
+        entry = self._entries.get(path.name)
+        if entry is not None and entry[:2] == key:
+            self.hits += 1
+            return json.loads(entry[2])
+        self.misses += 1
+        self._pending[path.name] = key
+        return None
+
+    def put(self, path: Path, row: Row) -> None:
+        assert self._db is not None, 'cache is not open'
+        size, mtime_ns = self._pending.pop(path.name)
+        srow = json.dumps(row)
+        self._entries[path.name] = (size, mtime_ns, srow)
+        self._db.execute(
+            'INSERT OR REPLACE INTO summaries(name, size, mtime_ns, row) VALUES (?, ?, ?, ?)',
+            (path.name, size, mtime_ns, srow),
+        )
+
+    def retain(self, paths: Iterable[Path]) -> None:
+        """
+        Evict entries for all files except the ones passed.
+        """
+        assert self._db is not None, 'cache is not open'
+        stale = set(self._entries).difference(p.name for p in paths)
+        for name in stale:
+            del self._entries[name]
+        self._db.executemany('DELETE FROM summaries WHERE name = ?', [(name,) for name in stale])
+        self.evictions += len(stale)
+
+
+class RawCache(Generic[T]):
+    """
+    In-memory cache of values loaded from files (e.g. raw sessions), bounded by number of entries,
+    least recently used ones are evicted first.
+    Entries are keyed on file identity like in SummaryCache, so changed files are loaded again.
+    """
+
+    def __init__(self, load: Callable[[Path], T], *, maxsize: int) -> None:
+        assert maxsize > 0, maxsize
+        self.load = load
+        self.maxsize = maxsize
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # path -> (size, mtime_ns, value), most recently used last
+        self._entries: OrderedDict[Path, tuple[int, int, T]] = OrderedDict()
+        # NOTE: only guards the bookkeeping, loading happens outside, so a slow file doesn't block hits
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, path: Path) -> T:
+        st = path.stat()
+        key = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[:2] == key:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+        value = self.load(path)
+        with self._lock:
+            self._entries[path] = (*key, value)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def summary(self) -> str:
+        return f'raw cache: {len(self)}/{self.maxsize} entries, {self.hits} hits, {self.misses} misses, {self.evictions} evictions'
@@ -1,17 +1,35 @@
 from __future__ import annotations
 
 import json
-from collections.abc import Iterator
-from concurrent.futures import Executor
+import os
+import random
+import re
+import time
+from bisect import bisect_right
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
 from dataclasses import dataclass
 from datetime import date as datetime_date
 from datetime import datetime, timedelta, timezone
+from functools import cached_property
+from itertools import islice
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Any, Literal, Optional, Union
 
+from .cache import RawCache, SummaryCache
 from .exporthelpers.dal_helper import Json, Res, datetime_aware
 from .exporthelpers.logging_helper import make_logger
-from .utils import DummyFuture
+from .stats import SessionStats, Stats
+from .storage import load_sidecar, read_text, session_paths, session_sid
+from .utils import DummyFuture, bounded_results
+
+if TYPE_CHECKING:
+    import numpy as np
+
+    from .archive import Archive
+    from .index import TimeIndex
+    from .manifest import Manifest
 
 logger = make_logger(__name__)
 log = logger  # legacy name, was used at HPI at some point, so keeping for backwards compat
@@ -35,12 +53,192 @@ def fromts(ts) -> datetime_aware:
 AWAKE = 4
 
 
+class Hypnogram:
+    """
+    Sleep epochs, run-length encoded: run i has count[i] epochs of stage[i], step[i] seconds apart, starting at start[i].
+    Epochs are split into runs on stage changes and on irregular gaps, so it's lossless (see epochs()).
+    Built in a single pass; point lookups and range sums are binary searches over run starts.
+    Each epoch lasts until the next one, the last epoch lasts as long as the one before it.
+    """
+
+    def __init__(self, epochs: list[tuple[int, int]]) -> None:
+        self.start: list[int] = []
+        self.stage: list[int] = []
+        self.count: list[int] = []
+        self.step: list[int] = []
+        # index of the first epoch in the run
+        self.offset: list[int] = []
+        # stage -> seconds spent in it before each run (and one extra item for the total)
+        self._before: dict[int, list[int]] = {}
+        self._first_asleep: Optional[int] = None  # run indices
+        self._last_asleep: Optional[int] = None
+
+        if len(epochs) == 0:
+            return
+        # NOTE: single pass, the run is flushed when the next epoch doesn't continue it
+        # the step is only known once the run has a second epoch, so until then it takes any epoch of the same stage
+        run_start, run_stage = epochs[0]
+        run_count = 1
+        run_step: Optional[int] = None
+        expected = run_start
+        for ts, stage in islice(epochs, 1, None):
+            if stage == run_stage and (run_step is None or ts == expected):
+                if run_step is None:
+                    run_step = ts - run_start
+                run_count += 1
+                expected = ts + run_step
+            else:
+                self._add(run_start, run_stage, run_count, ts - run_start if run_step is None else run_step)
+                run_start, run_stage, run_count, run_step = ts, stage, 1, None
+        if run_step is None:
+            # single epoch run at the very end, lasts as long as the epoch before it
+            run_step = run_start - (self.start[-1] + (self.count[-1] - 1) * self.step[-1]) if len(self.start) > 0 else 0
+        self._add(run_start, run_stage, run_count, run_step)
+
+        runs = len(self.start)
+        totals: dict[int, int] = {}
+        for s in set(self.stage):
+            self._before[s] = [0] * (runs + 1)
+        for i in range(runs):
+            s = self.stage[i]
+            totals[s] = totals.get(s, 0) + self._duration(i)
+            for s2, before in self._before.items():
+                before[i + 1] = totals.get(s2, 0)
+
+    def _add(self, start: int, stage: int, count: int, step: int) -> None:
+        i = len(self.start)
+        self.offset.append(self.offset[-1] + self.count[-1] if i > 0 else 0)
+        self.start.append(start)
+        self.stage.append(stage)
+        self.count.append(count)
+        self.step.append(step)
+        if stage != AWAKE:
+            if self._first_asleep is None:
+                self._first_asleep = i
+            self._last_asleep = i
+
+    def _duration(self, i: int) -> int:
+        # NOTE: runs are split on irregular gaps, so the last epoch of a run lasts until the next run
+        if i + 1 < len(self.start):
+            return self.start[i + 1] - self.start[i]
+        return self.count[i] * self.step[i]
+
+    def __len__(self) -> int:
+        """
+        Number of epochs
+        """
+        return self.offset[-1] + self.count[-1] if len(self.start) > 0 else 0
+
+    @property
+    def end(self) -> Optional[int]:
+        if len(self.start) == 0:
+            return None
+        return self.start[-1] + self.count[-1] * self.step[-1]
+
+    def _run(self, ts: float) -> int:
+        return bisect_right(self.start, ts) - 1
+
+    def stage_at(self, ts: float) -> Optional[int]:
+        """
+        Stage at the given timestamp, or None if it's outside of the hypnogram
+        """
+        i = self._run(ts)
+        end = self.end
+        if i < 0 or end is None or ts >= end:
+            return None
+        return self.stage[i]
+
+    def _spent(self, ts: float) -> dict[int, float]:
+        # seconds spent in each stage from the start until ts
+        i = self._run(ts)
+        if i < 0:
+            return dict.fromkeys(self._before, 0)
+        res: dict[int, float] = {s: before[i] for s, before in self._before.items()}
+        res[self.stage[i]] += min(ts - self.start[i], self._duration(i))
+        return res
+
+    def durations(self, since: Optional[float] = None, until: Optional[float] = None) -> dict[int, float]:
+        """
+        Seconds spent in each stage between since and until (whole hypnogram by default)
+        """
+        if until is None:
+            res: dict[int, float] = {s: before[-1] for s, before in self._before.items()}
+        else:
+            res = self._spent(until)
+        if since is not None:
+            for s, v in self._spent(since).items():
+                res[s] = max(res[s] - v, 0)
+        return res
+
+    @property
+    def first_asleep(self) -> Optional[int]:
+        """
+        Timestamp of the first non-awake epoch
+        """
+        i = self._first_asleep
+        return None if i is None else self.start[i]
+
+    @property
+    def last_asleep(self) -> Optional[int]:
+        """
+        Timestamp of the last non-awake epoch
+        """
+        i = self._last_asleep
+        return None if i is None else self.start[i] + (self.count[i] - 1) * self.step[i]
+
+    def epochs(self, lo: int = 0, hi: Optional[int] = None) -> list[list[int]]:
+        """
+        Decoded [timestamp, stage] pairs, same as epochs[lo:hi] in the original list.
+        """
+        lo, hi, _ = slice(lo, hi).indices(len(self))
+        res = []
+        for i in range(max(bisect_right(self.offset, lo) - 1, 0), len(self.start)):
+            offset = self.offset[i]
+            if offset >= hi:
+                break
+            start, stage, step = self.start[i], self.stage[i], self.step[i]
+            for k in range(max(lo - offset, 0), min(self.count[i], hi - offset)):
+                res.append([start + k * step, stage])
+        return res
+
+    def series(self) -> tuple[list[int], list[int]]:
+        tss: list[int] = []
+        stages: list[int] = []
+        for start, stage, count, step in zip(self.start, self.stage, self.count, self.step):
+            tss.extend(range(start, start + count * step, step) if step != 0 else [start] * count)
+            stages.extend([stage] * count)
+        return tss, stages
+
+    def asleep(self) -> slice:
+        """
+        Epoch indices from the first non-awake one, up to (but excluding) the last non-awake one
+        """
+        # NOTE: excluding the last one is how EmfitParse.strip_awakes always worked, keeping for compatibility
+        fi, li = self._first_asleep, self._last_asleep
+        if fi is None or li is None:
+            return slice(None)
+        return slice(self.offset[fi], self.offset[li] + self.count[li] - 1)
+
+
 # todo use multiple threads for that?
 class EmfitParse:
     # todo could get rid of sid parameter? it's in the json so don't really need anymore
-    def __init__(self, sid: str, raw: Json) -> None:
+    def __init__(self, sid: str, raw: Optional[Json] = None, *, path: Optional[Path] = None) -> None:
+        assert raw is not None or path is not None
         self.sid = sid
-        self.raw = raw
+        # if raw isn't passed, it's loaded from path on first access
+        self.path = path
+        if raw is not None:
+            self.__dict__['raw'] = raw
+
+    @classmethod
+    def from_path(cls, path: Path) -> EmfitParse:
+        return cls(session_sid(path), path=path)
+
+    @cached_property
+    def raw(self) -> Json:
+        assert self.path is not None
+        return json.loads(read_text(self.path))
 
     # TODO what was that for???
     def __hash__(self):
@@ -80,30 +278,27 @@ class EmfitParse:
         # these seems to be utc (can double check last epoch against to_utc field in export)
         return self.raw['sleep_epoch_datapoints']
 
+    @cached_property
+    def hypnogram(self) -> Hypnogram:
+        return Hypnogram(self.epochs)
+
     @property
     def epoch_series(self) -> tuple[list[int], list[int]]:
-        tss = []
-        eps = []
-        for (ts, e) in self.epochs:
-            tss.append(ts)
-            eps.append(e)
-        return tss, eps
+        return self.hypnogram.series()
 
-    @property
+    @cached_property
     def sleep_start(self) -> datetime_aware:
-        for (ts, e) in self.epochs:
-            if e == AWAKE:
-                continue
-            return fromts(ts)
-        raise RuntimeError
+        ts = self.hypnogram.first_asleep
+        if ts is None:
+            raise RuntimeError
+        return fromts(ts)
 
-    @property
+    @cached_property
     def sleep_end(self) -> datetime_aware:
-        for (ts, e) in reversed(self.epochs):
-            if e == AWAKE:
-                continue
-            return fromts(ts)
-        raise RuntimeError
+        ts = self.hypnogram.last_asleep
+        if ts is None:
+            raise RuntimeError
+        return fromts(ts)
 
     # so it's actual sleep, without awake
     # ok, so I need time_asleep
@@ -122,18 +317,7 @@ class EmfitParse:
 
     @property
     def strip_awakes(self):
-        ff = None
-        ll = None
-        for i, [_ts, e] in enumerate(self.epochs):
-            if e != AWAKE:
-                ff = i
-                break
-        for i in range(len(self.epochs) - 1, -1, -1):
-            [ts, e] = self.epochs[i]
-            if e != AWAKE:
-                ll = i
-                break
-        return self.epochs[ff:ll]
+        return self.epochs[self.hypnogram.asleep()]
 
     # # TODO epochs with implicit sleeps? not sure... e.g. night wakeups.
     # # I guess I could input intervals/correct data/exclude days manually?
@@ -191,12 +375,15 @@ class EmfitParse:
             # makes even more sense given tossturn datapoints only have timestamp
             yield ts, pulse
 
-    @property
+    @cached_property
     def sleep_hr(self):
+        # NOTE: computing bounds once here, otherwise it's quadratic in number of epochs
+        sleep_start = self.sleep_start.timestamp()
+        sleep_end = self.sleep_end.timestamp()
         tss = []
         res = []
         for ts, pulse in self.iter_points():
-            if self.sleep_start < fromts(ts) < self.sleep_end:
+            if sleep_start < ts < sleep_end:
                 tss.append(ts)
                 res.append(pulse)
         return tss, res
@@ -234,11 +421,122 @@ class EmfitParse:
         expected = len(hrs)
         return covered / expected * 100
 
+    @cached_property
+    def series(self) -> EmfitSeries:
+        return EmfitSeries(self)
+
+
+class EmfitSeries:
+    """
+    Same data as EmfitParse, but as numpy arrays, so derived series are computed with vectorized operations.
+    Missing values (null in json) are represented as nan.
+    If the session has binary sidecars, datapoints are memory mapped from them rather than decoded from json.
+    """
+
+    def __init__(self, em: EmfitParse) -> None:
+        self.em = em
+
+    def _sidecar(self, name: str) -> Optional[np.ndarray]:
+        path = self.em.path
+        return None if path is None else load_sidecar(path, name)
+
+    @cached_property
+    def measured(self) -> np.ndarray:
+        """
+        Columns: timestamp, pulse, breath, activity
+        """
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        sidecar = self._sidecar('measured')
+        if sidecar is not None:
+            return sidecar
+        return np.array(self.em.raw['measured_datapoints'], dtype=np.float64).reshape(-1, 4)
+
+    @cached_property
+    def hrv_rmssd(self) -> np.ndarray:
+        """
+        Columns: timestamp, rmssd, and 4 more columns of unclear meaning (see EmfitParse.hrv)
+        """
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        sidecar = self._sidecar('hrv')
+        if sidecar is not None:
+            return sidecar
+        return np.array(self.em.raw['hrv_rmssd_datapoints'], dtype=np.float64).reshape(-1, 6)
+
+    @cached_property
+    def epochs(self) -> np.ndarray:
+        """
+        Columns: timestamp, sleep stage
+        """
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        sidecar = self._sidecar('epochs')
+        if sidecar is not None:
+            return sidecar
+        return np.array(self.em.raw['sleep_epoch_datapoints'], dtype=np.int64).reshape(-1, 2)
+
+    @cached_property
+    def tossnturn(self) -> np.ndarray:
+        """
+        Timestamps of toss and turns
+        """
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        sidecar = self._sidecar('tossnturn')
+        if sidecar is not None:
+            return sidecar
+        # NOTE: tossnturn_datapoints can be null
+        return np.array(self.em.raw.get('tossnturn_datapoints') or [], dtype=np.float64)
+
+    @property
+    def epoch_series(self) -> tuple[np.ndarray, np.ndarray]:
+        return self.epochs[:, 0], self.epochs[:, 1]
+
+    @cached_property
+    def sleep_bounds(self) -> tuple[int, int]:
+        """
+        Timestamps of the first and last non-awake epochs
+        """
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        [asleep] = np.nonzero(self.epochs[:, 1] != AWAKE)
+        if len(asleep) == 0:
+            raise RuntimeError
+        tss = self.epochs[:, 0]
+        return int(tss[asleep[0]]), int(tss[asleep[-1]])
+
+    @cached_property
+    def sleep_hr(self) -> tuple[np.ndarray, np.ndarray]:
+        sleep_start, sleep_end = self.sleep_bounds
+        tss = self.measured[:, 0]
+        mask = (sleep_start < tss) & (tss < sleep_end)
+        return tss[mask], self.measured[mask, 1]
+
+    @property
+    def hrv(self) -> tuple[np.ndarray, np.ndarray]:
+        return self.hrv_rmssd[:, 0], self.hrv_rmssd[:, 1]
+
+    @property
+    def sleep_hr_coverage(self) -> float:
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        _, hrs = self.sleep_hr
+        covered = int(np.count_nonzero(~np.isnan(hrs)))
+        expected = len(hrs)
+        return covered / expected * 100
+
 
 # todo eh, I guess the reason for Emfit and EmfitParse was to make the latter cacheable?
 # maybe I should have a protocol/dataclass base and overload in EmfitParse instead?
 
 Sid = str
+Row = list[Any]
+
+PoolKind = Literal['thread', 'process']
+
+# dir mtimes this close to the listing aren't trusted by DAL._listing (e.g. FAT has 2s resolution)
+_RACY_MTIME_NS = 2_000_000_000
 
 
 @dataclass(eq=True, frozen=True)
@@ -283,40 +581,687 @@ class Emfit:
         # todo meh
         return cls(**{k: getattr(em, k) for k in Emfit.__annotations__})
 
+    # compact representation, e.g. for caching or passing between processes
+    # datetimes are stored as utc timestamps
+    def _to_row(self) -> Row:
+        return [getattr(self, k).timestamp() if k in _DATETIME_FIELDS else getattr(self, k) for k in _FIELDS]
+
+    @classmethod
+    def _from_row(cls, row: Row) -> Emfit:
+        kwargs: dict[str, Any] = {k: fromts(v) if k in _DATETIME_FIELDS else v for k, v in zip(_FIELDS, row)}
+        return cls(**kwargs)
+
+
+# NOTE: order matters, it defines the order in rows
+_FIELDS = list(Emfit.__annotations__)
+_DATETIME_FIELDS = {'start', 'end', 'sleep_start', 'sleep_end'}
+
+
+Period = Literal['week', 'month', 'year']
+
+# recovery (hrv), resting hr and sleep duration
+TREND_METRICS = ('recovery', 'measured_hr_avg', 'time_in_bed')
+
+
+class SleepTable:
+    """
+    Struct-of-arrays version of list[Emfit]: each Emfit field is a numpy column.
+    Datetimes are stored as int64 utc epoch seconds, missing values as nan.
+    Rows are only turned into Emfit objects on access.
+    """
+
+    def __init__(self, columns: dict[str, np.ndarray], *, errors: Optional[list[Exception]] = None) -> None:
+        assert set(columns) == set(_FIELDS), set(columns) ^ set(_FIELDS)
+        self.columns = columns
+        # errors encountered while collecting the table (see DAL.sleep_table)
+        self.errors = [] if errors is None else errors
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Row], *, errors: Optional[list[Exception]] = None) -> SleepTable:
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        rows = list(rows)
+        columns = {}
+        for i, field in enumerate(_FIELDS):
+            column = [row[i] for row in rows]
+            if field == 'sid':
+                columns[field] = np.array(column, dtype=np.str_)
+            elif field in _DATETIME_FIELDS:
+                columns[field] = np.array(column, dtype=np.int64)
+            else:
+                columns[field] = np.array([np.nan if v is None else v for v in column], dtype=np.float64)
+        return cls(columns, errors=errors)
+
+    @classmethod
+    def from_emfits(cls, emfits: Iterable[Emfit]) -> SleepTable:
+        return cls.from_rows(e._to_row() for e in emfits)
+
+    def __len__(self) -> int:
+        return len(self.columns['sid'])
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        columns = self.__dict__.get('columns', {})
+        if name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, i: int) -> Emfit:
+        row = []
+        for field in _FIELDS:
+            v = self.columns[field][i].item()
+            if v != v:  # noqa: PLR0124
+                v = None  # nan was used for missing values
+            row.append(v)
+        return Emfit._from_row(row)
 
-def _process_one(json_path: Path, i: int, total: int) -> Res[Emfit]:
-    logger.info(f'processing {json_path} ({i}/{total})')
+    def __iter__(self) -> Iterator[Emfit]:
+        for i in range(len(self)):
+            yield self[i]
+
+    # vectorized versions of Emfit properties
+
+    @property
+    def respiratory_rate_avg(self) -> np.ndarray:
+        return self.columns['measured_rr_avg']
+
+    @property
+    def date(self) -> np.ndarray:
+        # NOTE: Emfit.date is end date in utc
+        return self.columns['end'].astype('datetime64[s]').astype('datetime64[D]')
+
+    @property
+    def time_in_bed(self) -> np.ndarray:
+        return (self.columns['sleep_end'] - self.columns['sleep_start']) // 60
+
+    @property
+    def recovery(self) -> np.ndarray:
+        return self.columns['hrv_morning'] - self.columns['hrv_evening']
+
+    def trends(self, metrics: Iterable[str] = TREND_METRICS, *, window: int = 7) -> Trends:
+        trends = Trends(metrics, window=window)
+        trends.extend(self)
+        return trends
+
+
+def _period_start(days: np.ndarray, period: Period) -> np.ndarray:
+    """
+    Maps days since epoch to the first day of the calendar period they fall into (weeks start on Monday).
+    """
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    if period == 'week':
+        # NOTE: 1970-01-01 was a Thursday, i.e. weekday 3
+        return days - (days + 3) % 7
+    unit = {'month': 'M', 'year': 'Y'}[period]
+    return days.astype('datetime64[D]').astype(f'datetime64[{unit}]').astype('datetime64[D]').astype(np.int64)
+
+
+class Trends:
+    """
+    Trailing rolling means and calendar-bucketed means of nightly metrics (any SleepTable column/property).
+    Nights are bucketed by SleepTable.date, missing values are skipped.
+
+    Everything is derived from prefix sums over nights sorted by date, so extending with newer nights
+    (e.g. after the daily export) is proportional to the number of new nights rather than the whole history.
+    """
+
+    def __init__(self, metrics: Iterable[str] = TREND_METRICS, *, window: int = 7) -> None:
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        self.metrics = list(metrics)
+        self.window = window  # in calendar days, including the night itself
+
+        self._n = 0
+        # NOTE: buffers grow geometrically, only [:n] (or [:n + 1] for prefix sums) is meaningful
+        self._days = np.empty(16, dtype=np.int64)
+        self._values = {m: np.empty(16) for m in self.metrics}
+        self._rolling = {m: np.empty(16) for m in self.metrics}
+        # prefix sums of values (missing as 0) and of non-missing counts, starting with 0
+        self._sums = {m: np.zeros(17) for m in self.metrics}
+        self._counts = {m: np.zeros(17, dtype=np.int64) for m in self.metrics}
+
+    def __len__(self) -> int:
+        return self._n
+
+    @property
+    def dates(self) -> np.ndarray:
+        return self._days[: self._n].astype('datetime64[D]')
+
+    def _reserve(self, n: int) -> None:
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        capacity = len(self._days)
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity *= 2
+        grow = lambda a, size: np.concatenate([a, np.empty(size - len(a), dtype=a.dtype)])
+        self._days = grow(self._days, capacity)
+        for m in self.metrics:
+            self._values[m] = grow(self._values[m], capacity)
+            self._rolling[m] = grow(self._rolling[m], capacity)
+            self._sums[m] = grow(self._sums[m], capacity + 1)
+            self._counts[m] = grow(self._counts[m], capacity + 1)
+
+    def extend(self, table: SleepTable) -> None:
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        if len(table) == 0:
+            return
+        days = table.date.astype(np.int64)
+        order = np.argsort(days, kind='stable')
+        days = days[order]
+        values = {m: getattr(table, m)[order].astype(np.float64) for m in self.metrics}
+
+        n = self._n
+        if n > 0 and days[0] < self._days[n - 1]:
+            # backfilled nights older than what we've got, so prefix sums have to be rebuilt
+            days = np.concatenate([self._days[:n], days])
+            order = np.argsort(days, kind='stable')
+            days = days[order]
+            values = {m: np.concatenate([self._values[m][:n], values[m]])[order] for m in self.metrics}
+            n = 0
+
+        end = n + len(days)
+        self._reserve(end)
+        self._days[n:end] = days
+        all_days = self._days[:end]
+        # start of the trailing window for each new night
+        lo = np.searchsorted(all_days, days - (self.window - 1), side='left')
+        hi = np.arange(n + 1, end + 1)
+        for m in self.metrics:
+            v = values[m]
+            valid = ~np.isnan(v)
+            self._values[m][n:end] = v
+            sums = self._sums[m]
+            counts = self._counts[m]
+            sums[n + 1 : end + 1] = sums[n] + np.cumsum(np.where(valid, v, 0.0))
+            counts[n + 1 : end + 1] = counts[n] + np.cumsum(valid)
+            self._rolling[m][n:end] = _safe_mean(sums[hi] - sums[lo], counts[hi] - counts[lo])
+        self._n = end
+
+    def append(self, emfit: Emfit) -> None:
+        self.extend(SleepTable.from_emfits([emfit]))
+
+    def rolling(self, metric: str) -> np.ndarray:
+        """
+        Mean over nights within the trailing window, for each night (in date order, see dates).
+        """
+        return self._rolling[metric][: self._n].copy()
+
+    def calendar(self, metric: str, period: Period = 'week') -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns (period start dates, means, number of nights with a value) for each period with any nights.
+        """
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        n = self._n
+        days = self._days[:n]
+        starts = np.unique(_period_start(days, period))
+        bounds = np.append(np.searchsorted(days, starts, side='left'), n)
+        sums = self._sums[metric][bounds]
+        counts = self._counts[metric][bounds]
+        nights = np.diff(counts)
+        return starts.astype('datetime64[D]'), _safe_mean(np.diff(sums), nights), nights
+
+
+def _safe_mean(sums: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+# raw keys Emfit.from_json actually needs
+_SUMMARY_KEYS = frozenset({
+    'id',
+    'time_start',
+    'time_end',
+    'hrv_rmssd_morning',
+    'hrv_rmssd_evening',
+    'hrv_lf',
+    'hrv_hf',
+    'measured_hr_avg',
+    'measured_rr_avg',
+    'sleep_duration',
+    'sleep_epoch_datapoints',
+    'measured_datapoints',  # for sleep_hr_coverage
+})
+
+_WS = re.compile(r'\s*')
+_END2 = re.compile(r'\]\s*\]')
+_decoder = json.JSONDecoder()
+
+
+def _skip_array(s: str, i: int) -> Optional[int]:
+    """
+    Fast path for skipping datapoint arrays without building any objects.
+    Only handles flat or 2-level arrays without strings, returns None otherwise.
+    """
+    if s[i] != '[':
+        return None
+    end = s.find(']', i) + 1
+    if s.count('[', i, end) != 1:
+        m = _END2.search(s, i)
+        if m is None:
+            return None
+        end = m.end()
+        if s.count('[', i, end) != s.count(']', i, end):
+            return None
+    if s.find('"', i, end) != -1:
+        return None
+    return end
+
+
+def _skip_ws(s: str, i: int) -> int:
+    m = _WS.match(s, i)
+    assert m is not None  # can't happen, \s* always matches
+    return m.end()
+
+
+def _loads_summary(s: str, keys: frozenset[str] = _SUMMARY_KEYS) -> Json:
+    """
+    Like json.loads, but only keeps the top-level keys Emfit needs (or the ones passed).
+    Other values (e.g. hrv_rmssd_datapoints) are skipped, so it's cheaper in time and memory.
+    """
+    raw_decode = _decoder.raw_decode
+
+    res: Json = {}
+    i = _skip_ws(s, 0)
+    assert s[i] == '{', s[i]
+    i = _skip_ws(s, i + 1)
+    if s[i] == '}':
+        return res
+    while True:
+        key, i = raw_decode(s, i)
+        i = _skip_ws(s, i)
+        assert s[i] == ':', s[i]
+        i = _skip_ws(s, i + 1)
+        if key in keys:
+            res[key], i = raw_decode(s, i)
+        else:
+            end = _skip_array(s, i)
+            if end is None:
+                _, end = raw_decode(s, i)
+            i = end
+        i = _skip_ws(s, i)
+        c = s[i]
+        if c == '}':
+            return res
+        assert c == ',', c
+        i = _skip_ws(s, i + 1)
+
+
+def _process_one(json_path: Path, i: int, total: int, *, summary_only: bool = False) -> Res[Emfit]:
+    logger.info('processing %s (%d/%d)', json_path, i, total)
     try:
-        j = json.loads(json_path.read_text())
+        text = read_text(json_path)
+        j = _loads_summary(text) if summary_only else json.loads(text)
         return Emfit.from_json(j)
     except Exception as ex:
         return ex
 
 
+def _process_one_timed(json_path: Path, i: int, total: int, *, summary_only: bool, queue_wait: float) -> tuple[Res[Emfit], SessionStats]:
+    """
+    Same as _process_one, but also measures how long each stage took
+    """
+    logger.info('processing %s (%d/%d)', json_path, i, total)
+    read = decode = construct = 0.0
+    size = 0
+    res: Res[Emfit]
+    start = time.perf_counter()
+    try:
+        size = json_path.stat().st_size
+        text = read_text(json_path)
+        read = time.perf_counter() - start
+        j = _loads_summary(text) if summary_only else json.loads(text)
+        decode = time.perf_counter() - start - read
+        res = Emfit.from_json(j)
+        construct = time.perf_counter() - start - read - decode
+    except Exception as ex:
+        res = ex
+    stats = SessionStats(
+        name=json_path.name,
+        bytes_read=size,
+        read=read,
+        decode=decode,
+        construct=construct,
+        queue_wait=queue_wait,
+        error=isinstance(res, Exception),
+    )
+    return res, stats
+
+
+def _process_chunk(
+    items: list[tuple[int, Path]],
+    total: int,
+    *,
+    summary_only: bool,
+    compact: bool,
+    timed: bool = False,
+    submitted: Optional[float] = None,
+) -> tuple[list[Res[Union[Emfit, Row]]], Optional[list[SessionStats]]]:
+    """
+    If compact, returns rows instead of Emfit objects, they are much cheaper to pickle between processes.
+    If timed, also returns stats for each session. submitted is wall clock time the chunk was submitted to the pool.
+    """
+    res: list[Res[Union[Emfit, Row]]] = []
+    stats: Optional[list[SessionStats]] = [] if timed else None
+    # NOTE: wall clock, since the chunk might've been submitted from another process
+    queue_wait = 0.0 if submitted is None else time.time() - submitted
+    for i, f in items:
+        if stats is None:
+            r = _process_one(f, i, total, summary_only=summary_only)
+        else:
+            r, s = _process_one_timed(f, i, total, summary_only=summary_only, queue_wait=queue_wait)
+            stats.append(s)
+        res.append(r._to_row() if compact and isinstance(r, Emfit) else r)
+    return res, stats
+
+
+class Session:
+    """
+    Lightweight handle for a night: the summary (Emfit) is kept in memory, and raw data is loaded on demand
+    through a RawCache shared by all handles, so paging through lots of nights keeps a bounded number of raw sessions around.
+    Emfit fields and properties are accessible on the handle directly.
+    """
+
+    def __init__(self, emfit: Emfit, path: Path, cache: RawCache[EmfitParse]) -> None:
+        self.emfit = emfit
+        self.path = path
+        self._cache = cache
+
+    def __getattr__(self, name: str) -> Any:
+        # NOTE: only called for attributes missing on the handle itself
+        emfit = self.__dict__.get('emfit')
+        if emfit is None:
+            raise AttributeError(name)
+        return getattr(emfit, name)
+
+    def __repr__(self) -> str:
+        return f'Session({self.emfit.sid}, path={self.path})'
+
+    @property
+    def parse(self) -> EmfitParse:
+        # NOTE: better not to hold on to it, otherwise it's kept in memory regardless of the cache
+        return self._cache.get(self.path)
+
+    @property
+    def raw(self) -> Json:
+        return self.parse.raw
+
+    def iter_points(self):
+        return self.parse.iter_points()
+
+    @property
+    def hrv(self):
+        return self.parse.hrv
+
+    @property
+    def epochs(self) -> list[tuple[int, int]]:
+        return self.parse.epochs
+
+    @property
+    def hypnogram(self) -> Hypnogram:
+        return self.parse.hypnogram
+
+    @property
+    def series(self) -> EmfitSeries:
+        return self.parse.series
+
+
 class DAL:
-    def __init__(self, export_path: Path, *, cpu_pool: Optional[Executor] = None) -> None:
+    def __init__(
+        self,
+        export_path: Path,
+        *,
+        cpu_pool: Optional[Executor] = None,
+        cache_path: Optional[Path] = None,
+        summary_only: bool = False,
+        window: int = 64,
+        use_manifest: bool = False,
+        workers: Optional[int] = None,
+        pool: PoolKind = 'process',
+        chunk_size: Optional[int] = None,
+        stats: Optional[Stats] = None,
+        raw_cache_size: int = 16,
+    ) -> None:
         self.export_path = export_path
+        # NOTE: either pass your own executor as cpu_pool, or set workers to let DAL manage the pool
+        assert cpu_pool is None or workers is None, 'cpu_pool and workers are mutually exclusive'
         self.cpu_pool = cpu_pool
+        self.workers = workers
+        self.pool = pool
+        # number of sessions processed in a single task
+        self.chunk_size = chunk_size
+        # max number of chunks submitted to the pool that haven't been consumed yet
+        self.window = window
+        # list sessions from the export manifest (see manifest.py) instead of scanning the directory
+        self.use_manifest = use_manifest
+        # only decode the fields needed for Emfit, skipping the rest of datapoints
+        self.summary_only = summary_only
+        # if set, parsed summaries are persisted there, so only new/changed files are processed
+        self.cache = None if cache_path is None else SummaryCache(cache_path, fields=_FIELDS)
+        # if set, per session timings are collected there (see stats.py)
+        self.stats = stats
+        # raw sessions loaded on demand by handles(), at most raw_cache_size of them are kept in memory
+        self.raw_cache: RawCache[EmfitParse] = RawCache(EmfitParse.from_path, maxsize=raw_cache_size)
+        # (export dir mtime, session files by sid, files which couldn't be indexed), see _listing
+        self._listed: Optional[tuple[int, dict[Sid, Path], list[Path]]] = None
+
+    @cached_property
+    def archive(self) -> Archive:
+        """
+        If export_path is a packed archive (see archive.py), gives access to it, including zero-copy datapoints
+        """
+        from .archive import Archive  # noqa: PLC0415  # circular import
 
-    def sleeps(self) -> Iterator[Res[Emfit]]:
+        return Archive(self.export_path)
+
+    def sleeps(
+        self,
+        *,
+        ordered: bool = True,
+        since: Optional[datetime_aware] = None,
+        until: Optional[datetime_aware] = None,
+    ) -> Iterator[Res[Emfit]]:
+        """
+        If ordered is False, results are yielded as soon as they are processed, otherwise sorted by sid
+        since/until restrict to sessions overlapping with the interval
+        """
         assert self.export_path.exists(), self.export_path  # ugh glob will just return empty sequence if dir doesn't exist
 
-        # NOTE: ids seems to be consistent with ascending date order
-        paths = sorted(self.export_path.glob('*.json'))
+        if self.export_path.is_file():
+            for e in self.archive.sleeps():
+                if (since is None or e.end >= since) and (until is None or e.start <= until):
+                    yield e
+            return
+
+        paths = self._paths(since=since, until=until)
+        # NOTE: with since/until, paths are only a subset of the export, so can't tell which cache entries are stale
+        for _, res in self._sleeps(paths, ordered=ordered, retain=since is None and until is None):
+            yield res
 
-        cpu_pool = self.cpu_pool
+    def _sleeps(self, paths: list[Path], *, ordered: bool, retain: bool) -> Iterator[tuple[Path, Res[Emfit]]]:
+        """
+        Processes paths (see _paths), yields results along with the session file they came from
+        If retain is True, paths are the whole export, so stale cache entries can be dropped
+        """
+        with ExitStack() as stack:
+            cache = None if self.cache is None else stack.enter_context(self.cache.open())
+            pool, compact = self._pool(stack)
+
+            chunk_size = self.chunk_size
+            if chunk_size is None:
+                # a few chunks per worker, so they are load balanced
+                chunk_size = 1 if self.workers is None else max(1, min(16, len(paths) // (self.workers * 4)))
+            items = list(enumerate(paths))
+            chunks = [items[k : k + chunk_size] for k in range(0, len(items), chunk_size)]
+
+            hits: dict[Path, Row] = {}
+            stats = self.stats
+
+            def submit(chunk: list[tuple[int, Path]]) -> Future[tuple[list[Res[Union[Emfit, Row]]], Optional[list[SessionStats]]]]:
+                misses = []
+                for i, f in chunk:
+                    row = None if cache is None else cache.get(f)
+                    if row is None:
+                        misses.append((i, f))
+                    else:
+                        hits[f] = row
+                timed = stats is not None
+                if pool is None or len(misses) == 0:
+                    # NOTE: processed in the main thread, so no queue wait
+                    return DummyFuture(_process_chunk, misses, len(paths), summary_only=self.summary_only, compact=compact, timed=timed)
+                submitted = time.time() if timed else None
+                return pool.submit(_process_chunk, misses, len(paths), summary_only=self.summary_only, compact=compact, timed=timed, submitted=submitted)
+
+            # NOTE: only keeping a window of futures, otherwise all results would pile up in memory before we yield anything
+            for chunk, (results, session_stats) in bounded_results(submit, chunks, window=self.window, ordered=ordered):
+                if stats is not None:
+                    for s in session_stats or []:
+                        stats.record(s)
+                it = iter(results)
+                for _, f in chunk:
+                    row = hits.pop(f, None)
+                    if row is not None:
+                        if stats is not None:
+                            stats.cache_hits += 1
+                        yield f, Emfit._from_row(row)
+                        continue
+                    r = next(it)
+                    fres = Emfit._from_row(r) if isinstance(r, list) else r
+                    if cache is not None and isinstance(fres, Emfit):
+                        cache.put(f, r if isinstance(r, list) else fres._to_row())
+                    yield f, fres
+
+            if cache is not None and retain:
+                cache.retain(paths)
+            if stats is not None:
+                logger.info('stats:\n%s', stats.summary())
+
+    def _paths(self, *, since: Optional[datetime_aware], until: Optional[datetime_aware]) -> list[Path]:
+        # NOTE: ids seems to be consistent with ascending date order
+        windowed = since is not None or until is not None
+        manifest = self._manifest()
+        if manifest is not None:
+            paths = manifest.paths()
+            if not windowed:
+                return paths
+            by_sid = {session_sid(p): p for p in paths}
+            failed = self._time_index.refresh(paths)
+        elif not windowed:
+            return session_paths(self.export_path)
+        else:
+            by_sid, failed = self._listing()
+
+        # NOTE: only the sessions overlapping [since, until] are opened
+        # files which couldn't be indexed are kept, so errors are reported same way as without the window
+        wanted = {session_sid(p) for p in failed}
+        wanted.update(self._time_index.query(since=since, until=until))
+        return [by_sid[sid] for sid in sorted(wanted) if sid in by_sid]
+
+    def _manifest(self) -> Optional[Manifest]:
+        if not self.use_manifest:
+            return None
+        from .manifest import Manifest  # noqa: PLC0415  # circular import
+
+        manifest = Manifest(self.export_path)
+        if not manifest.exists():
+            # e.g. the export dir was created by an older exporter, or populated manually
+            logger.warning('%s: no export manifest, falling back to listing the directory', self.export_path)
+            return None
+        return manifest
+
+    @cached_property
+    def _time_index(self) -> TimeIndex:
+        from .index import TimeIndex  # noqa: PLC0415  # circular import
+
+        return TimeIndex(self.export_path)
+
+    def _listing(self) -> tuple[dict[Sid, Path], list[Path]]:
+        """
+        Session files by sid, and the ones which couldn't be indexed.
+        The export dir is only listed (and the index refreshed) if the dir changed since the last call.
+        """
+        st_mtime_ns = self.export_path.stat().st_mtime_ns
+        cached = self._listed
+        if cached is not None and cached[0] == st_mtime_ns:
+            return cached[1], cached[2]
+
+        started_ns = time.time_ns()
+        paths = session_paths(self.export_path)
+        failed = self._time_index.refresh(paths)
+        by_sid = {session_sid(p): p for p in paths}
+        # NOTE: stat again, refresh might have rewritten the index file in the export dir
+        st_mtime_ns = self.export_path.stat().st_mtime_ns
+        # NOTE: with coarse mtime resolution, a file added right after listing might not bump the dir mtime
+        # so only trusting mtimes which are older than the listing by a safe margin
+        trusted = st_mtime_ns < started_ns - _RACY_MTIME_NS
+        self._listed = (st_mtime_ns, by_sid, failed) if trusted else None
+        return by_sid, failed
+
+    def sessions(
+        self,
+        *,
+        since: Optional[datetime_aware] = None,
+        until: Optional[datetime_aware] = None,
+    ) -> Iterator[EmfitParse]:
+        """
+        Lazily loaded sessions: json is only decoded when needed, datapoints are served from sidecars if there are any (see storage.write_sidecars)
+        """
+        assert self.export_path.is_dir(), self.export_path
+        for p in self._paths(since=since, until=until):
+            yield EmfitParse.from_path(p)
+
+    def handles(
+        self,
+        *,
+        since: Optional[datetime_aware] = None,
+        until: Optional[datetime_aware] = None,
+    ) -> Iterator[Res[Session]]:
+        """
+        Same as sleeps(), but yields Session handles, which load raw data on demand through raw_cache
+        """
+        assert self.export_path.is_dir(), self.export_path
+        paths = self._paths(since=since, until=until)
+        for path, e in self._sleeps(paths, ordered=True, retain=since is None and until is None):
+            if isinstance(e, Exception):
+                yield e
+            else:
+                yield Session(e, path, self.raw_cache)
 
-        futures = []
-        for i, f in enumerate(paths):
-            if cpu_pool is not None:
-                future = cpu_pool.submit(_process_one, f, i, len(paths))
+    def sleep_table(self) -> SleepTable:
+        """
+        All sleeps as a columnar table, much more compact than a list of Emfit objects
+        Errors are collected in SleepTable.errors
+        """
+        if self.export_path.is_file():
+            return self.archive.table()
+        rows = []
+        errors = []
+        for e in self.sleeps():
+            if isinstance(e, Exception):
+                errors.append(e)
             else:
-                future = DummyFuture(_process_one, f, i, len(paths))
-            futures.append(future)
+                rows.append(e._to_row())
+        return SleepTable.from_rows(rows, errors=errors)
 
-        for fut in futures:
-            fres = fut.result()
-            yield fres
+    def _pool(self, stack: ExitStack) -> tuple[Optional[Executor], bool]:
+        """
+        Returns executor to use, and whether results should be passed back in compact form (i.e. rows)
+        """
+        if self.cpu_pool is not None:
+            return self.cpu_pool, isinstance(self.cpu_pool, ProcessPoolExecutor)
+        if self.workers is None:
+            return None, False
+        pool: Executor
+        if self.pool == 'process':
+            pool = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            pool = ThreadPoolExecutor(max_workers=self.workers)
+        stack.callback(pool.shutdown, wait=True, cancel_futures=True)
+        return pool, self.pool == 'process'
 
 
 # legacy function, used to be called from HPI. keeping for bwd compatibility
@@ -326,11 +1271,14 @@ def sleeps(path: Path, *, cpu_pool: Optional[Executor] = None) -> Iterator[Res[E
 
 ### end of main DAL, rest is test & supplementary code
 class FakeData:
+    """
+    Each night is drawn from its own random stream (derived from the seed and night index),
+    so the output for a given seed is the same regardless of whether nights are generated one by one via generate(),
+    or in bulk by fill(), with any number of workers.
+    """
+
     def __init__(self, seed: int = 0) -> None:
         self.seed = seed
-        import numpy as np
-
-        self.gen = np.random.default_rng(seed=self.seed)
         self.id = 0
 
         # hr is sort of a random walk?? probably not very accurate, but whatever
@@ -354,132 +1302,173 @@ class FakeData:
     def today(self) -> datetime:
         return self.first_day + timedelta(days=self.id)
 
-    def generate(self) -> Json:
-        import numpy as np
+    def _rngs(self, i: int) -> tuple[np.random.Generator, np.random.Generator]:
+        """
+        Streams for the random walk step after the night and for the night itself
+        """
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        walk, night = np.random.SeedSequence(self.seed, spawn_key=(i,)).spawn(2)
+        return np.random.default_rng(walk), np.random.default_rng(night)
+
+    def _walk(self, count: int) -> list[tuple[float, float, float, float]]:
+        """
+        Advances the random walk by count nights, returns the state for each of them
+        NOTE: this is inherently serial, but cheap compared to generating the nights
+        """
+        states = []
+        for i in range(self.id, self.id + count):
+            states.append((self.cur_avg_hr, self.rr_avg, self.hrv_morning, self.hrv_evening))
+            G, _ = self._rngs(i)
+            dhr, drr, dmorning, devening = G.normal(0, [0.5, 0.1, 0.9, 0.9]).tolist()
+            # fmt: off
+            self.hrv_morning += dmorning
+            self.hrv_evening += devening
+            self.cur_avg_hr  += dhr
+            self.rr_avg      += drr
+            # fmt: on
+        self.id += count
+        return states
+
+    def _make_sleep(self, i: int, state: tuple[float, float, float, float]) -> Json:
+        import numpy as np  # noqa: PLC0415  # numpy is optional
 
         # todo ok, mimesize seems pretty useless for now?
         # from mimesis.schema import Field, Schema # type: ignore
         # mark fields I didn't bother filling for now
         # F = Field('en')
         todo = None
-        G = self.gen
+        _, G = self._rngs(i)
+        avg_hr, rr_avg, hrv_morning, hrv_evening = state
+        D = timedelta
+        today = self.first_day + D(days=i)
 
-        def make_sleep():
-            D = timedelta
+        def ntd(mean: float, sigma: float) -> timedelta:
+            # 'normal' timedelta minutes
+            val = G.normal(mean, sigma)
+            val = max(0, val)
+            return D(minutes=int(val))
 
-            def ntd(mean, sigma):
-                # 'normal' timedelta minutes
-                val = G.normal(mean, sigma)
-                val = max(0, val)
-                return D(minutes=int(val))
+        sleep_minutes = ntd(self.avg_sleep_minutes, 60)
 
-            sleep_minutes = ntd(self.avg_sleep_minutes, 60)
+        T = lambda d: int(d.timestamp())  # assume it's aligned by seconds for simplicity
+        # fmt: off
+        bed_start   = today + D(hours=23)  # todo randomize
+        bed_end     = bed_start + sleep_minutes
+        sleep_start = bed_start + ntd(30, 10)
+        sleep_end   = bed_end   - ntd(20, 10)
+        # fmt: on
 
-            T = lambda d: int(d.timestamp())  # assume it's aligned by seconds for simplicity
-            # fmt: off
-            bed_start   = self.today + D(hours=23)  # todo randomize
-            bed_end     = bed_start + sleep_minutes
-            sleep_start = bed_start + ntd(30, 10)
-            sleep_end   = bed_end   - ntd(20, 10)
-            # fmt: on
+        utcoffset = self.tz.utcoffset(today)
+        assert utcoffset is not None
+        gmt_offset = utcoffset / D(minutes=1)
 
-            gmt_offset = self.tz.utcoffset(self.today) / D(minutes=1)
+        sleep_duration = (sleep_end - sleep_start) / D(seconds=1)
 
-            sleep_duration = (sleep_end - sleep_start) / D(seconds=1)
+        # todo decide on periods when woken up first (sort of poisson distribution?), then fit the rest
+        # todo instead, arange and assume sample every 5 secs or something?
+        tss = np.arange(T(bed_start), T(bed_end), self.frequency.total_seconds())
+        n = len(tss)
 
-            count = int((sleep_end - sleep_start) / self.frequency)
+        # NOTE: whole night is drawn at once; object arrays so tolist() gives plain python values and nulls
+        hrv_rmssd = np.full((n, 6), todo, dtype=object)
+        hrv_rmssd[:, 0] = tss
+        hrv_rmssd[:, 1] = 0  # TODO HRV
 
-            # todo decide on periods when woken up first (sort of poisson distribution?), then fit the rest
-            # todo instead, arange and assume sample every 5 secs or something?
-            tss = np.arange(T(bed_start), T(bed_end), self.frequency.total_seconds())
+        measured = np.full((n, 4), todo, dtype=object)  # last column is activity??
+        measured[:, 0] = tss
+        measured[:, 1] = G.normal(60, 5, size=n)  # TODO vary it throughout the night & have a global trend
+        measured[:, 2] = G.normal(12, 2, size=n)
 
-            arange = np.arange
-            # fmt: off
-            return {
-                "bed_exit_count"            : todo,
-                "bed_exit_duration"         : todo,
-                "bed_exit_periods"          : todo,
-                "device_id"                 : self.device_id,
-                "from_utc"                  : todo,
-                "hrv_hf"                    : todo,
-                "hrv_lf"                    : todo,
-                "hrv_recovery_integrated"   : todo,
-                "hrv_recovery_rate"         : todo,
-                "hrv_recovery_ratio"        : todo,
-                "hrv_recovery_total"        : todo,
-                "hrv_rmssd_datapoints"      : [(
-                    ts,
-                    0,  # TODO HRV
-                    todo,
-                    todo,
-                    todo,
-                    todo
-                ) for ts in tss],
-                "hrv_rmssd_evening"         : self.hrv_evening,
-                "hrv_rmssd_morning"         : self.hrv_morning,
-                "id"                        : f'{self.id:06}',
-                "measured_activity_avg"     : todo,
-                "measured_datapoints"       : [(
-                    ts,
-                    G.normal(60, 5),  # TODO vary it throughout the night & have a global trend
-                    G.normal(12, 2),
-                    todo, # activity??
-                ) for ts in tss],
-                "measured_hr_avg"           : self.cur_avg_hr,  # todo simulate nightly HR via this
-                "measured_hr_max"           : todo,
-                "measured_hr_min"           : todo,
-                # todo this should also be inferred instead from raw data
-                "measured_rr_avg"           : self.rr_avg,
-                "measured_rr_max"           : todo,
-                "measured_rr_min"           : todo,
-                "nodata_periods"            : todo,
-                "note"                      : todo,
-                "sleep_awakenings"          : todo,
-                "sleep_class_awake_duration": todo,
-                "sleep_class_awake_percent" : todo,
-                "sleep_class_deep_duration" : todo,
-                "sleep_class_deep_percent"  : todo,
-                "sleep_class_light_duration": todo,
-                "sleep_class_light_percent" : todo,
-                "sleep_class_rem_duration"  : todo,
-                "sleep_class_rem_percent"   : todo,
-                "sleep_duration"            : sleep_duration,
-                "sleep_efficiency"          : todo,
-                "sleep_epoch_datapoints"    : [(t, AWAKE) for t in range(T(bed_start)  , T(sleep_start), 60)] + \
-                                              [(t, 3    ) for t in range(T(sleep_start), T(sleep_end  ), 60)] + \
-                                              [(t, AWAKE) for t in range(T(sleep_end)  , T(bed_end)    , 60)],
-                "sleep_onset_duration"      : todo,
-                "sleep_score"               : todo,
-                "sleep_score_2"             : todo,
-                "snoring_data"              : todo,
-                "system_nodata_periods"     : todo,
-                "time_duration"             : todo,
-                "time_end"                  : T(bed_start),
-                "time_end_string"           : todo,
-                "time_in_bed_duration"      : todo,
-                "time_start"                : T(bed_end),
-                "time_start_gmt_offset"     : gmt_offset,
-                "time_user_gmt_offset"      : todo,
-                "to_utc"                    : todo,
-                "tossnturn_count"           : todo,  # todo derive
-                "tossnturn_datapoints"      : todo,
-            }
-            # fmt: on
+        ets = np.arange(T(bed_start), T(bed_end), 60)
+        epochs = np.empty((len(ets), 2), dtype=object)
+        epochs[:, 0] = ets
+        epochs[:, 1] = np.where((ets >= T(sleep_start)) & (ets < T(sleep_end)), 3, AWAKE)
 
-        j = make_sleep()
         # fmt: off
-        self.hrv_morning += G.normal(0, 0.9)
-        self.hrv_evening += G.normal(0, 0.9)
-        self.cur_avg_hr  += G.normal(0, 0.5)
-        self.rr_avg      += G.normal(0, 0.1)
+        return {
+            "bed_exit_count"            : todo,
+            "bed_exit_duration"         : todo,
+            "bed_exit_periods"          : todo,
+            "device_id"                 : self.device_id,
+            "from_utc"                  : todo,
+            "hrv_hf"                    : todo,
+            "hrv_lf"                    : todo,
+            "hrv_recovery_integrated"   : todo,
+            "hrv_recovery_rate"         : todo,
+            "hrv_recovery_ratio"        : todo,
+            "hrv_recovery_total"        : todo,
+            "hrv_rmssd_datapoints"      : hrv_rmssd.tolist(),
+            "hrv_rmssd_evening"         : hrv_evening,
+            "hrv_rmssd_morning"         : hrv_morning,
+            "id"                        : f'{i:06}',
+            "measured_activity_avg"     : todo,
+            "measured_datapoints"       : measured.tolist(),
+            "measured_hr_avg"           : avg_hr,  # todo simulate nightly HR via this
+            "measured_hr_max"           : todo,
+            "measured_hr_min"           : todo,
+            # todo this should also be inferred instead from raw data
+            "measured_rr_avg"           : rr_avg,
+            "measured_rr_max"           : todo,
+            "measured_rr_min"           : todo,
+            "nodata_periods"            : todo,
+            "note"                      : todo,
+            "sleep_awakenings"          : todo,
+            "sleep_class_awake_duration": todo,
+            "sleep_class_awake_percent" : todo,
+            "sleep_class_deep_duration" : todo,
+            "sleep_class_deep_percent"  : todo,
+            "sleep_class_light_duration": todo,
+            "sleep_class_light_percent" : todo,
+            "sleep_class_rem_duration"  : todo,
+            "sleep_class_rem_percent"   : todo,
+            "sleep_duration"            : sleep_duration,
+            "sleep_efficiency"          : todo,
+            "sleep_epoch_datapoints"    : epochs.tolist(),
+            "sleep_onset_duration"      : todo,
+            "sleep_score"               : todo,
+            "sleep_score_2"             : todo,
+            "snoring_data"              : todo,
+            "system_nodata_periods"     : todo,
+            "time_duration"             : todo,
+            "time_end"                  : T(bed_end),
+            "time_end_string"           : todo,
+            "time_in_bed_duration"      : todo,
+            "time_start"                : T(bed_start),
+            "time_start_gmt_offset"     : gmt_offset,
+            "time_user_gmt_offset"      : todo,
+            "to_utc"                    : todo,
+            "tossnturn_count"           : todo,  # todo derive
+            "tossnturn_datapoints"      : todo,
+        }
         # fmt: on
-        self.id += 1
-        return j
 
-    def fill(self, path: Path, *, count: int) -> None:
-        for _i in range(count):
-            j = self.generate()
-            (path / f'{j["id"]}.json').write_text(json.dumps(j))
+    def generate(self) -> Json:
+        i = self.id
+        [state] = self._walk(1)
+        return self._make_sleep(i, state)
+
+    def fill(self, path: Path, *, count: int, workers: Optional[int] = None) -> None:
+        """
+        If workers is set, nights are generated and written by a process pool
+        """
+        start = self.id
+        states = self._walk(count)
+        if workers is None:
+            _fake_fill(self, path, start, states)
+            return
+        # NOTE: contiguous shards, a few per worker so they finish around the same time
+        shard = max(1, -(-count // (workers * 4)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_fake_fill, self, path, start + k, states[k : k + shard]) for k in range(0, count, shard)]
+            for fut in futures:
+                fut.result()
+
+
+def _fake_fill(fake: FakeData, path: Path, start: int, states: list[tuple[float, float, float, float]]) -> None:
+    for k, state in enumerate(states):
+        j = fake._make_sleep(start + k, state)
+        (path / f'{j["id"]}.json').write_text(json.dumps(j))
 
 
 def test(tmp_path: Path) -> None:
@@ -491,6 +1480,409 @@ def test(tmp_path: Path) -> None:
     assert len(res) == 5
 
 
+def test_stats(tmp_path: Path) -> None:
+    FakeData().fill(tmp_path, count=10)
+    (tmp_path / '000003.json').write_text('{"id": "000003", "broken')
+    seen = []
+    for kwargs in [{}, {'workers': 2, 'pool': 'thread'}, {'workers': 2, 'pool': 'process', 'chunk_size': 3}]:
+        stats = Stats()
+        res = list(DAL(tmp_path, stats=stats, **kwargs).sleeps())  # type: ignore[arg-type]
+        assert len(res) == 10
+        assert (stats.sessions, stats.errors, stats.cache_hits) == (10, 1, 0)
+        assert stats.bytes_read == sum(p.stat().st_size for p in tmp_path.glob('*.json'))
+        assert min(stats.read, stats.decode, stats.construct) > 0
+        assert stats.queue_wait >= 0
+        assert 'sessions' in stats.summary()
+
+    stats = Stats(callback=lambda s: seen.append(s.name))
+    cache_path = tmp_path / 'cache.sqlite'
+    list(DAL(tmp_path, stats=stats, cache_path=cache_path).sleeps())
+    list(DAL(tmp_path, stats=stats, cache_path=cache_path).sleeps())
+    # errors aren't cached, so are processed again
+    assert (stats.sessions, stats.cache_hits) == (11, 9)
+    assert seen == [*sorted(p.name for p in tmp_path.glob('*.json')), '000003.json']
+
+
+def test_fake_data_reproducible(tmp_path: Path) -> None:
+    count = 7
+    serial = tmp_path / 'serial'
+    serial.mkdir()
+    f = FakeData(seed=123)
+    f.fill(serial, count=3)
+    f.fill(serial, count=count - 3)
+
+    parallel = tmp_path / 'parallel'
+    parallel.mkdir()
+    FakeData(seed=123).fill(parallel, count=count, workers=3)
+
+    f = FakeData(seed=123)
+    generated = [json.dumps(f.generate()) for _ in range(count)]
+
+    assert [p.read_text() for p in sorted(serial.iterdir())] == generated
+    assert [p.read_text() for p in sorted(parallel.iterdir())] == generated
+    assert json.dumps(FakeData(seed=124).generate()) != generated[0]
+
+
+def test_fake_data_seed() -> None:
+    # pins down the initial state, so regressions like a changed starting average are caught
+    f = FakeData(seed=0)
+    first = f.generate()
+    assert first['id'] == '000000'
+    assert first['time_start'] < first['time_end']
+    assert 0 < first['sleep_duration'] < first['time_end'] - first['time_start']
+    assert (first['measured_hr_avg'], first['measured_rr_avg']) == (60.0, 13.0)
+    assert (first['hrv_rmssd_morning'], first['hrv_rmssd_evening']) == (45.0, 55.0)
+
+    tss = [row[0] for row in first['measured_datapoints']]
+    assert tss[0] == first['time_start']
+    assert all(b - a == 30 for a, b in zip(tss, tss[1:]))
+    assert tss[-1] < first['time_end']
+    assert {row[1] for row in first['sleep_epoch_datapoints']} == {3, AWAKE}
+
+    # random walk only kicks in from the second night
+    second = f.generate()
+    assert second['time_start'] - first['time_start'] == 24 * 60 * 60
+    assert second['measured_hr_avg'] != 60.0
+    assert second['measured_rr_avg'] != 13.0
+
+
+def test_series() -> None:
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    f = FakeData()
+    for _ in range(3):
+        j = f.generate()
+        # make sure missing values are handled
+        mid = len(j['measured_datapoints']) // 2
+        [ts, _, br, activity] = j['measured_datapoints'][mid]
+        j['measured_datapoints'][mid] = (ts, None, br, activity)
+        em = EmfitParse(j['id'], raw=j)
+        series = em.series
+
+        assert series.sleep_bounds == (int(em.sleep_start.timestamp()), int(em.sleep_end.timestamp()))
+        for arrays, lists in [
+            (series.sleep_hr, em.sleep_hr),
+            (series.hrv, em.hrv),
+            (series.epoch_series, em.epoch_series),
+        ]:
+            for a, l in zip(arrays, lists):
+                assert np.array_equal(a, np.array(l, dtype=a.dtype), equal_nan=True)
+        assert series.sleep_hr_coverage == em.sleep_hr_coverage
+        assert em.sleep_hr_coverage < 100
+
+
+def test_hypnogram() -> None:
+    rng = random.Random(0)
+    for n in [0, 1, 2, 3, 50, 500]:
+        epochs: list[tuple[int, int]] = []
+        ts = 1_600_000_000
+        for _ in range(n):
+            epochs.append((ts, rng.choice([AWAKE, AWAKE, 1, 2, 3])))
+            ts += rng.choice([30, 30, 30, 30, 60, 90])  # some gaps in data
+        h = Hypnogram(epochs)
+        assert len(h) == n
+        assert h.epochs() == [list(e) for e in epochs]
+        assert h.epochs(3, -2) == [list(e) for e in epochs[3:-2]]
+        assert h.series() == ([e[0] for e in epochs], [e[1] for e in epochs])
+        asleep = [e[0] for e in epochs if e[1] != AWAKE]
+        assert h.first_asleep == (asleep[0] if asleep else None)
+        assert h.last_asleep == (asleep[-1] if asleep else None)
+        if n == 0:
+            assert h.stage_at(ts) is None
+            assert h.durations() == {}
+            continue
+
+        # naive: each epoch lasts until the next one, the last one as long as the one before it
+        last = epochs[-1][0] - epochs[-2][0] if n > 1 else 0
+        ends = [e[0] for e in epochs[1:]] + [epochs[-1][0] + last]
+        spans = [(s, e, stage) for (s, stage), e in zip(epochs, ends)]
+
+        for t in range(epochs[0][0] - 40, ts + 100, 7):
+            stages = [stage for s, e, stage in spans if s <= t < e]
+            assert h.stage_at(t) == (stages[0] if stages else None)
+
+        for _ in range(20):
+            t1, t2 = sorted(rng.randint(epochs[0][0] - 100, ts + 100) for _ in range(2))
+            expected: dict[int, float] = dict.fromkeys({e[1] for e in epochs}, 0)
+            for s, e, stage in spans:
+                expected[stage] += max(min(e, t2) - max(s, t1), 0)
+            assert h.durations(t1, t2) == expected
+        assert sum(h.durations().values()) == sum(e - s for s, e, _ in spans)
+
+    # same as it used to be computed with linear scans
+    em = EmfitParse('x', raw=FakeData().generate())
+    eps = em.epochs
+    ff = next(i for i, (_, e) in enumerate(eps) if e != AWAKE)
+    ll = next(i for i in range(len(eps) - 1, -1, -1) if eps[i][1] != AWAKE)
+    assert em.sleep_start == fromts(eps[ff][0])
+    assert em.sleep_end == fromts(eps[ll][0])
+    assert em.strip_awakes == eps[ff:ll]
+    assert em.epoch_series == ([ts for ts, _ in eps], [e for _, e in eps])
+    assert em.hypnogram.durations(em.sleep_start.timestamp(), em.sleep_end.timestamp())[AWAKE] == 0
+
+
+def test_loads_summary(tmp_path: Path) -> None:
+    j = FakeData().generate()
+    j['note'] = 'string with [brackets]] and "quotes"'
+    j['bed_exit_periods'] = [[1, 2], [3, 4]]
+    j['snoring_data'] = [[[1, 2]], [[3]]]
+    j['nodata_periods'] = [{'start': 1, 'end': [2]}]
+    j['tossnturn_datapoints'] = []
+    for s in [json.dumps(j), json.dumps(j, ensure_ascii=False, indent=2, sort_keys=True)]:
+        full = json.loads(s)
+        summary = _loads_summary(s)
+        assert summary == {k: v for k, v in full.items() if k in _SUMMARY_KEYS}
+        assert Emfit.from_json(summary) == Emfit.from_json(full)
+    assert _loads_summary(' { } ') == {}
+
+    FakeData().fill(tmp_path, count=3)
+    assert list(DAL(tmp_path, summary_only=True).sleeps()) == list(DAL(tmp_path).sleeps())
+
+
+def test_window(tmp_path: Path) -> None:
+    FakeData().fill(tmp_path, count=10)
+    expected = list(sleeps(tmp_path))
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        dal = DAL(tmp_path, cpu_pool=pool, window=2)
+        assert list(dal.sleeps()) == expected
+        unordered = list(dal.sleeps(ordered=False))
+    assert sorted(unordered, key=lambda e: e.sid) == expected  # type: ignore[union-attr]
+
+
+def test_workers(tmp_path: Path) -> None:
+    FakeData().fill(tmp_path, count=10)
+    (tmp_path / '000003.json').write_text('{}')  # errors should be passed back too
+    expected = list(sleeps(tmp_path))
+    assert isinstance(expected[3], Exception)
+    for pool in ['thread', 'process']:
+        for chunk_size in [None, 1, 3, 100]:
+            dal = DAL(tmp_path, workers=2, pool=pool, chunk_size=chunk_size)  # type: ignore[arg-type]
+            res = list(dal.sleeps())
+            assert res[:3] + res[4:] == expected[:3] + expected[4:]
+            assert isinstance(res[3], KeyError)
+
+
+def test_sleep_table(tmp_path: Path) -> None:
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    FakeData().fill(tmp_path, count=5)
+    emfits = [e for e in sleeps(tmp_path) if isinstance(e, Emfit)]
+    table = DAL(tmp_path).sleep_table()
+    assert len(table) == 5
+    assert table.errors == []
+    assert list(table) == emfits
+    assert table[-1] == emfits[-1]
+    assert table.sid.tolist() == [e.sid for e in emfits]
+    assert np.allclose(table.hrv_morning, [e.hrv_morning for e in emfits])
+    for prop in ['date', 'time_in_bed', 'recovery', 'respiratory_rate_avg']:
+        assert getattr(table, prop).tolist() == [getattr(e, prop) for e in emfits]
+
+
+def test_trends(tmp_path: Path) -> None:
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    FakeData().fill(tmp_path, count=40)
+    table = DAL(tmp_path).sleep_table()
+    emfits = list(table)
+
+    def naive_rolling(metric: str, window: int) -> list[float]:
+        res = []
+        for e in emfits:
+            vals = [getattr(o, metric) for o in emfits if 0 <= (e.date - o.date).days < window]
+            vals = [v for v in vals if not np.isnan(v)]
+            res.append(sum(vals) / len(vals) if vals else float('nan'))
+        return res
+
+    trends = table.trends(window=7)
+    assert trends.dates.tolist() == [e.date for e in emfits]
+    for m in TREND_METRICS:
+        assert np.allclose(trends.rolling(m), naive_rolling(m, 7), equal_nan=True)
+
+    weeks: dict[datetime_date, list[float]] = {}
+    for e in emfits:
+        weeks.setdefault(e.date - timedelta(days=e.date.weekday()), []).append(e.recovery)
+    starts, means, counts = trends.calendar('recovery', 'week')
+    assert starts.tolist() == list(weeks)
+    assert np.allclose(means, [sum(v) / len(v) for v in weeks.values()])
+    assert counts.tolist() == [len(v) for v in weeks.values()]
+    starts, _, counts = trends.calendar('time_in_bed', 'month')
+    assert all(d.day == 1 for d in starts.tolist())
+    assert counts.sum() == len(emfits)
+
+    # appending one night at a time (including out of order) should agree with computing at once
+    incremental = Trends(window=7)
+    incremental.extend(SleepTable.from_emfits(emfits[10:30]))
+    for e in emfits[30:]:
+        incremental.append(e)
+    incremental.extend(SleepTable.from_emfits(emfits[:10]))
+    assert len(incremental) == len(emfits)
+    for m in TREND_METRICS:
+        assert np.allclose(incremental.rolling(m), trends.rolling(m), equal_nan=True)
+        for period in ('week', 'month', 'year'):
+            for a, b in zip(incremental.calendar(m, period), trends.calendar(m, period)):
+                assert np.allclose(a.astype(np.float64), b.astype(np.float64), equal_nan=True)
+
+
+def test_handles(tmp_path: Path) -> None:
+    FakeData().fill(tmp_path, count=6)
+    dal = DAL(tmp_path, raw_cache_size=2, summary_only=True)
+    handles = [h for h in dal.handles() if isinstance(h, Session)]
+    assert [h.emfit for h in handles] == list(DAL(tmp_path).sleeps())
+    assert handles[0].recovery == handles[0].emfit.recovery
+    cache = dal.raw_cache
+    assert (len(cache), cache.misses) == (0, 0)  # nothing is loaded upfront
+
+    expected = [EmfitParse.from_path(h.path) for h in handles]
+    for h, em in zip(handles, expected):
+        assert list(h.iter_points()) == list(em.iter_points())
+        assert h.hrv == em.hrv
+        assert h.epochs == em.epochs
+        assert h.hypnogram.first_asleep == em.hypnogram.first_asleep
+    assert len(cache) == 2
+    # each night was loaded once, and then hit for hrv/epochs/hypnogram
+    assert (cache.hits, cache.misses, cache.evictions) == (18, 6, 4)
+
+    assert handles[-1].raw['id'] == handles[-1].sid
+    assert cache.hits == 19
+    assert handles[0].raw['id'] == handles[0].sid
+    assert (cache.misses, cache.evictions) == (7, 5)
+
+    # changed on disk, so should be reloaded
+    h = handles[-1]
+    parse = h.parse
+    st = h.path.stat()
+    os.utime(h.path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert h.parse is not parse
+    assert 'raw cache: 2/2 entries' in cache.summary()
+
+
+def test_since_until(tmp_path: Path) -> None:
+    FakeData().fill(tmp_path, count=10)
+    emfits = [e for e in sleeps(tmp_path) if isinstance(e, Emfit)]
+    dal = DAL(tmp_path)
+
+    since = emfits[3].end - timedelta(hours=1)
+    until = emfits[5].start + timedelta(hours=1)
+    assert list(dal.sleeps(since=since, until=until)) == emfits[3:6]
+    assert list(dal.sleeps(since=since)) == emfits[3:]
+    assert list(dal.sleeps(until=until)) == emfits[:6]
+
+    # index picks up new and removed files
+    (tmp_path / '000004.json').unlink()
+    assert list(dal.sleeps(since=since, until=until)) == [emfits[3], emfits[5]]
+
+    # index is only rewritten when it's out of date
+    index_path = tmp_path / 'emfit-index.tsv'
+    mtime = index_path.stat().st_mtime_ns
+    assert list(dal.sleeps(since=since, until=until)) == [emfits[3], emfits[5]]
+    assert index_path.stat().st_mtime_ns == mtime
+
+    # can't be indexed, but should still be reported as an error
+    (tmp_path / '000004.json').write_text('{"id": "000004", "time_sta')
+    res = list(dal.sleeps(since=since, until=until))
+    assert res[0] == emfits[3]
+    assert isinstance(res[1], Exception)
+    assert res[2] == emfits[5]
+    assert index_path.stat().st_mtime_ns == mtime
+
+
+def test_since_until_listing(tmp_path: Path, monkeypatch) -> None:
+    FakeData().fill(tmp_path, count=6)
+    emfits = [e for e in sleeps(tmp_path) if isinstance(e, Emfit)]
+    listed = 0
+    original = session_paths
+
+    def counting_session_paths(export_path: Path) -> list[Path]:
+        nonlocal listed
+        listed += 1
+        return original(export_path)
+
+    monkeypatch.setitem(globals(), 'session_paths', counting_session_paths)
+
+    def age_dir() -> None:
+        # pretend the dir was last changed long ago, otherwise its mtime is too fresh to trust
+        past = time.time_ns() - 10 * _RACY_MTIME_NS
+        os.utime(tmp_path, ns=(past, past))
+
+    dal = DAL(tmp_path)
+    since = emfits[3].start
+    assert list(dal.sleeps(since=since)) == emfits[3:]
+    age_dir()
+    assert list(dal.sleeps(since=since)) == emfits[3:]
+    assert listed == 2  # second call lists again, since the first one wrote the index
+    assert list(dal.sleeps(since=since)) == emfits[3:]
+    assert list(dal.sleeps(until=emfits[1].end)) == emfits[:2]
+    assert listed == 2
+
+    # removing a file changes the dir mtime, so it's listed again
+    (tmp_path / '000004.json').unlink()
+    assert list(dal.sleeps(since=since)) == [emfits[3], emfits[5]]
+    assert listed == 3
+
+
+def test_use_manifest_missing(tmp_path: Path) -> None:
+    FakeData().fill(tmp_path, count=3)
+    expected = list(DAL(tmp_path).sleeps())
+    assert len(expected) == 3
+    assert list(DAL(tmp_path, use_manifest=True).sleeps()) == expected
+
+
+def test_since_until_keeps_cache(tmp_path: Path) -> None:
+    FakeData().fill(tmp_path, count=6)
+    dal = DAL(tmp_path, cache_path=tmp_path / 'cache.sqlite')
+    emfits = [e for e in dal.sleeps() if isinstance(e, Emfit)]
+    assert dal.cache is not None
+    assert dal.cache.misses == 6
+
+    assert list(dal.sleeps(since=emfits[4].start)) == emfits[4:]
+    # windowed query shouldn't evict entries outside of the window
+    assert list(dal.sleeps()) == emfits
+    assert (dal.cache.misses, dal.cache.evictions) == (6, 0)
+
+
+def test_summary_cache(tmp_path: Path) -> None:
+    export_path = tmp_path / 'export'
+    export_path.mkdir()
+    FakeData().fill(export_path, count=5)
+    expected = list(sleeps(export_path))
+
+    dal = DAL(export_path, cache_path=tmp_path / 'cache.sqlite')
+    assert dal.cache is not None
+    assert list(dal.sleeps()) == expected
+    assert (dal.cache.hits, dal.cache.misses) == (0, 5)
+
+    # second pass shouldn't process anything
+    assert list(dal.sleeps()) == expected
+    assert (dal.cache.hits, dal.cache.misses) == (5, 5)
+
+    # archived turds are evicted, changed files are reprocessed
+    (export_path / '000000.json').rename(export_path / '000000.json.old')
+    changed = export_path / '000001.json'
+    changed.write_text(changed.read_text() + ' ')
+    assert list(dal.sleeps()) == expected[1:]
+    assert (dal.cache.hits, dal.cache.misses, dal.cache.evictions) == (8, 6, 1)
+
+
+def test_summary_cache_partial(tmp_path: Path) -> None:
+    export_path = tmp_path / 'export'
+    export_path.mkdir()
+    FakeData().fill(export_path, count=5)
+    expected = list(sleeps(export_path))
+
+    dal = DAL(export_path, cache_path=tmp_path / 'cache.sqlite')
+    seen = []
+    for e in dal.sleeps():
+        seen.append(e)
+        if len(seen) == 3:
+            break  # consumer stopped early, generator is closed without running to the end
+    assert seen == expected[:3]
+
+    fresh = DAL(export_path, cache_path=tmp_path / 'cache.sqlite')
+    assert fresh.cache is not None
+    assert list(fresh.sleeps()) == expected
+    assert (fresh.cache.hits, fresh.cache.misses) == (3, 2)
+
+
 # todo use proper dal_helper.main?
 def main() -> None:
     for x in sleeps(Path('/tmp/emfit')):
@@ -5,15 +5,33 @@ Captures dvmstatus Emfit page
 NOTE: see  https://gist.github.com/karlicoss/3361f6a239048a451daa2a02982ee180#dvmstatushtm
 for actual parsing
 """
+import math
+import signal
 import sqlite3
 import sys
 import time
 import urllib.request
+from collections.abc import Sequence
+from contextlib import closing
+from dataclasses import dataclass
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import Any, Literal, Optional
 
 import click
 
+from .local import FETCH, HTML_POST, HTML_PRE, OK, parse_sample
+
+# raw: full page as captured (original format)
+RAW_SCHEMA = 'CREATE TABLE IF NOT EXISTS data (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT, payload TEXT)'
+RAW_INSERT = 'INSERT INTO data(timestamp, payload) VALUES (?, ?)'
+# compact: parsed at capture time, see local.parse_sample. raw page is only kept if it failed to parse
+# NOTE: explicit id rather than implicit rowid, which might be renumbered by VACUUM
+COMPACT_SCHEMA = 'CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY, ts INTEGER NOT NULL, hr REAL, rr REAL, error INTEGER NOT NULL, raw TEXT)'
+COMPACT_INSERT = 'INSERT INTO samples(ts, hr, rr, error, raw) VALUES (?, ?, ?, ?, ?)'
+# for time range queries, e.g. joining with sessions (see local.load_samples)
+COMPACT_INDEX = 'CREATE INDEX IF NOT EXISTS samples_ts ON samples(ts)'
+
 
 def grab(ip: str) -> str:
     url = ip + '/dvmstatus.htm'
@@ -23,23 +41,285 @@ def grab(ip: str) -> str:
         return str(e)
 
 
-def capture(*, ip: str, to: Path) -> None:
-    with sqlite3.connect(str(to)) as db:
-        # todo not sure if need id?
-        db.execute('CREATE TABLE IF NOT EXISTS data (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT, payload TEXT)')
+Level = Literal['minute', 'hour']
+LEVELS: dict[Level, int] = {'minute': 60, 'hour': 60 * 60}
+
+_ROLLUP_COLUMNS = ['hr_count', 'hr_sum', 'hr_min', 'hr_max', 'rr_count', 'rr_sum', 'rr_min', 'rr_max']
+
+
+@dataclass(frozen=True)
+class Rollup:
+    start: int  # epoch seconds
+    hr_count: int
+    hr_mean: Optional[float]
+    hr_min: Optional[float]
+    hr_max: Optional[float]
+    rr_count: int
+    rr_mean: Optional[float]
+    rr_min: Optional[float]
+    rr_max: Optional[float]
+
+
+# (ts, hr, rr), all rollups need from a sample
+_Values = tuple[int, Optional[float], Optional[float]]
+
+
+def _raw_values(timestamp: str, payload: str) -> _Values:
+    ts, hr, rr, _, _ = parse_sample(int(datetime.fromisoformat(timestamp).timestamp()), payload)
+    return ts, hr, rr
+
+
+class Rollups:
+    """
+    Per minute/hour aggregates of valid hr/rr samples, so long range queries don't have to scan raw samples.
+
+    Rollups cover all samples with id up to a watermark (kept in the db). update() reads and rolls up everything past it (backfilling existing databases),
+    add() rolls up samples the live capture has just inserted, without reading them back.
+    NOTE: both should be called within the transaction which inserts/reads the samples, so concurrent updates don't double count.
+    NOTE: if it's lagging, the live capture only rolls up a bounded number of samples per batch, so after a backlog (e.g. database existed before rollups)
+    rollups lag behind the samples until catch_up() runs (capture() does that on startup, see also backfill()).
+    """
+
+    def __init__(self, db: sqlite3.Connection, *, compact: bool) -> None:
+        self.db = db
+        self.compact = compact
+        for level in LEVELS:
+            db.execute(f'CREATE TABLE IF NOT EXISTS rollup_{level} (start INTEGER PRIMARY KEY, {", ".join(_ROLLUP_COLUMNS)})')
+        db.execute('CREATE TABLE IF NOT EXISTS rollup_state (key TEXT PRIMARY KEY, value INTEGER)')
+
+    @property
+    def watermark(self) -> int:
+        row = self.db.execute("SELECT value FROM rollup_state WHERE key = 'id'").fetchone()
+        return 0 if row is None else row[0]
+
+    def _samples(self, *, limit: Optional[int]) -> tuple[list[_Values], Optional[int]]:
+        """
+        Returns (ts, hr, rr) of samples past the watermark, and the last id
+        """
+        table, columns = ('samples', 'ts, hr, rr') if self.compact else ('data', 'timestamp, payload')
+        rows = self.db.execute(
+            f'SELECT id, {columns} FROM {table} WHERE id > ? ORDER BY id LIMIT ?',
+            (self.watermark, -1 if limit is None else limit),
+        ).fetchall()
+        if len(rows) == 0:
+            return [], None
+        if self.compact:
+            samples = [(ts, hr, rr) for _, ts, hr, rr in rows]
+        else:
+            samples = [_raw_values(ts, payload) for _, ts, payload in rows]
+        return samples, rows[-1][0]
+
+    def update(self, *, limit: Optional[int] = None) -> int:
+        """
+        Rolls up (at most limit) samples past the watermark. Returns number of samples rolled up.
+        """
+        samples, last = self._samples(limit=limit)
+        if last is None:
+            return 0
+        self._roll_up(samples, last=last)
+        return len(samples)
+
+    def add(self, samples: list[_Values], *, last: int) -> int:
+        """
+        Rolls up samples which were just inserted, with ids up to last, without reading them back. Returns number of samples rolled up.
+        If rollups are lagging behind (so samples don't follow the watermark), falls back to a bounded update() instead.
+        """
+        if self.watermark != last - len(samples):
+            # NOTE: limit is so a backlog doesn't stall the capture, catching up is done by catch_up()
+            return self.update(limit=len(samples) * 2)
+        self._roll_up(samples, last=last)
+        return len(samples)
+
+    def _roll_up(self, samples: list[_Values], *, last: int) -> None:
+        for level, seconds in LEVELS.items():
+            # start -> [hr count, sum, min, max, rr count, sum, min, max]
+            acc: dict[int, list[Any]] = {}
+            for ts, hr, rr in samples:
+                a = acc.get(ts - ts % seconds)
+                if a is None:
+                    a = acc[ts - ts % seconds] = [0, 0.0, None, None, 0, 0.0, None, None]
+                for off, v in ((0, hr), (4, rr)):
+                    if v is None or math.isnan(v):
+                        continue
+                    a[off] += 1
+                    a[off + 1] += v
+                    a[off + 2] = v if a[off + 2] is None else min(a[off + 2], v)
+                    a[off + 3] = v if a[off + 3] is None else max(a[off + 3], v)
+            merge = ', '.join(
+                f'{c} = {c} + excluded.{c}' if c.endswith(('_count', '_sum'))
+                # NOTE: scalar min/max are null if any argument is null
+                else f'{c} = {c[-3:]}(COALESCE({c}, excluded.{c}), COALESCE(excluded.{c}, {c}))'
+                for c in _ROLLUP_COLUMNS
+            )  # fmt: skip
+            self.db.executemany(
+                f'INSERT INTO rollup_{level} (start, {", ".join(_ROLLUP_COLUMNS)}) VALUES ({", ".join("?" * 9)}) ON CONFLICT(start) DO UPDATE SET {merge}',
+                [(start, *a) for start, a in acc.items()],
+            )
+        self.db.execute("INSERT OR REPLACE INTO rollup_state (key, value) VALUES ('id', ?)", (last,))
+
+    def catch_up(self, *, batch_size: int = 100_000) -> int:
+        """
+        Rolls up everything past the watermark, one transaction per batch, so it doesn't block concurrent writers for long.
+        Returns number of rolled up samples.
+        """
         total = 0
-        # todo shold I use asyncio maybe?
+        self.db.commit()
         while True:
-            data = grab(ip=ip)
-            now = datetime.now(tz=timezone.utc).isoformat()
-            if total % 60 == 0:
-                # log & commit every minute
-                db.commit()
-                total = next(db.execute('select COUNT(*) from data'))[0]
-                print('capturing: ', total, now, repr(data), file=sys.stderr)
-            db.execute('INSERT INTO data(timestamp, payload) VALUES (?, ?)', (now, data))
-            total += 1
-            time.sleep(1)
+            # NOTE: immediate, so reading samples past the watermark and updating it is atomic even if capture is running
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                count = self.update(limit=batch_size)
+            except BaseException:
+                self.db.rollback()
+                raise
+            self.db.commit()
+            if count == 0:
+                return total
+            total += count
+            print(f'rollups: rolled up {total} samples', file=sys.stderr)
+
+    def query(self, level: Level, *, since: Optional[int] = None, until: Optional[int] = None) -> list[Rollup]:
+        """
+        Rollups for intervals starting within [since, until] (epoch seconds)
+        """
+        rows = self.db.execute(
+            f'SELECT start, {", ".join(_ROLLUP_COLUMNS)} FROM rollup_{level} WHERE start >= ? AND start <= ? ORDER BY start',
+            (-(2**62) if since is None else since, 2**62 if until is None else until),
+        )
+        mean = lambda count, total: None if count == 0 else total / count
+        return [
+            Rollup(start, hc, mean(hc, hs), hmin, hmax, rc, mean(rc, rs), rmin, rmax)
+            for start, hc, hs, hmin, hmax, rc, rs, rmin, rmax in rows
+        ]
+
+
+def backfill(path: Path, *, batch_size: int = 100_000) -> int:
+    """
+    Rolls up samples in an existing capture database (see Rollups). Safe to run while capture is running, and to resume.
+    Returns number of rolled up samples.
+    """
+    db = sqlite3.connect(str(path))
+    try:
+        compact = db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'samples'").fetchone() is not None
+        return Rollups(db, compact=compact).catch_up(batch_size=batch_size)
+    finally:
+        db.close()
+
+
+class CaptureWriter:
+    """
+    Buffers samples in memory and writes them in batches, one transaction per batch.
+    """
+
+    def __init__(self, db: sqlite3.Connection, *, batch_size: int = 60, compact: bool = False) -> None:
+        self.db = db
+        self.batch_size = batch_size
+        self.compact = compact
+        self.insert = COMPACT_INSERT if compact else RAW_INSERT
+        self.table = 'samples' if compact else 'data'
+        self.buffer: list[Sequence[Any]] = []
+
+        # NOTE: WAL means commits are appends to the log (fsynced only on checkpoints with synchronous=NORMAL)
+        # at worst we'd lose the last few batches on power loss, which is fine for this
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        # todo not sure if need id?
+        db.execute(COMPACT_SCHEMA if compact else RAW_SCHEMA)
+        if compact:
+            db.execute(COMPACT_INDEX)
+        self.rollups = Rollups(db, compact=compact)
+        db.commit()
+        # NOTE: running counter -- COUNT(*) is a full scan, and it's months worth of data
+        # rows are never deleted, so max id is the same (and it's a cheap index lookup)
+        self.total: int = next(db.execute(f'SELECT COALESCE(MAX(id), 0) FROM {self.table}'))[0]
+
+    def add(self, row: Sequence[Any]) -> bool:
+        """
+        row is either (timestamp, payload) or local.Sample, depending on compact
+        Returns True if the batch got flushed
+        """
+        self.buffer.append(row)
+        if len(self.buffer) < self.batch_size:
+            return False
+        self.flush()
+        return True
+
+    def flush(self) -> None:
+        if len(self.buffer) == 0:
+            return
+        # NOTE: parsed here once, rather than rollups reading back the rows which were just inserted
+        samples = [(row[0], row[1], row[2]) for row in self.buffer] if self.compact else [_raw_values(*row) for row in self.buffer]
+        with self.db:  # commits the transaction
+            self.db.executemany(self.insert, self.buffer)
+            # NOTE: ids of the batch are contiguous, since the transaction holds the write lock
+            last = next(self.db.execute(f'SELECT MAX(id) FROM {self.table}'))[0]
+            self.rollups.add(samples, last=last)
+        self.total = last
+        self.buffer = []
+
+
+def capture(*, ip: str, to: Path, batch_size: int = 60, compact: bool = False) -> None:
+    stop = False
+
+    def on_signal(signum: int, _frame) -> None:
+        nonlocal stop
+        print(f'capturing: got signal {signum}, stopping', file=sys.stderr)
+        stop = True
+
+    # NOTE: not raising from the handler, so it can't interrupt a flush halfway, the loop just exits after the current iteration
+    # previous handlers are restored after, in case capture() is called from some bigger program
+    previous = {sig: signal.signal(sig, on_signal) for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]}
+
+    try:
+        with closing(sqlite3.connect(str(to))) as db:
+            writer = CaptureWriter(db, batch_size=batch_size, compact=compact)
+            # NOTE: otherwise after a backlog, rollups would only catch up by a batch at a time
+            writer.rollups.catch_up()
+            try:
+                # todo shold I use asyncio maybe?
+                while not stop:
+                    data = grab(ip=ip)
+                    now = datetime.now(tz=timezone.utc)
+                    row = parse_sample(int(now.timestamp()), data) if compact else (now.isoformat(), data)
+                    if writer.add(row):
+                        print('capturing: ', writer.total, now.isoformat(), repr(row if compact else data), file=sys.stderr)
+                    time.sleep(1)
+            finally:
+                writer.flush()
+                print('capturing: flushed, total', writer.total, file=sys.stderr)
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+
+
+def migrate(src: Path, dst: Path, *, batch_size: int = 10_000) -> int:
+    """
+    Converts raw capture database to the compact format, without loading it in memory.
+    Can be interrupted and resumed: progress is kept in dst along with the data.
+    Returns number of converted rows.
+    """
+    converted = 0
+    with sqlite3.connect(f'file:{src}?mode=ro', uri=True) as sdb, sqlite3.connect(str(dst)) as ddb:
+        writer = CaptureWriter(ddb, compact=True)  # sets up the schema
+        ddb.execute('CREATE TABLE IF NOT EXISTS migration (key TEXT PRIMARY KEY, value INTEGER)')
+        done = ddb.execute("SELECT value FROM migration WHERE key = 'last_id'").fetchone()
+        last_id = 0 if done is None else done[0]
+
+        cur = sdb.execute('SELECT id, timestamp, payload FROM data WHERE id > ? ORDER BY id', (last_id,))
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            samples = [parse_sample(int(datetime.fromisoformat(ts).timestamp()), payload) for _, ts, payload in rows]
+            with ddb:  # samples and progress are committed atomically
+                ddb.executemany(COMPACT_INSERT, samples)
+                writer.rollups.update()
+                ddb.execute("INSERT OR REPLACE INTO migration(key, value) VALUES ('last_id', ?)", (rows[-1][0],))
+            converted += len(rows)
+            print(f'migrating: converted {converted} rows', file=sys.stderr)
+    sdb.close()
+    ddb.close()
+    return converted
 
 
 ### copy pasted from promnesia
@@ -88,21 +368,174 @@ def _install_systemd(*, name: str, out: Path, launcher: str, largs: list[str]) -
 
 
 @click.command()
-@click.option('--ip', type=str, required=True)
+@click.option('--ip', type=str, default=None, help='Device address, required for capture')
 @click.option('--to', type=Path, required=True)
+@click.option('--batch-size', type=int, default=60, help='Number of samples (one per second) written in a single transaction')
+@click.option('--compact', type=bool, is_flag=True, default=False, help='Parse pages during capture, only keep hr/rr (see local.parse_sample)')
+@click.option('--migrate-from', type=Path, default=None, help='Convert existing raw capture database into compact one at --to, instead of capturing')
+@click.option('--backfill', 'do_backfill', type=bool, is_flag=True, default=False, help='Compute rollups for existing samples in --to, instead of capturing')
 @click.option('--install-systemd', type=bool, is_flag=True, default=False)
-def main(*, ip: str, to: Path, install_systemd: bool) -> None:
+def main(*, ip: Optional[str], to: Path, batch_size: int, compact: bool, migrate_from: Optional[Path], do_backfill: bool, install_systemd: bool) -> None:
+    if migrate_from is not None:
+        migrate(migrate_from, to)
+        return
+    if do_backfill:
+        backfill(to)
+        return
+    if ip is None:
+        raise click.UsageError('--ip is required for capture')
     if install_systemd:
         name = 'emfit_capture'
         out = Path(f'~/.config/systemd/user/{name}.service').expanduser()
         _install_systemd(
             name=name,
             out=out,
-            launcher=str(Path(__file__).absolute()),
-            largs=['--ip', ip, '--to', str(to)],
+            launcher=f'{sys.executable} -m emfitexport.dvmstatus',
+            largs=['--ip', ip, '--to', str(to), '--batch-size', str(batch_size), *(['--compact'] if compact else [])],
         )
         return
-    capture(ip=ip, to=to)
+    capture(ip=ip, to=to, batch_size=batch_size, compact=compact)
+
+
+def test_capture_writer(tmp_path: Path) -> None:
+    path = tmp_path / 'capture.sqlite'
+    with sqlite3.connect(str(path)) as db:
+        writer = CaptureWriter(db, batch_size=3)
+        rows = [(datetime.fromtimestamp(1_600_000_000 + i, tz=timezone.utc).isoformat(), f'payload{i}') for i in range(7)]
+        assert [writer.add(row) for row in rows] == [False, False, True] * 2 + [False]
+        assert writer.total == 6
+        writer.flush()
+        assert writer.total == 7
+        assert next(db.execute('PRAGMA journal_mode'))[0] == 'wal'
+    db.close()
+
+    with sqlite3.connect(str(path)) as db:
+        writer = CaptureWriter(db)
+        assert writer.total == 7
+        assert list(db.execute('SELECT timestamp, payload FROM data ORDER BY id'))[-1] == rows[-1]
+    db.close()
+
+
+def test_capture_signals(tmp_path: Path, monkeypatch) -> None:
+    def fake_grab(ip: str) -> str:  # noqa: ARG001
+        signal.raise_signal(signal.SIGTERM)
+        return 'timed out'
+
+    monkeypatch.setattr(sys.modules[__name__], 'grab', fake_grab)
+    monkeypatch.setattr(time, 'sleep', lambda _: None)
+    before = signal.getsignal(signal.SIGTERM)
+    capture(ip='http://localhost', to=tmp_path / 'capture.sqlite')
+    assert signal.getsignal(signal.SIGTERM) is before
+    with sqlite3.connect(str(tmp_path / 'capture.sqlite')) as db:
+        assert list(db.execute('SELECT payload FROM data')) == [('timed out',)]
+    db.close()
+
+
+def test_migrate(tmp_path: Path) -> None:
+    page = HTML_PRE + '<big>HR:<big><big> 56</big></big></big>/min  .<p><big>RR:<big><big> 13.5</big></big></big>/min  .<p>.<p><small><small>00 21 77<br>t120 v2.2.1' + HTML_POST
+    src = tmp_path / 'raw.sqlite'
+    with sqlite3.connect(str(src)) as db:
+        writer = CaptureWriter(db, batch_size=1000)
+        for i in range(25):
+            writer.add((datetime.fromtimestamp(1_600_000_000 + i, tz=timezone.utc).isoformat(), page if i % 10 else 'timed out'))
+        writer.flush()
+    db.close()
+
+    dst = tmp_path / 'compact.sqlite'
+    assert migrate(src, dst, batch_size=7) == 25
+    # nothing new, so resuming shouldn't convert anything
+    assert migrate(src, dst, batch_size=7) == 0
+    with sqlite3.connect(str(dst)) as db:
+        rows = list(db.execute('SELECT ts, hr, rr, error, raw FROM samples ORDER BY id'))
+    db.close()
+    assert len(rows) == 25
+    assert rows[0] == (1_600_000_000, None, None, FETCH, 'timed out')
+    assert rows[1] == (1_600_000_001, 56.0, 13.5, OK, None)
+    assert dst.stat().st_size < src.stat().st_size
+
+
+def test_rollups(tmp_path: Path) -> None:
+    mid = '<big>HR:<big><big>{}</big></big></big>/min  .<p><big>RR:<big><big>{}</big></big></big>/min  .<p>.<p><small><small>00 21 77<br>t120 v2.2.1'
+    t0 = 1_600_000_000 - 1_600_000_000 % 3600
+    pages = []
+    for i in range(3 * 3600 + 100):
+        if i % 17 == 0:
+            page = HTML_PRE + mid.format(' ---', ' --.-') + HTML_POST
+        elif i % 29 == 0:
+            page = 'timed out'
+        else:
+            page = HTML_PRE + mid.format(f' {40 + i % 50}', f' {10 + i % 7}.5') + HTML_POST
+        pages.append((datetime.fromtimestamp(t0 + i, tz=timezone.utc).isoformat(), page))
+
+    def expected(level: Level) -> list[Rollup]:
+        seconds = LEVELS[level]
+        res = []
+        for start in range(t0, t0 + len(pages), seconds):
+            vals = [parse_sample(0, p)[1:3] for _, p in pages[start - t0 : start - t0 + seconds]]
+            hrs = [hr for hr, _ in vals if hr is not None]
+            rrs = [rr for _, rr in vals if rr is not None]
+            res.append(Rollup(start, len(hrs), sum(hrs) / len(hrs), min(hrs), max(hrs), len(rrs), sum(rrs) / len(rrs), min(rrs), max(rrs)))
+        return res
+
+    def check(db: sqlite3.Connection, *, compact: bool) -> None:
+        rollups = Rollups(db, compact=compact)
+        for level in LEVELS:
+            res = rollups.query(level)
+            exp = expected(level)
+            assert [r.start for r in res] == [r.start for r in exp]
+            for r, e in zip(res, exp):
+                assert (r.hr_count, r.hr_min, r.hr_max, r.rr_count, r.rr_min, r.rr_max) == (e.hr_count, e.hr_min, e.hr_max, e.rr_count, e.rr_min, e.rr_max)
+                assert math.isclose(r.hr_mean, e.hr_mean) and math.isclose(r.rr_mean, e.rr_mean)  # type: ignore[arg-type]  # noqa: PT018
+        assert len(rollups.query('hour', since=t0 + 3600, until=t0 + 2 * 3600)) == 2
+
+    # maintained during capture
+    raw = tmp_path / 'raw.sqlite'
+    with sqlite3.connect(str(raw)) as db:
+        writer = CaptureWriter(db, batch_size=60)
+        statements: list[str] = []
+        db.set_trace_callback(statements.append)
+        for row in pages:
+            writer.add(row)
+        writer.flush()
+        db.set_trace_callback(None)
+        # samples which were just inserted shouldn't be read back
+        assert any(st.startswith('INSERT INTO data') for st in statements)
+        assert not any(st.startswith('SELECT id, timestamp') for st in statements)
+        check(db, compact=False)
+    db.close()
+
+    # built during migration
+    compact = tmp_path / 'compact.sqlite'
+    migrate(raw, compact, batch_size=1000)
+    with sqlite3.connect(str(compact)) as db:
+        check(db, compact=True)
+    db.close()
+
+    # database captured before rollups existed
+    old = tmp_path / 'old.sqlite'
+    with sqlite3.connect(str(old)) as db:
+        db.execute(RAW_SCHEMA)
+        db.executemany(RAW_INSERT, pages)
+    db.close()
+    assert backfill(old, batch_size=5000) == len(pages)
+    assert backfill(old) == 0
+    with sqlite3.connect(str(old)) as db:
+        check(db, compact=False)
+    db.close()
+
+    # capture only rolls up a bit per batch, so with a backlog it needs to catch up
+    lagging = tmp_path / 'lagging.sqlite'
+    with sqlite3.connect(str(lagging)) as db:
+        db.execute(RAW_SCHEMA)
+        db.executemany(RAW_INSERT, pages[:-60])
+        db.commit()
+        writer = CaptureWriter(db, batch_size=60)
+        for row in pages[-60:]:
+            writer.add(row)
+        assert writer.rollups.watermark == 120
+        assert writer.rollups.catch_up(batch_size=5000) == len(pages) - 120
+        check(db, compact=False)
+    db.close()
 
 
 if __name__ == '__main__':
@@ -1,10 +1,18 @@
 from __future__ import annotations
 
+import hashlib
 import json
-import logging
+import re
 import sys
-from collections.abc import Iterator
+import threading
+from collections import Counter
+from collections.abc import Collection, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from typing import Any, Optional, Union
 
 import requests
 from tenacity import (
@@ -14,8 +22,24 @@ from tenacity import (
     wait_exponential,
 )
 
+from .dal import DAL, FakeData
+from .exporthelpers.dal_helper import Res
 from .exporthelpers.export_helper import Json, Parser, setup_parser
 from .exporthelpers.logging_helper import make_logger
+from .index import INDEX_NAME, TimeIndex
+from .manifest import MANIFEST_NAME, Manifest
+from .storage import (
+    SUFFIXES,
+    Compression,
+    HashingWriter,
+    compressing_writer,
+    encode,
+    read_bytes,
+    session_paths,
+    session_sid,
+    write_atomic,
+)
+from .utils import DummyFuture, bounded_results
 
 logger = make_logger(__name__)
 
@@ -36,15 +60,92 @@ retryme = retry(
 )
 
 
+class _Sniffer:
+    """
+    Picks a few top level values out of a json stream as it's downloaded, without parsing the whole thing.
+    NOTE: lists are not parsed, for them the value is just [] (so it's possible to tell them from null)
+    """
+
+    # NOTE: a key must be preceded by { or , -- quotes within strings are always escaped, so this can't match inside a string value
+    # nested objects might in principle have same keys, but emfit sessions don't have any before the top level ones
+    _RE = re.compile(rb'[{,]\s*"(id|time_start|time_end|sleep_epoch_datapoints)"\s*:\s*("(?:[^"\\]|\\.)*"|null|\[|[-+0-9.eE]+)')
+    # should cover the longest key/value pair we care about, in case it's split across chunks
+    _TAIL = 256
+
+    def __init__(self) -> None:
+        self.values: dict[str, Any] = {}
+        self._tail = b''
+
+    def feed(self, chunk: bytes, *, final: bool = False) -> None:
+        buf = self._tail + chunk
+        for m in self._RE.finditer(buf):
+            if m.end() == len(buf) and not final:
+                # value (e.g. a number) might continue in the next chunk, it will be matched again as part of the tail
+                continue
+            key = m.group(1).decode('ascii')
+            if key in self.values:
+                continue
+            raw = m.group(2)
+            self.values[key] = [] if raw == b'[' else json.loads(raw)
+        self._tail = buf[-self._TAIL :]
+
+
+@dataclass(frozen=True)
+class _Fetched:
+    """
+    Session streamed to a temporary file, which is yet to be renamed into place
+    """
+
+    tmp: Path
+    size: int
+    sha256: str
+    # enough for the index, so we don't need to read the file back
+    summary: Json
+
+
+# NOTE: present while an export is running, so the next export can tell if the previous one was interrupted
+# shouldn't end with .json, otherwise DAL would treat it as a session
+RUNNING_NAME = 'emfit-export.running'
+
+# sessions are mostly a few hundred kb, so this keeps memory per fetch flat without too many syscalls
+_CHUNK_SIZE = 64 * 1024
+
+
 class Exporter:
-    def __init__(self, token: str, export_dir: Path) -> None:
+    def __init__(
+        self,
+        token: str,
+        export_dir: Path,
+        *,
+        concurrency: int = 1,
+        base_url: str = QS_API,
+        compression: Compression = 'none',
+        stream: bool = False,
+        reconcile: bool = False,
+    ) -> None:
         self.token = token
         self.export_dir = export_dir
-
-    def api(self, path: str, base=QS_API, **kwargs):
-        r = requests.get(
-            base + path,
-            headers={'Authorization': f'Bearer {self.token}'},
+        # if True, the manifest is synced with the export dir before the export (see Manifest.reconcile)
+        # otherwise it only happens if the previous export was interrupted
+        self.reconcile = reconcile
+        # how new sessions are stored, see storage.py
+        self.compression = compression
+        # if True, responses are written to disk as they are received, without decoding and pretty printing
+        self.stream = stream
+        # max number of sleep sessions fetched in parallel
+        self.concurrency = concurrency
+        self.base_url = base_url
+
+        # NOTE: shared session keeps connections alive, so we don't pay for TCP/TLS setup on every request
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Authorization'] = f'Bearer {self.token}'
+
+    def api(self, path: str, base: Optional[str] = None, **kwargs):
+        r = self.session.get(
+            (self.base_url if base is None else base) + path,
             **kwargs,
         )
         r.raise_for_status()
@@ -91,8 +192,52 @@ class Exporter:
 
         return js
 
+    @staticmethod
+    def _check_sniffed(sleep_id: str, values: dict[str, Any]) -> None:
+        sid = values.get('id', None)
+        if sid is None:
+            logger.warning('Bad json for %s: no id', sleep_id)
+            raise RetryMe
+
+        if values.get('sleep_epoch_datapoints', None) is None:
+            logger.warning('Sleep session %s has no datapoints, likely incomplete sleep. Running the export later should resolve this.', sid)
+            raise RetryMe
+
+    @retryme
+    def fetch_sleep_raw(self, device: str, sleep_id: str) -> _Fetched:
+        """
+        Same checks as fetch_sleep, but the response is streamed into a temporary file in the export dir
+        """
+        tmp = self.export_dir / (sleep_id + SUFFIXES[self.compression] + '.tmp')
+        sniffer = _Sniffer()
+        try:
+            with self.api(f'/api/v1/presence/{device}/{sleep_id}', stream=True) as r, tmp.open('wb') as fo:
+                hw = HashingWriter(fo)
+                with compressing_writer(hw, self.compression) as write:
+                    for chunk in r.iter_content(chunk_size=_CHUNK_SIZE):
+                        sniffer.feed(chunk)
+                        write(chunk)
+            sniffer.feed(b'', final=True)
+            values = sniffer.values
+            self._check_sniffed(sleep_id, values)
+            summary = {k: values[k] for k in ('time_start', 'time_end')}
+        except KeyError as e:
+            tmp.unlink(missing_ok=True)
+            logger.warning('Bad json for %s: no %s', sleep_id, e)
+            raise RetryMe from e
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+        return _Fetched(
+            tmp=tmp,
+            size=hw.size,
+            sha256=hw.sha256.hexdigest(),
+            summary=summary,
+        )
+
     def load_existing(self) -> list[str]:
-        return sorted(p.stem for p in self.export_dir.glob('*.json'))
+        return [session_sid(p) for p in session_paths(self.export_dir)]
 
     def update_sleeps(self) -> Iterator[Exception]:
         device_id = self.fetch_device_id()
@@ -102,36 +247,84 @@ class Exporter:
 
         logger.info('Fetched %d sleep sessions from api', len(api_ids))
 
+        index = TimeIndex(self.export_dir)
+        manifest = Manifest(self.export_dir)
+        running = self.export_dir / RUNNING_NAME
+        if self.reconcile or running.exists() or not manifest.exists():
+            # NOTE: lists the export dir, so files written by an interrupted export aren't fetched again,
+            # and files which disappeared since are
+            manifest.reconcile()
+        running.touch()
+
+        # NOTE: decisions are made based on the manifest, without stat-ing or reading the files
+        missing = []
         for sid in api_ids:
-            ppath = self.export_dir / (sid + '.json')
-            if ppath.exists():
+            entry = manifest.get(sid)
+            if entry is not None and entry.status == 'ok':
                 # todo special mode that force overwrites?
-                logger.info('skipping %s, already downloaded', ppath)
+                logger.info('skipping %s, already downloaded', sid)
                 continue
+            missing.append(sid)
 
+        def fetch(sid: str) -> Res[Union[Json, _Fetched]]:
             try:
-                js = self.fetch_sleep(device_id, sleep_id=sid)
+                if self.stream:
+                    # NOTE: this way writing happens in the worker threads, the main thread only renames files
+                    return self.fetch_sleep_raw(device_id, sleep_id=sid)
+                return self.fetch_sleep(device_id, sleep_id=sid)
             except Exception as e:
-                logging.error('error while fetching sleep %s', sid)
-                logging.exception(e)
-                yield e
-                continue
-
-            logger.info('fetched sleep %s, saving to %s', sid, ppath)
-            ppath.write_text(json.dumps(js, ensure_ascii=False, indent=2, sort_keys=True))
+                return e
+
+        with ExitStack() as stack:
+            if self.concurrency > 1:
+                pool = stack.enter_context(ThreadPoolExecutor(max_workers=self.concurrency))
+                submit = lambda sid: pool.submit(fetch, sid)
+            else:
+                submit = lambda sid: DummyFuture(fetch, sid)
+
+            # NOTE: results are ordered, so files are still written in sid order
+            for sid, js in bounded_results(submit, missing, window=self.concurrency * 2):
+                if isinstance(js, Exception):
+                    # NOTE: not inside an except block, so passing the exception explicitly to get the traceback
+                    logger.error('error while fetching sleep %s', sid, exc_info=js)
+                    yield js
+                    continue
+
+                suffix = SUFFIXES[self.compression]
+                ppath = self.export_dir / (sid + suffix)
+                logger.info('fetched sleep %s, saving to %s', sid, ppath)
+                if isinstance(js, _Fetched):
+                    js.tmp.replace(ppath)
+                    manifest.record_digest(sid, size=js.size, sha256=js.sha256, suffix=suffix)
+                    index.add(sid, js.summary)
+                    continue
+                data = encode(js, self.compression)
+                write_atomic(ppath, data)
+                manifest.record(sid, data, suffix=suffix)
+                index.add(sid, js)
 
         # next, clean up turds
         # IIRC, turds might happen if export happened to run during the sleep.. then you might end up with a partial sleep
-        existing = self.load_existing()
+        existing = manifest.sids()
         diff = set(existing).difference(set(api_ids))
         if len(diff) > 5:  # todo kinda arbitrary
             yield RuntimeError(f'Too many differences {diff}')
 
-        for d in diff:
+        for d in sorted(diff):
             logger.info(f'Archiving turd {d}')
-            old = self.export_dir / (d + '.json')
-            new = self.export_dir / (d + '.json.old')
-            old.rename(new)
+            name = manifest.entries[d].name
+            old = self.export_dir / name
+            new = self.export_dir / (name + '.old')
+            try:
+                old.rename(new)
+            except FileNotFoundError:
+                # e.g. deleted manually, or already archived by an interrupted export
+                logger.warning('%s is already gone', old)
+            manifest.archive(d)
+
+        if manifest.bloated:
+            manifest.compact()
+        running.unlink(missing_ok=True)
 
     def run(self) -> None:
         errors = list(self.update_sleeps())
@@ -167,6 +360,10 @@ def main() -> None:
     ex = Exporter(
         token=token,
         export_dir=args.export_dir,
+        concurrency=args.concurrency,
+        compression=args.compression,
+        stream=args.stream,
+        reconcile=args.reconcile,
     )
     ex.run()
 
@@ -178,8 +375,244 @@ def make_parser():
         params=['username', 'password'],
     )
     p.add_argument('--export-dir', type=Path, required=True, help='Output directory for JSON sleep sessions')
+    p.add_argument('--concurrency', type=int, default=1, help='Max number of sleep sessions fetched in parallel (default: sequential, to be gentle on the api)')
+    p.add_argument('--compression', choices=list(SUFFIXES), default='none', help='Store new sleep sessions compressed (see storage.py)')
+    p.add_argument(
+        '--stream',
+        action='store_true',
+        help='Write responses to disk as they are received (keeps json as returned by the api, rather than pretty printed)',
+    )
+    p.add_argument(
+        '--reconcile',
+        action='store_true',
+        help='Check the manifest against the export dir, e.g. if session files were deleted manually (always done after an interrupted export)',
+    )
     return p
 
 
-if __name__ == '__main__':
-    main()
+@contextmanager
+def _stub_server(sleeps: dict[str, Json], *, failing: Collection[str] = ()) -> Iterator[tuple[str, Counter[str]]]:
+    """
+    Serves sessions via the same endpoints as emfit api
+    Yields base url and counts of requested paths, for tests
+    """
+    requests_count: Counter[str] = Counter()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # otherwise connections aren't kept alive
+
+        def do_GET(self) -> None:
+            path = self.path
+            requests_count[path] += 1
+            requests_count[f'port:{self.client_address[1]}'] += 1
+            sid = path.split('/')[-1]
+            status = 200
+            if path == '/api/v1/user/get':
+                res: Json = {'user': {'devices': '1234'}}
+            elif path == '/api/v1/presence/1234/latest':
+                res = {'navigation_data': [{'id': sid} for sid in sleeps]}
+            elif sid in failing:
+                status = 500
+                res = {}
+            else:
+                res = sleeps[sid]
+            data = json.dumps(res).encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}', requests_count
+    finally:
+        server.shutdown()
+
+
+def test_update_sleeps_concurrent(tmp_path: Path) -> None:
+    f = FakeData()
+    sleeps = {j['id']: j for j in (f.generate() for _ in range(20))}
+    with _stub_server(sleeps) as (base_url, requests_count):
+        ex = Exporter(token='token', export_dir=tmp_path, concurrency=4, base_url=base_url)
+        assert list(ex.update_sleeps()) == []
+
+    assert ex.load_existing() == sorted(sleeps)
+    # files should still be written in sid order
+    written = [line.split('\t')[0] for line in (tmp_path / INDEX_NAME).read_text().splitlines()]
+    assert written == sorted(sleeps)
+    # connections should be reused
+    assert len([k for k in requests_count if k.startswith('port:')]) <= 4
+
+
+def test_update_sleeps_resume(tmp_path: Path) -> None:
+    f = FakeData()
+    sleeps = {j['id']: j for j in (f.generate() for _ in range(10))}
+
+    # e.g. export was interrupted, so some sessions are missing
+    with _stub_server(sleeps, failing={'000003', '000007'}) as (base_url, _):
+        ex = Exporter(token='token', export_dir=tmp_path, base_url=base_url)
+        errors = list(ex.update_sleeps())
+    assert len(errors) == 2
+    assert Manifest(tmp_path).sids() == sorted(set(sleeps) - {'000003', '000007'})
+
+    # resumed export should only fetch what's missing, and archive turds
+    del sleeps['000000']
+    with _stub_server(sleeps) as (base_url, requests_count):
+        ex = Exporter(token='token', export_dir=tmp_path, base_url=base_url)
+        assert list(ex.update_sleeps()) == []
+    fetched = sorted(k.split('/')[-1] for k in requests_count if k.startswith('/api/v1/presence/1234/0'))
+    assert fetched == ['000003', '000007']
+
+    manifest = Manifest(tmp_path)
+    assert manifest.sids() == sorted(sleeps)
+    assert manifest.sids(status='archived') == ['000000']
+    assert (tmp_path / '000000.json.old').exists()
+
+    assert list(DAL(tmp_path, use_manifest=True).sleeps()) == list(DAL(tmp_path).sleeps())
+
+
+def test_update_sleeps_reconcile(tmp_path: Path) -> None:
+    f = FakeData()
+    sleeps = {j['id']: j for j in (f.generate() for _ in range(5))}
+    with _stub_server(sleeps) as (base_url, _):
+        assert list(Exporter(token='token', export_dir=tmp_path, base_url=base_url).update_sleeps()) == []
+    assert not (tmp_path / RUNNING_NAME).exists()
+
+    # simulate an interrupted export: torn write, so the last file is written but not recorded
+    manifest_path = tmp_path / MANIFEST_NAME
+    lines = manifest_path.read_text().splitlines(keepends=True)
+    manifest_path.write_text(''.join(lines[:-1]) + lines[-1][:10])
+    (tmp_path / RUNNING_NAME).touch()
+    with _stub_server(sleeps) as (base_url, requests_count):
+        assert list(Exporter(token='token', export_dir=tmp_path, base_url=base_url).update_sleeps()) == []
+    fetched = [k for k in requests_count if k.startswith('/api/v1/presence/1234/0')]
+    assert fetched == []
+    assert Manifest(tmp_path).sids() == sorted(sleeps)
+
+    # file deleted manually: only noticed if asked to reconcile
+    (tmp_path / '000001.json').unlink()
+    with _stub_server(sleeps) as (base_url, requests_count):
+        assert list(Exporter(token='token', export_dir=tmp_path, base_url=base_url).update_sleeps()) == []
+    fetched = [k for k in requests_count if k.startswith('/api/v1/presence/1234/0')]
+    assert fetched == []
+
+    turd = tmp_path / '000000.json'
+
+    class DeletingExporter(Exporter):
+        def fetch_sleep(self, device: str, sleep_id: str) -> Json:  # type: ignore[override]
+            turd.unlink(missing_ok=True)  # turd is gone by the time it's archived
+            return super().fetch_sleep(device, sleep_id)
+
+    del sleeps['000000']
+    with _stub_server(sleeps) as (base_url, requests_count):
+        ex = DeletingExporter(token='token', export_dir=tmp_path, base_url=base_url, reconcile=True)
+        assert list(ex.update_sleeps()) == []
+    fetched = sorted(k.split('/')[-1] for k in requests_count if k.startswith('/api/v1/presence/1234/0'))
+    assert fetched == ['000001']
+
+    manifest = Manifest(tmp_path)
+    assert manifest.sids() == sorted(sleeps)
+    assert manifest.sids(status='archived') == ['000000']
+    assert [p.name for p in manifest.paths()] == [f'{sid}.json' for sid in sorted(sleeps)]
+
+    # bloated manifest is left alone by readers, and compacted by the next export
+    manifest_path.write_text(manifest_path.read_text() * 50)
+    size = manifest_path.stat().st_size
+    assert len(list(DAL(tmp_path, use_manifest=True).sleeps())) == len(sleeps)
+    assert manifest_path.stat().st_size == size
+    with _stub_server(sleeps) as (base_url, _):
+        assert list(Exporter(token='token', export_dir=tmp_path, base_url=base_url).update_sleeps()) == []
+    assert len(manifest_path.read_text().splitlines()) == len(sleeps) + 1  # + archived turd
+    assert Manifest(tmp_path).sids() == sorted(sleeps)
+
+
+def test_update_sleeps_compressed(tmp_path: Path) -> None:
+    f = FakeData()
+    sleeps = {j['id']: j for j in (f.generate() for _ in range(3))}
+    with _stub_server(sleeps) as (base_url, _):
+        ex = Exporter(token='token', export_dir=tmp_path, base_url=base_url, compression='gzip')
+        assert list(ex.update_sleeps()) == []
+    assert sorted(p.name for p in tmp_path.glob('0*')) == [f'{sid}.json.gz' for sid in sorted(sleeps)]
+    assert ex.load_existing() == sorted(sleeps)
+    assert [e.sid for e in DAL(tmp_path, use_manifest=True).sleeps()] == sorted(sleeps)  # type: ignore[union-attr]
+
+    # turds should be archived regardless of compression
+    del sleeps['000000']
+    with _stub_server(sleeps) as (base_url, _):
+        ex = Exporter(token='token', export_dir=tmp_path, base_url=base_url, compression='gzip')
+        assert list(ex.update_sleeps()) == []
+    assert (tmp_path / '000000.json.gz.old').exists()
+
+
+def test_sniffer() -> None:
+    j = FakeData().generate()
+    data = json.dumps(j).encode('utf8')
+    expected = {'id': j['id'], 'time_start': j['time_start'], 'time_end': j['time_end'], 'sleep_epoch_datapoints': []}
+    # should work regardless of where chunks are split
+    for chunk_size in [1, 7, 100, len(data)]:
+        sniffer = _Sniffer()
+        for i in range(0, len(data), chunk_size):
+            sniffer.feed(data[i : i + chunk_size])
+        sniffer.feed(b'', final=True)
+        assert sniffer.values == expected
+
+    sniffer = _Sniffer()
+    sniffer.feed(b'{"note": "\\"id\\": 123", "id": "000001", "sleep_epoch_datapoints": null}', final=True)
+    assert sniffer.values == {'id': '000001', 'sleep_epoch_datapoints': None}
+
+
+def test_update_sleeps_stream(tmp_path: Path) -> None:
+    f = FakeData()
+    sleeps = {j['id']: j for j in (f.generate() for _ in range(5))}
+
+    # regular export as a reference
+    reference_dir = tmp_path / 'reference'
+    reference_dir.mkdir()
+    with _stub_server(sleeps) as (base_url, _):
+        assert list(Exporter(token='token', export_dir=reference_dir, base_url=base_url).update_sleeps()) == []
+    expected = list(DAL(reference_dir).sleeps())
+    assert len(expected) == len(sleeps)
+
+    compressions: list[Compression] = ['none', 'gzip']
+    for compression in compressions:
+        export_dir = tmp_path / compression
+        export_dir.mkdir()
+        with _stub_server(sleeps) as (base_url, _):
+            ex = Exporter(token='token', export_dir=export_dir, concurrency=2, base_url=base_url, compression=compression, stream=True)
+            assert list(ex.update_sleeps()) == []
+        assert not any(p.name.endswith('.tmp') for p in export_dir.iterdir())
+        assert ex.load_existing() == sorted(sleeps)
+
+        manifest = Manifest(export_dir)
+        for p in manifest.paths():
+            data = p.read_bytes()
+            # digests computed while streaming should match the files
+            assert manifest.entries[session_sid(p)].sha256 == hashlib.sha256(data).hexdigest()
+            # responses are stored as is
+            assert read_bytes(p) == json.dumps(sleeps[session_sid(p)]).encode('utf8')
+
+        assert list(DAL(export_dir, use_manifest=True).sleeps()) == expected
+        # index should be populated from the sniffed values
+        since = expected[2].start  # type: ignore[union-attr]
+        assert [e.sid for e in DAL(export_dir).sleeps(since=since)] == sorted(sleeps)[2:]  # type: ignore[union-attr]
+
+
+def test_fetch_sleep_raw_bad(tmp_path: Path) -> None:
+    j = FakeData().generate()
+    del j['time_end']
+    with _stub_server({j['id']: j}) as (base_url, _):
+        ex = Exporter(token='token', export_dir=tmp_path, base_url=base_url, stream=True)
+        # NOTE: bypassing retries, otherwise takes a while
+        fetch = Exporter.fetch_sleep_raw.__wrapped__
+        try:
+            fetch(ex, '1234', j['id'])
+        except RetryMe:
+            pass
+        else:
+            raise AssertionError('should have failed')
+    # shouldn't leave temporary files behind
+    assert list(tmp_path.iterdir()) == []
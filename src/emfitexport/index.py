@@ -0,0 +1,134 @@
+"""
+Sidecar index mapping sleep sessions to their time range, so time window queries don't need to open every file.
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterable
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from .dal import Sid, _loads_summary
+from .exporthelpers.dal_helper import Json
+from .exporthelpers.logging_helper import make_logger
+from .storage import read_text, session_sid
+
+logger = make_logger(__name__)
+
+
+# NOTE: shouldn't end with .json, otherwise DAL would treat it as a session
+INDEX_NAME = 'emfit-index.tsv'
+
+_KEYS = frozenset({'time_start', 'time_end'})
+
+
+class TimeIndex:
+    """
+    Stored as tsv lines: sid, time_start, time_end (utc epoch seconds).
+    The exporter appends to it as it writes files; later lines win over earlier ones.
+    """
+
+    def __init__(self, export_path: Path) -> None:
+        self.path = export_path / INDEX_NAME
+        self._entries: Optional[dict[Sid, tuple[float, float]]] = None
+        # sorted by start time, for binary search
+        self._sorted: Optional[tuple[list[float], list[float], list[Sid]]] = None
+        self._max_duration = 0.0
+
+    @property
+    def entries(self) -> dict[Sid, tuple[float, float]]:
+        if self._entries is None:
+            entries = {}
+            if self.path.exists():
+                for line in self.path.read_text().splitlines():
+                    try:
+                        sid, start, end = line.split('\t')
+                        entries[sid] = (float(start), float(end))
+                    except ValueError:
+                        # e.g. a partially written line if the exporter was interrupted
+                        logger.warning('%s: skipping malformed line %r', self.path, line)
+            self._entries = entries
+        return self._entries
+
+    def _invalidate(self) -> None:
+        self._sorted = None
+
+    @staticmethod
+    def _time_range(j: Json) -> tuple[float, float]:
+        start, end = j['time_start'], j['time_end']
+        # be defensive in case they are swapped for some reason
+        return min(start, end), max(start, end)
+
+    def add(self, sid: Sid, j: Json) -> None:
+        """
+        Called after a session is written to the export dir
+        """
+        start, end = self._time_range(j)
+        self.entries[sid] = (start, end)
+        self._invalidate()
+        with self.path.open('a') as fo:
+            fo.write(f'{sid}\t{start}\t{end}\n')
+
+    def refresh(self, paths: Iterable[Path]) -> list[Path]:
+        """
+        Syncs the index with the session files: indexes the new ones and drops the ones that are gone.
+        Returns the files which couldn't be indexed (e.g. malformed json), so the caller can still report them.
+        NOTE: sessions already in the index aren't reread, they aren't supposed to change after the export.
+        NOTE: if the index is out of date, the index file in the export dir is rewritten, even if it's called as part of a query (e.g. DAL.sleeps with since/until).
+        """
+        entries = self.entries
+        sids = {session_sid(p): p for p in paths}
+        missing = [sid for sid in sids if sid not in entries]
+        stale = [sid for sid in entries if sid not in sids]
+        failed: list[Path] = []
+        if len(missing) == 0 and len(stale) == 0:
+            return failed
+
+        for sid in stale:
+            del entries[sid]
+        for sid in missing:
+            p = sids[sid]
+            try:
+                j = _loads_summary(read_text(p), keys=_KEYS)
+                entries[sid] = self._time_range(j)
+            except Exception as e:
+                # DAL will report the error when it actually processes the file
+                logger.warning('%s: error while indexing: %s', p, e)
+                failed.append(p)
+        added = len(missing) - len(failed)
+        if added == 0 and len(stale) == 0:
+            # only files which failed again, nothing to write
+            return failed
+        logger.info('index: added %d, removed %d', added, len(stale))
+        self._invalidate()
+
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        tmp.write_text(''.join(f'{sid}\t{start}\t{end}\n' for sid, (start, end) in sorted(entries.items())))
+        tmp.replace(self.path)
+        return failed
+
+    def query(self, *, since: Optional[datetime] = None, until: Optional[datetime] = None) -> list[Sid]:
+        """
+        Sessions overlapping with [since, until], sorted by start time
+        """
+        if self._sorted is None:
+            items = sorted(self.entries.items(), key=lambda kv: kv[1])
+            self._sorted = (
+                [start for _, (start, _) in items],
+                [end for _, (_, end) in items],
+                [sid for sid, _ in items],
+            )
+            self._max_duration = max((end - start for _, (start, end) in items), default=0.0)
+        starts, ends, sids = self._sorted
+
+        lo = 0
+        hi = len(starts)
+        if since is not None:
+            # nothing that started before (since - longest session) can overlap
+            lo = bisect_left(starts, since.timestamp() - self._max_duration)
+        if until is not None:
+            hi = bisect_right(starts, until.timestamp())
+        since_ts = None if since is None else since.timestamp()
+        return [sids[i] for i in range(lo, hi) if since_ts is None or ends[i] >= since_ts]
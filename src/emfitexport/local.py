@@ -1,11 +1,38 @@
 from __future__ import annotations
 
+import csv
 import re
+import sqlite3
+import sys
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING, Any, BinaryIO, Optional
+
+import click
+
+from .utils import DummyFuture, bounded_results
+
+if TYPE_CHECKING:
+    import numpy as np
+
+    from .dal import SleepTable
 
 Stats = dict[str, Any]
 
+# compact sample, as stored by capture: epoch seconds, hr, rr, error code, raw page (only kept if there was an error)
+Sample = tuple[int, Optional[float], Optional[float], int, Optional[str]]
+
+# error codes for compact samples
+OK = 0
+EMPTY = 1  # empty page, happens sometimes
+UNPARSEABLE = 2  # didn't match the template
+FETCH = 3  # failed to fetch the page (e.g. device was unreachable), raw contains the exception
+
 HTML_PRE = '''
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"
   "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
@@ -40,6 +67,18 @@ HTML_POST = '''
 </html>
 '''
 
+_RE_MID = re.compile(RE_MID)
+# same as RE_MID, but values can't contain tags -- this way the regex doesn't need to backtrack, which makes it much faster
+# if it doesn't match, we fall back onto RE_MID, so the semantics are exactly the same
+_RE_MID_FAST = re.compile(RE_MID.replace('(?P<hr>.*)', '(?P<hr>[^<]*)').replace('(?P<rr>.*)', '(?P<rr>[^<]*)'))
+
+
+def _values(hrs: str, rrs: str) -> tuple[Optional[float], Optional[float]]:
+    hr = None if hrs == ' ---'  else float(hrs.strip())
+    rr = None if rrs == ' --.-' else float(rrs.strip())
+    return hr, rr
+
+
 # TODO oof. should have used
 # https://gist.github.com/harperreed/9d063322eb84e88bc2d0580885011bdd#dvmstatushtm
 # dvmstatus.htm
@@ -52,21 +91,65 @@ def parse_page(html: str) -> Stats:
     assert html.endswith(HTML_POST)
     html = html[len(HTML_PRE): -len(HTML_POST)]
     html = html.replace('\n', '') # just to simplify
-    m = re.fullmatch(RE_MID, html)
+    m = _RE_MID.fullmatch(html)
     assert m is not None, repr(html)
     g = m.groupdict()
 
-    hrs = g['hr']
-    rrs = g['rr']
-
-    hr = None if hrs == ' ---'  else float(hrs.strip())
-    rr = None if rrs == ' --.-' else float(rrs.strip())
+    hr, rr = _values(g['hr'], g['rr'])
     return {
         'hr': hr,
         'rr': rr,
     }
 
 
+_PRE_LEN = len(HTML_PRE)
+_POST_LEN = len(HTML_POST)
+
+
+def parse_values(html: str) -> tuple[Optional[float], Optional[float]]:
+    """
+    Same as parse_page (throws on pages it can't parse), but returns (hr, rr) and avoids copying the page in the common case
+    """
+    if html.startswith(HTML_PRE) and html.endswith(HTML_POST):
+        end = len(html) - _POST_LEN
+        if html.find('\n', _PRE_LEN, end) == -1:
+            m = _RE_MID_FAST.fullmatch(html, _PRE_LEN, end)
+            if m is not None:
+                return _values(m.group('hr'), m.group('rr'))
+    st = parse_page(html)
+    if 'error' in st:
+        raise ValueError(st['error'])
+    return st['hr'], st['rr']
+
+
+def parse_sample(ts: int, page: str) -> Sample:
+    """
+    Converts a captured page into a compact sample. Never throws, so it's safe to call during the capture.
+    """
+    if page == '':
+        return (ts, None, None, EMPTY, None)
+    if not page.startswith('<!DOCTYPE'):
+        # dvmstatus.grab returns exception text if it fails to fetch the page
+        return (ts, None, None, FETCH, page)
+    try:
+        hr, rr = parse_values(page)
+    except Exception:
+        return (ts, None, None, UNPARSEABLE, page)
+    return (ts, hr, rr, OK, None)
+
+
+def test_parse_sample() -> None:
+    mid = '<big>HR:<big><big> 56</big></big></big>/min  .<p><big>RR:<big><big> 13.5</big></big></big>/min  .<p>.<p><small><small>00 21 77<br>t120 v2.2.1'
+    page = HTML_PRE + mid + HTML_POST
+    assert parse_sample(10, page) == (10, 56.0, 13.5, OK, None)
+    nodata = page.replace(' 56', ' ---').replace(' 13.5', ' --.-')
+    assert parse_sample(11, nodata) == (11, None, None, OK, None)
+    assert parse_sample(12, '') == (12, None, None, EMPTY, None)
+    assert parse_sample(13, '<urlopen error timed out>') == (13, None, None, FETCH, '<urlopen error timed out>')
+    broken = page.replace('RR:', 'XX:')
+    assert parse_sample(14, broken) == (14, None, None, UNPARSEABLE, broken)
+
+
 def process(d: Path) -> None:
     for x in sorted(d.glob('*.htm')):
         html = x.read_text()
@@ -82,3 +165,386 @@ def process(d: Path) -> None:
     # f = list(sorted(d.glob('*.htm')))[1000]
     # todo catch exceptions
     # todo always save htmls? for now manual cleanup?
+
+
+### bulk decoding of captured pages into columnar hr/rr series
+
+# columns of the decode() output, each is stored as a .npy file
+COLUMNS = {
+    'ts'   : '<i8',  # epoch seconds
+    'hr'   : '<f8',  # nan if there was no reading
+    'rr'   : '<f8',
+    'error': '<i1',  # see error codes above
+}  # fmt: skip
+
+# (kind, items): 'raw' -- (iso timestamp, page) rows, 'compact' -- Sample rows (without raw), 'files' -- paths to pages
+Chunk = tuple[str, list[Any]]
+
+
+class _NpyAppender:
+    """
+    Writes a 1d .npy file incrementally, the header is rewritten with the final length on close
+    """
+
+    def __init__(self, path: Path, dtype: str) -> None:
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.fo: BinaryIO = path.open('wb')
+        self._header()
+        # NOTE: header is padded to 64 bytes, so in practice its length won't change with the count
+        self.header_len = self.fo.tell()
+
+    def _header(self) -> None:
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': (self.count,)}
+        np.lib.format.write_array_header_1_0(self.fo, header)
+
+    def append(self, arr: np.ndarray) -> None:
+        arr.astype(self.dtype, copy=False).tofile(self.fo)
+        self.count += len(arr)
+
+    def close(self) -> None:
+        self.fo.seek(0)
+        self._header()
+        assert self.fo.tell() == self.header_len, 'header length changed'
+        self.fo.close()
+
+
+def _chunks(source: Path, *, chunk_size: int) -> Iterator[Chunk]:
+    if source.is_dir():
+        paths = sorted(source.glob('*.htm'))
+        for k in range(0, len(paths), chunk_size):
+            yield ('files', paths[k : k + chunk_size])
+        return
+
+    db = sqlite3.connect(f'file:{source}?mode=ro', uri=True)
+    try:
+        tables = {name for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if 'samples' in tables:
+            kind, query = 'compact', 'SELECT ts, hr, rr, error FROM samples ORDER BY id'
+        else:
+            kind, query = 'raw', 'SELECT timestamp, payload FROM data ORDER BY id'
+        cur = db.execute(query)
+        while len(rows := cur.fetchmany(chunk_size)) > 0:
+            yield (kind, rows)
+    finally:
+        db.close()
+
+
+def _epochs(timestamps: list[str]) -> np.ndarray:
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    # NOTE: capture always writes utc, in that case numpy can parse them in bulk
+    if all(t.endswith('+00:00') for t in timestamps):
+        return np.array([t[:-6] for t in timestamps], dtype='datetime64[us]').astype('datetime64[s]').astype(np.int64)
+    return np.array([int(datetime.fromisoformat(t).timestamp()) for t in timestamps], dtype=np.int64)
+
+
+def _decode_chunk(chunk: Chunk) -> dict[str, np.ndarray]:
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    kind, items = chunk
+    columns: dict[str, Any]
+    if kind == 'compact':
+        columns = dict(zip(COLUMNS, zip(*items))) if len(items) > 0 else dict.fromkeys(COLUMNS, ())
+    else:
+        if kind == 'raw':
+            ts = _epochs([t for t, _ in items])
+            pages = [p for _, p in items]
+        else:
+            ts = np.array([int(p.stat().st_mtime) for p in items], dtype=np.int64)
+            pages = [p.read_text() for p in items]
+        # NOTE: pages only differ by hr/rr values, so there are very few distinct ones -- no need to parse them again
+        parsed: dict[str, tuple[Optional[float], Optional[float], int]] = {}
+        values = []
+        for page in pages:
+            v = parsed.get(page)
+            if v is None:
+                _, hr, rr, error, _ = parse_sample(0, page)
+                v = parsed[page] = (hr, rr, error)
+            values.append(v)
+        columns = {
+            'ts'   : ts,
+            'hr'   : [v[0] for v in values],
+            'rr'   : [v[1] for v in values],
+            'error': [v[2] for v in values],
+        }  # fmt: skip
+    # NOTE: None becomes nan
+    return {name: np.array(columns[name], dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def decode(source: Path, out: Path, *, workers: Optional[int] = None, chunk_size: int = 10_000) -> int:
+    """
+    Decodes captured pages from source (capture database, raw or compact, or a directory of .htm pages)
+    into columns in the out directory (see COLUMNS). Load them with np.load(out / 'hr.npy', mmap_mode='r').
+    Rows are streamed, so memory use only depends on chunk_size and workers. Returns number of rows.
+    """
+    out.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    total = 0
+    with ExitStack() as stack:
+        writers = {name: _NpyAppender(out / f'{name}.npy', dtype) for name, dtype in COLUMNS.items()}
+        for w in writers.values():
+            stack.callback(w.close)
+
+        submit: Callable[[Chunk], Future[dict[str, np.ndarray]]]
+        if workers is None:
+            submit = lambda chunk: DummyFuture(_decode_chunk, chunk)
+        else:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            submit = lambda chunk: pool.submit(_decode_chunk, chunk)
+
+        # NOTE: ordered, so output is sorted same way as the source
+        for _, columns in bounded_results(submit, _chunks(source, chunk_size=chunk_size), window=2 * (workers or 1)):
+            for name, w in writers.items():
+                w.append(columns[name])
+            total += len(columns['ts'])
+            elapsed = time.perf_counter() - start
+            print(f'decoding: {total} rows, {total / elapsed:.0f} rows/s', file=sys.stderr)
+    return total
+
+
+### joining decoded samples with exported sessions
+
+
+def load_samples(source: Path, *, since: Optional[int] = None, until: Optional[int] = None) -> dict[str, np.ndarray]:
+    """
+    Samples (see COLUMNS) with since <= ts <= until, sorted by ts.
+    source is either a capture database (compact one is queried via the ts index), or a decode() output directory.
+    """
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    lo = -(2**63) if since is None else since
+    hi = 2**63 - 1 if until is None else until
+    if source.is_dir():
+        columns = {name: np.load(source / f'{name}.npy', mmap_mode='r') for name in COLUMNS}
+    else:
+        db = sqlite3.connect(f'file:{source}?mode=ro', uri=True)
+        try:
+            tables = {name for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if 'samples' in tables:
+                rows = db.execute('SELECT ts, hr, rr, error FROM samples WHERE ts BETWEEN ? AND ? ORDER BY ts', (lo, hi)).fetchall()
+                return _decode_chunk(('compact', rows))
+        finally:
+            db.close()
+        # NOTE: raw timestamps are text, possibly with different utc offsets, so have to decode everything
+        chunks = [_decode_chunk(chunk) for chunk in _chunks(source, chunk_size=10_000)]
+        columns = {name: np.concatenate([c[name] for c in chunks]) for name in COLUMNS}
+
+    ts = columns['ts']
+    # NOTE: capture appends in time order, so usually it's sorted already
+    if len(ts) > 1 and not (ts[1:] >= ts[:-1]).all():
+        order = np.argsort(ts, kind='stable')
+        columns = {name: np.asarray(c)[order] for name, c in columns.items()}
+        ts = columns['ts']
+    start = np.searchsorted(ts, lo, side='left')
+    end = np.searchsorted(ts, hi, side='right')
+    return {name: np.asarray(c[start:end]) for name, c in columns.items()}
+
+
+@dataclass
+class Joined:
+    """
+    Samples assigned to sessions: session i gets samples[lo[i]:hi[i]], i.e. with start <= ts <= end.
+    """
+
+    sids: np.ndarray
+    lo: np.ndarray
+    hi: np.ndarray
+    samples: dict[str, np.ndarray]
+
+    def __len__(self) -> int:
+        return len(self.sids)
+
+    def __getitem__(self, i: int) -> dict[str, np.ndarray]:
+        return {name: c[self.lo[i] : self.hi[i]] for name, c in self.samples.items()}
+
+    def aggregates(self) -> dict[str, np.ndarray]:
+        """
+        Per-session sample counts and hr/rr avg/min/max (nan if no readings), computed for all sessions at once.
+        """
+        import numpy as np  # noqa: PLC0415  # numpy is optional
+
+        lo, hi = self.lo, self.hi
+        res: dict[str, np.ndarray] = {'sid': self.sids, 'samples': hi - lo}
+        # [lo0, hi0, lo1, hi1, ...] so reduceat reduces over each session at even positions
+        # NOTE: values get a sentinel at the end, so hi == len(samples) is a valid index
+        bounds = np.stack([lo, hi], axis=1).reshape(-1)
+        for name in ['hr', 'rr']:
+            values = self.samples[name]
+            valid = ~np.isnan(values)
+            csum = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0))])
+            ccount = np.concatenate([[0], np.cumsum(valid)])
+            count = ccount[hi] - ccount[lo]
+            res[f'{name}_count'] = count
+            with np.errstate(invalid='ignore', divide='ignore'):
+                res[f'{name}_avg'] = (csum[hi] - csum[lo]) / count
+            for suffix, ufunc, fill in [('min', np.minimum, np.inf), ('max', np.maximum, -np.inf)]:
+                r = np.full(len(self), np.nan)
+                if len(bounds) > 0:
+                    extended = np.append(np.where(valid, values, fill), fill)
+                    r = ufunc.reduceat(extended, bounds)[::2]
+                    r[count == 0] = np.nan
+                res[f'{name}_{suffix}'] = r
+        return res
+
+
+def join(samples: dict[str, np.ndarray], table: SleepTable) -> Joined:
+    """
+    Assigns samples (sorted by ts, see load_samples) to sessions by their start/end (bed enter/exit).
+    Only needs a binary search per session boundary, so cost is dominated by loading the samples.
+    """
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    ts = samples['ts']
+    return Joined(
+        sids=table.sid,
+        lo=np.searchsorted(ts, table.start, side='left'),
+        hi=np.searchsorted(ts, table.end, side='right'),
+        samples=samples,
+    )
+
+
+def join_sessions(source: Path, table: SleepTable) -> Joined:
+    """
+    Only loads samples within the time span of the sessions.
+    """
+    if len(table) == 0:
+        return join(load_samples(source, since=0, until=-1), table)
+    return join(load_samples(source, since=int(table.start.min()), until=int(table.end.max())), table)
+
+
+@click.group()
+def main() -> None:
+    pass
+
+
+@main.command(name='decode')
+@click.argument('source', type=Path)
+@click.argument('out', type=Path)
+@click.option('--workers', type=int, default=None, help='Number of worker processes')
+@click.option('--chunk-size', type=int, default=10_000)
+def cmd_decode(*, source: Path, out: Path, workers: Optional[int], chunk_size: int) -> None:
+    """
+    Decode captured pages in SOURCE (capture database or directory with .htm pages) into hr/rr columns in OUT directory
+    """
+    decode(source, out, workers=workers, chunk_size=chunk_size)
+
+
+@main.command(name='join')
+@click.argument('source', type=Path)
+@click.argument('export_path', type=Path)
+def cmd_join(*, source: Path, export_path: Path) -> None:
+    """
+    Print per-session aggregates of samples in SOURCE (capture database or decode output) for sessions in EXPORT_PATH
+    """
+    from .dal import DAL  # noqa: PLC0415  # not needed for capture, which imports this module
+
+    res = join_sessions(source, DAL(export_path).sleep_table()).aggregates()
+    writer = csv.writer(sys.stdout)
+    writer.writerow(list(res))
+    for row in zip(*(c.tolist() for c in res.values())):
+        writer.writerow(['' if v != v else v for v in row])  # noqa: PLR0124
+
+
+def test_decode(tmp_path: Path) -> None:
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    from .dvmstatus import CaptureWriter, migrate  # noqa: PLC0415  # circular import
+
+    mid = '<big>HR:<big><big>{}</big></big></big>/min  .<p><big>RR:<big><big>{}</big></big></big>/min  .<p>.<p><small><small>00 21 77<br>t120 v2.2.1'
+    pages = [HTML_PRE + mid.format(f' {50 + i % 10}', ' 13.5') + HTML_POST for i in range(50)]
+    pages[3] = HTML_PRE + mid.format(' ---', ' --.-') + HTML_POST
+    pages[7] = ''
+    pages[9] = 'timed out'
+    pages[11] = HTML_PRE + mid.format(' <b>1</b>', ' 13.5') + HTML_POST  # fast path doesn't match this
+
+    raw = tmp_path / 'raw.sqlite'
+    with sqlite3.connect(str(raw)) as db:
+        writer = CaptureWriter(db, batch_size=1000)
+        for i, page in enumerate(pages):
+            # NOTE: capture always writes utc, but some chunks with other timezones to test the slow path
+            tz = timezone(timedelta(hours=1 if i > 40 else 0))
+            writer.add((datetime.fromtimestamp(1_600_000_000 + i, tz=tz).isoformat(), page))
+        writer.flush()
+    db.close()
+    compact = tmp_path / 'compact.sqlite'
+    migrate(raw, compact)
+
+    expected = {
+        'ts': np.arange(1_600_000_000, 1_600_000_050),
+        'hr': np.array([float(50 + i % 10) for i in range(50)]),
+        'rr': np.full(50, 13.5),
+        'error': np.zeros(50),
+    }
+    for k in [3, 7, 9, 11]:
+        expected['hr'][k] = expected['rr'][k] = np.nan
+    expected['error'][[7, 9, 11]] = [EMPTY, FETCH, UNPARSEABLE]
+
+    for i, (source, workers) in enumerate([(raw, None), (raw, 2), (compact, 2)]):
+        out = tmp_path / f'out{i}'
+        assert decode(source, out, workers=workers, chunk_size=8) == 50
+        for name, arr in expected.items():
+            np.testing.assert_array_equal(np.load(out / f'{name}.npy', mmap_mode='r'), arr)
+
+
+def test_join(tmp_path: Path) -> None:
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    from .dal import DAL, FakeData  # noqa: PLC0415  # not needed for capture, which imports this module
+    from .dvmstatus import CaptureWriter  # noqa: PLC0415  # circular import
+
+    export = tmp_path / 'export'
+    export.mkdir()
+    FakeData().fill(export, count=4)
+    table = DAL(export).sleep_table()
+
+    # every 10 seconds from a few hours before the first session, with some missing readings
+    tss = list(range(int(table.start[0]) - 3 * 3600, int(table.end[-1]) + 3600, 10))
+    samples: list[Sample] = []
+    for i, ts in enumerate(tss):
+        ok = i % 13 != 0
+        samples.append((ts, 40 + i % 50 if ok else None, 12 + i % 7 if ok else None, OK if ok else EMPTY, None))
+    db_path = tmp_path / 'compact.sqlite'
+    with sqlite3.connect(str(db_path)) as db:
+        writer = CaptureWriter(db, batch_size=1000, compact=True)
+        # NOTE: shuffled a bit, shouldn't matter
+        for s in samples[100:] + samples[:100]:
+            writer.add(s)
+        writer.flush()
+        plan = db.execute('EXPLAIN QUERY PLAN SELECT ts, hr, rr, error FROM samples WHERE ts BETWEEN ? AND ? ORDER BY ts', (0, 1)).fetchall()
+        assert 'samples_ts' in str(plan)
+    db.close()
+    assert decode(db_path, tmp_path / 'decoded') == len(samples)
+
+    for source in [db_path, tmp_path / 'decoded']:
+        joined = join_sessions(source, table)
+        assert len(joined) == 4
+        agg = joined.aggregates()
+        assert agg['sid'].tolist() == table.sid.tolist()
+        for i, e in enumerate(table):
+            # naive scan
+            start, end = e.start.timestamp(), e.end.timestamp()
+            mine = [s for s in samples if start <= s[0] <= end]
+            assert len(mine) > 0
+            assert joined[i]['ts'].tolist() == [s[0] for s in mine]
+            assert agg['samples'][i] == len(mine)
+            for name, column in [('hr', [s[1] for s in mine]), ('rr', [s[2] for s in mine])]:
+                values = [v for v in column if v is not None]
+                assert agg[f'{name}_count'][i] == len(values)
+                assert np.isclose(agg[f'{name}_avg'][i], sum(values) / len(values))
+                assert agg[f'{name}_min'][i] == min(values)
+                assert agg[f'{name}_max'][i] == max(values)
+
+    # no samples at all for a session
+    empty = join(load_samples(db_path, since=0, until=-1), table).aggregates()
+    assert empty['samples'].tolist() == [0, 0, 0, 0]
+    assert np.isnan(empty['hr_avg']).all()
+    assert np.isnan(empty['hr_min']).all()
+
+
+if __name__ == '__main__':
+    main()
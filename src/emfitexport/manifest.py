@@ -0,0 +1,183 @@
+"""
+Export manifest: keeps track of sessions in the export dir, so sync decisions don't need globbing and stat-ing files.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+from typing import Literal, Optional
+
+from .dal import Sid
+from .exporthelpers.logging_helper import make_logger
+from .storage import session_paths, session_sid
+
+logger = make_logger(__name__)
+
+
+# NOTE: shouldn't end with .json, otherwise DAL would treat it as a session
+MANIFEST_NAME = 'emfit-manifest.jsonl'
+
+Status = Literal['ok', 'archived', 'missing']
+
+
+@dataclass(frozen=True)
+class Entry:
+    sid: Sid
+    size: int
+    sha256: str
+    fetched_at: float  # utc epoch seconds
+    status: Status
+    suffix: str = '.json'  # see storage.SUFFIXES
+
+    @property
+    def name(self) -> str:
+        return self.sid + self.suffix
+
+
+class Manifest:
+    """
+    Append-only log of json lines, the last entry for a sid wins.
+    Each entry is flushed and fsynced before returning, so if the export is interrupted,
+    everything recorded is on disk (at worst there is a torn last line, which is ignored).
+    """
+
+    def __init__(self, export_path: Path) -> None:
+        self.export_path = export_path
+        self.path = export_path / MANIFEST_NAME
+        self._entries: Optional[dict[Sid, Entry]] = None
+        # lines in the file, including superseded and malformed ones
+        self._lines = 0
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    @property
+    def entries(self) -> dict[Sid, Entry]:
+        if self._entries is None:
+            entries = {}
+            lines = 0
+            if self.path.exists():
+                for line in self.path.read_text().splitlines():
+                    lines += 1
+                    try:
+                        e = Entry(**json.loads(line))
+                    except Exception:
+                        logger.warning('%s: skipping malformed line %r', self.path, line)
+                        continue
+                    entries[e.sid] = e
+            self._entries = entries
+            self._lines = lines
+        return self._entries
+
+    @property
+    def bloated(self) -> bool:
+        """
+        True if most of the file is superseded entries, i.e. it's worth calling compact()
+        """
+        entries = self.entries
+        return self._lines > 2 * len(entries) + 100
+
+    def get(self, sid: Sid) -> Optional[Entry]:
+        return self.entries.get(sid)
+
+    def sids(self, status: Status = 'ok') -> list[Sid]:
+        return sorted(sid for sid, e in self.entries.items() if e.status == status)
+
+    def paths(self) -> list[Path]:
+        """
+        Session files, sorted by sid
+        """
+        entries = self.entries
+        return [self.export_path / entries[sid].name for sid in self.sids()]
+
+    def _append(self, *entries: Entry) -> None:
+        for e in entries:
+            self.entries[e.sid] = e
+        data = ''.join(json.dumps(asdict(e)) + '\n' for e in entries).encode('utf8')
+        with self.path.open('a+b') as fo:
+            # NOTE: if the previous write was torn, terminate the partial line, otherwise the new entry would be glued to it
+            if fo.seek(0, os.SEEK_END) > 0:
+                fo.seek(-1, os.SEEK_END)
+                if fo.read(1) != b'\n':
+                    data = b'\n' + data
+            fo.write(data)
+            fo.flush()
+            os.fsync(fo.fileno())
+        self._lines += len(entries)
+
+    @staticmethod
+    def _entry(sid: Sid, data: bytes, *, suffix: str, fetched_at: Optional[float] = None) -> Entry:
+        return Entry(
+            sid=sid,
+            size=len(data),
+            sha256=hashlib.sha256(data).hexdigest(),
+            fetched_at=time.time() if fetched_at is None else fetched_at,
+            status='ok',
+            suffix=suffix,
+        )
+
+    def record(self, sid: Sid, data: bytes, *, suffix: str = '.json', fetched_at: Optional[float] = None) -> Entry:
+        """
+        Should be called after the session file is written
+        data is the file contents (i.e. compressed, if the session is stored compressed)
+        """
+        entry = self._entry(sid, data, suffix=suffix, fetched_at=fetched_at)
+        self._append(entry)
+        return entry
+
+    def record_digest(self, sid: Sid, *, size: int, sha256: str, suffix: str = '.json') -> Entry:
+        """
+        Same as record(), for when the file contents were hashed while writing (e.g. streamed)
+        """
+        entry = Entry(sid=sid, size=size, sha256=sha256, fetched_at=time.time(), status='ok', suffix=suffix)
+        self._append(entry)
+        return entry
+
+    def archive(self, sid: Sid) -> None:
+        e = self.entries[sid]
+        self._append(replace(e, status='archived'))
+
+    def compact(self) -> None:
+        entries = self.entries
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        tmp.write_text(''.join(json.dumps(asdict(e)) + '\n' for _, e in sorted(entries.items())))
+        tmp.replace(self.path)
+        self._lines = len(entries)
+
+    def bootstrap(self) -> None:
+        """
+        Records sessions already present in the export dir, e.g. if it was created before the manifest existed
+        """
+        self._record_unknown(session_paths(self.export_path))
+
+    def _record_unknown(self, paths: list[Path]) -> int:
+        known = self.entries
+        new = [
+            self._entry(session_sid(p), p.read_bytes(), suffix=p.name[len(session_sid(p)) :], fetched_at=p.stat().st_mtime)
+            for p in paths
+            if (e := known.get(session_sid(p))) is None or e.status != 'ok'
+        ]
+        if len(new) > 0:
+            self._append(*new)
+        logger.info('manifest: recorded %d files', len(new))
+        return len(new)
+
+    def reconcile(self) -> None:
+        """
+        Syncs the manifest with session files actually present in the export dir:
+        - files which aren't recorded (e.g. export was interrupted after writing the file) are recorded
+        - files which are recorded but are gone (e.g. deleted manually) are marked as missing, so they are fetched again
+        NOTE: lists the directory (and reads unrecorded files), so the exporter only runs it when asked or after an unclean run
+        """
+        paths = session_paths(self.export_path)
+        names = {p.name for p in paths}
+        gone = [replace(e, status='missing') for _, e in sorted(self.entries.items()) if e.status == 'ok' and e.name not in names]
+        if len(gone) > 0:
+            logger.warning('manifest: %d recorded files are missing, will fetch again', len(gone))
+            self._append(*gone)
+        self._record_unknown(paths)
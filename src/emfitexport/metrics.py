@@ -0,0 +1,332 @@
+"""
+Nightly metrics derived from raw datapoints, rather than taken from the precomputed API values
+(measured_hr_avg, measured_rr_avg, sleep_duration etc.).
+
+Metrics are computed for many nights at once: datapoints of all nights are concatenated into ragged arrays
+(values + per-night offsets, same layout as in the archive) and reduced segment-wise, without per-night python loops.
+
+E.g.: python3 -m emfitexport.metrics compute /path/to/export-or-archive --output metrics.csv
+"""
+
+from __future__ import annotations
+
+import csv
+import json
+import os
+import sys
+from collections.abc import Iterable, Iterator
+from contextlib import ExitStack
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import click
+import numpy as np
+
+from .archive import Archive, pack
+from .dal import AWAKE, EmfitParse, FakeData, Sid
+from .exporthelpers.logging_helper import make_logger
+from .storage import read_bytes, session_paths
+
+logger = make_logger(__name__)
+
+
+@dataclass
+class Ragged:
+    """
+    Per-night arrays concatenated together: night i is values[offsets[i]:offsets[i + 1]].
+    """
+
+    values: np.ndarray
+    offsets: np.ndarray
+
+    @classmethod
+    def concat(cls, arrays: list[np.ndarray], columns: int) -> Ragged:
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+        values = np.concatenate(arrays) if len(arrays) > 0 else np.empty((0, columns))
+        return cls(values=values.reshape(-1, columns), offsets=offsets)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def repeat(self, per_night: np.ndarray) -> np.ndarray:
+        """
+        Broadcasts a per-night value to each of the night's datapoints.
+        """
+        return np.repeat(per_night, self.lengths)
+
+    def sum(self, values: np.ndarray) -> np.ndarray:
+        ids = self.repeat(np.arange(len(self.lengths)))
+        return np.bincount(ids, weights=values, minlength=len(self.lengths))
+
+    def reduce(self, ufunc: np.ufunc, values: np.ndarray, fill: float) -> np.ndarray:
+        """
+        ufunc.reduceat, except empty nights get fill instead of a value from the next night.
+        """
+        out = np.full(len(self.lengths), fill, dtype=np.float64)
+        nonempty = self.lengths > 0
+        if nonempty.any():
+            # NOTE: skipping empty nights is fine, they don't contribute anything to the preceding segment
+            out[nonempty] = ufunc.reduceat(values, self.offsets[:-1][nonempty])
+        return out
+
+
+@dataclass
+class Batch:
+    sids: list[Sid]
+    measured: Ragged  # timestamp, pulse, breath, activity
+    hrv: Ragged  # timestamp, rmssd, ...
+    epochs: Ragged  # timestamp, sleep stage
+    tossnturn: Optional[Ragged]  # timestamps; not kept in the archive
+
+    @classmethod
+    def from_sessions(cls, sessions: Iterable[EmfitParse]) -> Batch:
+        """
+        Only the datapoint arrays are kept, so sessions can be a generator, and the raw json is dropped as soon as the session is processed.
+        """
+        sids: list[Sid] = []
+        measured: list[np.ndarray] = []
+        hrv: list[np.ndarray] = []
+        epochs: list[np.ndarray] = []
+        tossnturn: list[np.ndarray] = []
+        for em in sessions:
+            series = em.series
+            sids.append(em.sid)
+            measured.append(series.measured)
+            hrv.append(series.hrv_rmssd)
+            epochs.append(series.epochs)
+            tossnturn.append(series.tossnturn)
+        return cls(
+            sids=sids,
+            measured=Ragged.concat(measured, columns=4),
+            hrv=Ragged.concat(hrv, columns=6),
+            epochs=Ragged.concat(epochs, columns=2),
+            tossnturn=Ragged.concat(tossnturn, columns=1),
+        )
+
+    @classmethod
+    def from_archive(cls, archive: Archive) -> Batch:
+        """
+        Ragged arrays straight from the archive segments, without going through json.
+        """
+        if archive.replaced > 0:
+            # NOTE: some sessions were appended again, so segments can't be concatenated as is
+            sids = archive.sids
+            return cls(
+                sids=sids,
+                measured=Ragged.concat([archive.measured(sid) for sid in sids], columns=4),
+                hrv=Ragged.concat([archive.hrv(sid) for sid in sids], columns=6),
+                epochs=Ragged.concat([archive.epochs(sid) for sid in sids], columns=2),
+                tossnturn=None,
+            )
+
+        def ragged(name: str) -> Ragged:
+            values = [seg.arrays[name] for seg in archive.segments]
+            offsets = [np.zeros(1, dtype=np.int64)]
+            base = 0
+            for seg in archive.segments:
+                o = seg.arrays[name + '_offsets']
+                offsets.append(o[1:] + base)
+                base += int(o[-1])
+            return Ragged(values=np.concatenate(values), offsets=np.concatenate(offsets))
+
+        assert len(archive.segments) > 0
+        return cls(
+            sids=[sid for seg in archive.segments for sid in seg.sids()],
+            measured=ragged('measured'),
+            hrv=ragged('hrv'),
+            epochs=ragged('epochs'),
+            tossnturn=None,
+        )
+
+
+# name -> (Ragged column, which datapoints)
+_STATS = {
+    'hr'      : ('measured', 1, 'sleep'),
+    'rr'      : ('measured', 2, 'sleep'),
+    'activity': ('measured', 3, 'bed'),
+    'hrv'     : ('hrv'     , 1, 'bed'),
+}  # fmt: skip
+
+
+def compute(batch: Batch) -> dict[str, np.ndarray]:
+    """
+    Per-night metrics as columns (sid + float64 arrays, nan if there is no data).
+    HR/RR statistics are restricted to the sleep window (between the first and the last non-awake epoch, same as EmfitParse.sleep_hr).
+    """
+    nights = len(batch.sids)
+    res: dict[str, np.ndarray] = {'sid': np.array(batch.sids, dtype=np.str_)}
+
+    # sleep window from epochs
+    epochs = batch.epochs
+    ets = epochs.values[:, 0].astype(np.float64)
+    asleep = epochs.values[:, 1] != AWAKE
+    sleep_start = epochs.reduce(np.minimum, np.where(asleep, ets, np.inf), fill=np.inf)
+    sleep_end = epochs.reduce(np.maximum, np.where(asleep, ets, -np.inf), fill=-np.inf)
+    no_sleep = ~np.isfinite(sleep_start)
+    sleep_start[no_sleep] = np.nan
+    sleep_end[no_sleep] = np.nan
+    res['sleep_start'] = sleep_start
+    res['sleep_end'] = sleep_end
+
+    # epoch duration is the gap to the next epoch; the last epoch of the night gets the same duration as the one before it
+    gaps = np.diff(ets, append=np.nan)
+    ends = epochs.offsets[1:][epochs.lengths > 0] - 1
+    gaps[ends] = np.where(epochs.lengths[epochs.lengths > 0] > 1, gaps[ends - 1], 0)
+    res['sleep_minutes'] = epochs.sum(np.where(asleep, gaps, 0)) / 60
+
+    measured = batch.measured
+    mts = measured.values[:, 0]
+    in_sleep = (measured.repeat(sleep_start) < mts) & (mts < measured.repeat(sleep_end))
+    masks = {'sleep': in_sleep, 'bed': None}
+
+    for name, (attr, column, which) in _STATS.items():
+        ragged: Ragged = getattr(batch, attr)
+        values = ragged.values[:, column]
+        valid = ~np.isnan(values)
+        mask = masks[which]
+        if mask is not None:
+            valid &= mask
+        count = ragged.sum(valid.astype(np.float64))
+        empty = count == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            res[f'{name}_avg'] = ragged.sum(np.where(valid, values, 0)) / count
+        for suffix, ufunc, fill in [('min', np.minimum, np.inf), ('max', np.maximum, -np.inf)]:
+            r = ragged.reduce(ufunc, np.where(valid, values, fill), fill=fill)
+            r[empty] = np.nan
+            res[f'{name}_{suffix}'] = r
+        if which == 'sleep' and name == 'hr':
+            expected = measured.sum(in_sleep.astype(np.float64))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                res['hr_coverage'] = count / expected * 100
+
+    if batch.tossnturn is None:
+        res['tossnturn_count'] = np.full(nights, np.nan)
+    else:
+        res['tossnturn_count'] = batch.tossnturn.lengths.astype(np.float64)
+    return res
+
+
+def load(path: Path) -> Batch:
+    """
+    path is either an export directory or an archive file (see emfitexport.archive)
+    """
+    if path.is_file():
+        return Batch.from_archive(Archive(path))
+
+    def sessions() -> Iterator[EmfitParse]:
+        for p in session_paths(path):
+            try:
+                j = json.loads(read_bytes(p))
+                em = EmfitParse(j['id'], raw=j)
+            except Exception as e:
+                logger.exception(e)
+                logger.error('skipping %s', p)
+                continue
+            yield em
+
+    # NOTE: streaming, so only one raw json is in memory at a time
+    return Batch.from_sessions(sessions())
+
+
+@click.group()
+def main() -> None:
+    pass
+
+
+@main.command(name='compute')
+@click.argument('path', type=Path)
+@click.option('--output', type=Path, help='csv file to write (default: stdout)')
+def cmd_compute(*, path: Path, output: Optional[Path]) -> None:
+    """
+    Compute metrics for all nights in PATH (export directory or archive)
+    """
+    res = compute(load(path))
+    order = np.argsort(res['sid'], kind='stable')
+    with ExitStack() as stack:
+        fo = sys.stdout if output is None else stack.enter_context(output.open('w', newline=''))
+        writer = csv.writer(fo)
+        writer.writerow(list(res))
+        for row in zip(*(res[k][order].tolist() for k in res)):
+            writer.writerow(['' if v != v else v for v in row])  # noqa: PLR0124
+
+
+def test_compute(tmp_path: Path) -> None:
+    fake = FakeData()
+    js = [fake.generate() for _ in range(6)]
+    # fake data has no activity/tossnturn, and no gaps
+    j = js[1]
+    for k, p in enumerate(j['measured_datapoints']):
+        p[3] = k % 7
+        if k % 5 == 0:
+            p[1] = None
+    j['tossnturn_datapoints'] = [j['time_start'] + 100, j['time_start'] + 200]
+    js[2]['hrv_rmssd_datapoints'] = []  # empty segment in the middle
+    js[3]['sleep_epoch_datapoints'] = [[ts, AWAKE] for ts, _ in js[3]['sleep_epoch_datapoints']]
+    sessions = [EmfitParse(j['id'], raw=j) for j in js]
+
+    res = compute(Batch.from_sessions(sessions))
+    assert res['sid'].tolist() == [em.sid for em in sessions]
+
+    def check(name: str, expected: list[float]) -> None:
+        assert np.allclose(res[name], expected, equal_nan=True), name
+
+    nan = np.nan
+    naive = lambda f, a: f(a[~np.isnan(a)]) if (~np.isnan(a)).any() else nan
+    windows = []
+    for em in sessions:
+        m = em.series.measured
+        try:
+            sleep_start, sleep_end = em.series.sleep_bounds
+        except RuntimeError:  # no sleep at all
+            windows.append(m[:0])
+            continue
+        windows.append(m[(sleep_start < m[:, 0]) & (m[:, 0] < sleep_end)])
+    for name, column in [('hr', 1), ('rr', 2)]:
+        for stat, f in [('avg', np.mean), ('min', np.min), ('max', np.max)]:
+            check(f'{name}_{stat}', [naive(f, w[:, column]) for w in windows])
+    check('hr_coverage', [em.series.sleep_hr_coverage if len(w) > 0 else nan for em, w in zip(sessions, windows)])
+    check('hrv_avg', [0, 0, nan, 0, 0, 0])
+    check('activity_avg', [nan, float(np.mean([k % 7 for k in range(len(j['measured_datapoints']))])), nan, nan, nan, nan])
+    check('activity_max', [nan, 6.0, nan, nan, nan, nan])
+    check('tossnturn_count', [0, 2, 0, 0, 0, 0])
+    check('sleep_minutes', [(em.raw['sleep_duration'] // 60 if k != 3 else 0) for k, em in enumerate(sessions)])
+    assert res['hr_coverage'][1] < 100
+    assert np.isnan(res['sleep_start'][3])
+    for k in [0, 1, 2, 4, 5]:
+        assert res['sleep_start'][k] == sessions[k].sleep_start.timestamp()
+        assert res['sleep_end'][k] == sessions[k].sleep_end.timestamp()
+
+    # should match when computed from the archive
+    export_path = tmp_path / 'export'
+    export_path.mkdir()
+    for jj in js[:3]:
+        (export_path / f'{jj["id"]}.json').write_text(json.dumps(jj))
+    pack(export_path, tmp_path / 'emfit.archive')
+    for jj in js[3:]:
+        (export_path / f'{jj["id"]}.json').write_text(json.dumps(jj))
+    pack(export_path, tmp_path / 'emfit.archive')
+    assert len(Archive(tmp_path / 'emfit.archive').segments) == 2
+
+    # NOTE: night without any sleep isn't packed, since Emfit can't be constructed for it
+    kept = np.array([0, 1, 2, 4, 5])
+
+    def check_archive() -> None:
+        from_archive = compute(load(tmp_path / 'emfit.archive'))
+        for name, values in res.items():
+            if name == 'tossnturn_count':
+                continue
+            assert np.array_equal(from_archive[name], values[kept], equal_nan=name != 'sid'), name
+
+    check_archive()
+    # replaced session shouldn't be counted twice
+    os.utime(export_path / f'{js[1]["id"]}.json', ns=(0, 0))
+    pack(export_path, tmp_path / 'emfit.archive')
+    assert Archive(tmp_path / 'emfit.archive').replaced == 1
+    check_archive()
+
+
+if __name__ == '__main__':
+    main()
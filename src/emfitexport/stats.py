@@ -0,0 +1,67 @@
+"""
+Opt-in instrumentation for DAL.sleeps, to tell whether it's bound by IO, json decoding or constructing Emfit objects.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class SessionStats:
+    """
+    Timings for a single session file, in seconds.
+    These are measured wherever the file is processed (e.g. in a pool worker) and passed back along with the result.
+    """
+
+    name: str
+    bytes_read: int  # size on disk
+    read: float  # reading the file (including decompression)
+    decode: float  # json decoding
+    construct: float  # building Emfit out of json
+    queue_wait: float  # between submitting to the pool and the worker picking the session up
+    error: bool
+
+
+class Stats:
+    """
+    Aggregates SessionStats. Counters are cumulative across sleeps() calls.
+    If callback is passed, it's called for each session as results are consumed.
+    """
+
+    def __init__(self, callback: Optional[Callable[[SessionStats], None]] = None) -> None:
+        self.callback = callback
+
+        self.sessions = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.bytes_read = 0
+        self.read = 0.0
+        self.decode = 0.0
+        self.construct = 0.0
+        self.queue_wait = 0.0
+
+    def record(self, s: SessionStats) -> None:
+        self.sessions += 1
+        self.errors += s.error
+        self.bytes_read += s.bytes_read
+        self.read += s.read
+        self.decode += s.decode
+        self.construct += s.construct
+        self.queue_wait += s.queue_wait
+        if self.callback is not None:
+            self.callback(s)
+
+    def summary(self) -> str:
+        n = max(self.sessions, 1)
+        ms = lambda total: f'{total:.3f}s ({total * 1000 / n:.2f} ms/session)'
+        return '\n'.join([
+            f'sessions   : {self.sessions} processed, {self.cache_hits} from cache, {self.errors} errors',
+            f'bytes read : {self.bytes_read / 2**20:.1f} MiB',
+            f'read       : {ms(self.read)}',
+            f'decode     : {ms(self.decode)}',
+            f'construct  : {ms(self.construct)}',
+            f'queue wait : {ms(self.queue_wait)}',
+        ])  # fmt: skip
@@ -0,0 +1,357 @@
+"""
+On-disk storage of sleep sessions: plain json (the default) or compressed json.
+Optionally, datapoints can also be stored in binary sidecars next to the session (see write_sidecars).
+
+E.g. to recompress an existing export: python3 -m emfitexport.storage recompress /path/to/export --compression gzip
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import io
+import json
+import os
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Any, BinaryIO, Literal, Optional, cast
+
+import click
+
+from .exporthelpers.logging_helper import make_logger
+from .utils import DummyFuture
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = make_logger(__name__)
+
+
+Compression = Literal['none', 'gzip', 'zstd']
+
+SUFFIXES: dict[Compression, str] = {
+    'none': '.json',
+    'gzip': '.json.gz',
+    'zstd': '.json.zst',
+}
+
+
+def compression_of(path: Path) -> Optional[Compression]:
+    name = path.name
+    for compression, suffix in SUFFIXES.items():
+        if name.endswith(suffix):
+            return compression
+    return None
+
+
+def session_sid(path: Path) -> str:
+    compression = compression_of(path)
+    assert compression is not None, path
+    return path.name[: -len(SUFFIXES[compression])]
+
+
+def session_paths(export_path: Path) -> list[Path]:
+    """
+    All session files in the export dir (compressed or not), sorted by sid.
+    """
+    by_sid: dict[str, Path] = {}
+    # NOTE: single directory scan rather than a glob per suffix
+    for p in export_path.iterdir():
+        if compression_of(p) is None:
+            continue
+        sid = session_sid(p)
+        prev = by_sid.get(sid)
+        # might have both while the export is being recompressed, they have the same data so doesn't matter much
+        if prev is None or p.name < prev.name:
+            by_sid[sid] = p
+    return [by_sid[sid] for sid in sorted(by_sid)]
+
+
+def read_bytes(path: Path) -> bytes:
+    data = path.read_bytes()
+    compression = compression_of(path)
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    if compression == 'zstd':
+        import zstandard  # noqa: PLC0415  # zstandard is optional
+
+        # NOTE: frames written in streaming mode don't have content size in the header, so can't use decompress()
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def read_text(path: Path) -> str:
+    return read_bytes(path).decode('utf8')
+
+
+def compress(data: bytes, compression: Compression) -> bytes:
+    if compression == 'gzip':
+        # NOTE: mtime=0 so the output is deterministic
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if compression == 'zstd':
+        import zstandard  # noqa: PLC0415  # zstandard is optional
+
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def encode(j: object, compression: Compression) -> bytes:
+    """
+    Serializes a session for storing: pretty printed if uncompressed (to keep it human readable), compact otherwise.
+    """
+    if compression == 'none':
+        return json.dumps(j, ensure_ascii=False, indent=2, sort_keys=True).encode('utf8')
+    data = json.dumps(j, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf8')
+    return compress(data, compression)
+
+
+class HashingWriter:
+    """
+    Passes writes through to the file, keeping track of size and sha256 of what's written
+    """
+
+    def __init__(self, fo: BinaryIO) -> None:
+        self.fo = fo
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        self.sha256.update(data)
+        return self.fo.write(data)
+
+    def flush(self) -> None:
+        self.fo.flush()
+
+
+@contextmanager
+def compressing_writer(fo: HashingWriter, compression: Compression) -> Iterator[Callable[[bytes], Any]]:
+    """
+    Yields a function compressing data into fo, for writing sessions incrementally.
+    Compressed stream is finalized on exit, fo itself is not closed.
+    """
+    if compression == 'gzip':
+        with gzip.GzipFile(filename='', fileobj=fo, mode='wb', compresslevel=6, mtime=0) as gz:
+            yield gz.write
+    elif compression == 'zstd':
+        import zstandard  # noqa: PLC0415  # zstandard is optional
+
+        with zstandard.ZstdCompressor(level=3).stream_writer(cast(IO[bytes], fo), closefd=False) as zw:
+            yield zw.write
+    else:
+        yield fo.write
+
+
+def write_atomic(path: Path, data: bytes) -> None:
+    # so an interrupted write never leaves a partial session behind
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_bytes(data)
+    tmp.replace(path)
+
+
+def _recompress_one(path: Path, compression: Compression) -> tuple[Path, bytes]:
+    j = json.loads(read_bytes(path))
+    data = encode(j, compression)
+    target = path.with_name(session_sid(path) + SUFFIXES[compression])
+    write_atomic(target, data)
+    path.unlink()
+    return target, data
+
+
+def recompress(export_path: Path, compression: Compression, *, workers: Optional[int] = None) -> int:
+    """
+    Rewrites all sessions which aren't stored with the specified compression. Returns number of rewritten files.
+    """
+    from .manifest import Manifest  # noqa: PLC0415  # circular import
+
+    paths = [p for p in session_paths(export_path) if compression_of(p) != compression]
+    manifest = Manifest(export_path)
+
+    with ExitStack() as stack:
+        futures: list[Future[tuple[Path, bytes]]]
+        if workers is None:
+            futures = [DummyFuture(_recompress_one, p, compression) for p in paths]
+        else:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            futures = [pool.submit(_recompress_one, p, compression) for p in paths]
+        for fut in futures:
+            target, data = fut.result()
+            logger.info('recompressed %s', target)
+            sid = session_sid(target)
+            entry = manifest.get(sid) if manifest.exists() else None
+            if entry is not None:
+                manifest.record(sid, data, suffix=SUFFIXES[compression], fetched_at=entry.fetched_at)
+    return len(paths)
+
+
+# per-night datapoints stored as <sid>.<name>.npy: name -> (EmfitSeries attribute, dtype)
+SIDECARS = {
+    'measured' : ('measured' , '<f8'),
+    'hrv'      : ('hrv_rmssd', '<f8'),
+    'epochs'   : ('epochs'   , '<i8'),
+    'tossnturn': ('tossnturn', '<f8'),
+}  # fmt: skip
+
+
+def sidecar_path(path: Path, name: str) -> Path:
+    return path.with_name(f'{session_sid(path)}.{name}.npy')
+
+
+def load_sidecar(path: Path, name: str) -> Optional[np.ndarray]:
+    """
+    Memory mapped sidecar of the session file, or None if it's missing or older than the session.
+    """
+    sidecar = sidecar_path(path, name)
+    try:
+        stale = sidecar.stat().st_mtime_ns < path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if stale:
+        return None
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    return np.load(sidecar, mmap_mode='r')
+
+
+def _write_sidecars_one(path: Path) -> Path:
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    from .dal import EmfitParse  # noqa: PLC0415  # circular import
+
+    j = json.loads(read_bytes(path))
+    series = EmfitParse(session_sid(path), raw=j).series
+    for name, (attr, dtype) in SIDECARS.items():
+        # NOTE: column-major, so each column is contiguous in the file and reading one doesn't touch the others
+        arr = np.asfortranarray(getattr(series, attr), dtype=dtype)
+        buf = io.BytesIO()
+        np.save(buf, arr, allow_pickle=False)
+        write_atomic(sidecar_path(path, name), buf.getvalue())
+    return path
+
+
+def write_sidecars(export_path: Path, *, workers: Optional[int] = None) -> int:
+    """
+    Writes binary sidecars for sessions which don't have them (or have stale ones). Returns number of processed sessions.
+    """
+    paths = [p for p in session_paths(export_path) if any(load_sidecar(p, name) is None for name in SIDECARS)]
+    with ExitStack() as stack:
+        futures: list[Future[Path]]
+        if workers is None:
+            futures = [DummyFuture(_write_sidecars_one, p) for p in paths]
+        else:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            futures = [pool.submit(_write_sidecars_one, p) for p in paths]
+        for fut in futures:
+            logger.info('wrote sidecars for %s', fut.result())
+    return len(paths)
+
+
+@click.group()
+def main() -> None:
+    pass
+
+
+@main.command(name='recompress')
+@click.argument('export_path', type=Path)
+@click.option('--compression', type=click.Choice(list(SUFFIXES)), required=True)
+@click.option('--workers', type=int, default=None, help='Number of worker processes')
+def cmd_recompress(*, export_path: Path, compression: Compression, workers: Optional[int]) -> None:
+    """
+    Rewrite existing sessions in EXPORT_PATH with different compression
+    """
+    count = recompress(export_path, compression, workers=workers)
+    logger.info('recompressed %d sessions', count)
+
+
+@main.command(name='sidecars')
+@click.argument('export_path', type=Path)
+@click.option('--workers', type=int, default=None, help='Number of worker processes')
+def cmd_sidecars(*, export_path: Path, workers: Optional[int]) -> None:
+    """
+    Write binary datapoint sidecars for sessions in EXPORT_PATH
+    """
+    count = write_sidecars(export_path, workers=workers)
+    logger.info('wrote sidecars for %d sessions', count)
+
+
+def test_compressing_writer(tmp_path: Path) -> None:
+    data = json.dumps({'id': '000000', 'measured_datapoints': list(range(10_000))}).encode('utf8')
+    for compression, suffix in SUFFIXES.items():
+        path = tmp_path / f'000000{suffix}'
+        with path.open('wb') as fo:
+            hw = HashingWriter(fo)
+            with compressing_writer(hw, compression) as write:
+                for i in range(0, len(data), 1000):
+                    write(data[i : i + 1000])
+        assert read_bytes(path) == data
+        stored = path.read_bytes()
+        assert (hw.size, hw.sha256.hexdigest()) == (len(stored), hashlib.sha256(stored).hexdigest())
+
+
+def test_recompress(tmp_path: Path) -> None:
+    from .dal import DAL, FakeData  # noqa: PLC0415  # circular import
+    from .manifest import Manifest  # noqa: PLC0415  # circular import
+
+    FakeData().fill(tmp_path, count=5)
+    expected = list(DAL(tmp_path).sleeps())
+    Manifest(tmp_path).bootstrap()
+
+    assert recompress(tmp_path, 'gzip', workers=2) == 5
+    assert sorted(p.name for p in tmp_path.glob('0*')) == [f'{i:06}.json.gz' for i in range(5)]
+    assert list(DAL(tmp_path).sleeps()) == expected
+    assert list(DAL(tmp_path, summary_only=True).sleeps()) == expected
+    assert list(DAL(tmp_path, use_manifest=True).sleeps()) == expected
+    assert recompress(tmp_path, 'gzip') == 0
+
+    assert recompress(tmp_path, 'none') == 5
+    assert list(DAL(tmp_path, use_manifest=True).sleeps()) == expected
+
+
+def test_sidecars(tmp_path: Path) -> None:
+    import numpy as np  # noqa: PLC0415  # numpy is optional
+
+    from .dal import DAL, EmfitParse, FakeData  # noqa: PLC0415  # circular import
+    from .metrics import Batch  # noqa: PLC0415  # circular import
+
+    FakeData().fill(tmp_path, count=4)
+    recompress(tmp_path, 'gzip', workers=None)
+    paths = session_paths(tmp_path)
+    expected = [EmfitParse(session_sid(p), raw=json.loads(read_bytes(p))).series for p in paths]
+
+    assert all(load_sidecar(p, 'measured') is None for p in paths)
+    assert write_sidecars(tmp_path, workers=2) == 4
+    assert write_sidecars(tmp_path) == 0
+    assert session_paths(tmp_path) == paths  # sidecars aren't mistaken for sessions
+
+    sessions = list(DAL(tmp_path).sessions())
+    assert [em.sid for em in sessions] == [session_sid(p) for p in paths]
+    for em, exp in zip(sessions, expected):
+        s = em.series
+        for attr, _ in SIDECARS.values():
+            arr = getattr(s, attr)
+            assert isinstance(arr, np.memmap)
+            assert np.array_equal(arr, getattr(exp, attr), equal_nan=True)
+        assert s.measured[:, 1].flags.c_contiguous  # single column is contiguous
+        assert s.sleep_hr_coverage == exp.sleep_hr_coverage
+        assert 'raw' not in em.__dict__  # json wasn't touched
+
+    sessions = list(DAL(tmp_path).sessions())
+    batch = Batch.from_sessions(sessions)
+    assert batch.tossnturn is not None
+    assert batch.tossnturn.lengths.tolist() == [0] * 4
+    assert all('raw' not in em.__dict__ for em in sessions)
+
+    # stale sidecar (e.g. session was re-fetched) falls back to json
+    p = paths[0]
+    st = p.stat()
+    os.utime(p, ns=(st.st_atime_ns, sidecar_path(p, 'measured').stat().st_mtime_ns + 10**9))
+    em = EmfitParse.from_path(p)
+    assert not isinstance(em.series.measured, np.memmap)
+    assert np.array_equal(em.series.measured, expected[0].measured, equal_nan=True)
+    assert write_sidecars(tmp_path) == 1
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,17 @@
-from concurrent.futures import Future
-from typing import TYPE_CHECKING, Any
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from typing import TYPE_CHECKING, Any, TypeVar
 
 from .exporthelpers.dal_helper import Json, json_items
 
@@ -28,3 +40,80 @@ class DummyFuture(DummyFutureBase):
 
     def result(self, *args, **kwargs):  # noqa: ARG002
         return self.fn(*self.args, **self.kwargs)
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def bounded_results(
+    submit: Callable[[T], Future[R]],
+    items: Iterable[T],
+    *,
+    window: int,
+    ordered: bool = True,
+) -> Iterator[tuple[T, R]]:
+    """
+    Submits items lazily, keeping at most `window` results in flight, and yields (item, result) pairs.
+    If ordered, results come in the same order as items, otherwise as soon as they complete.
+    """
+    assert window > 0, window
+    if ordered:
+        queue: deque[tuple[T, Future[R]]] = deque()
+        for item in items:
+            queue.append((item, submit(item)))
+            if len(queue) >= window:
+                item, fut = queue.popleft()
+                yield item, fut.result()
+        while len(queue) > 0:
+            item, fut = queue.popleft()
+            yield item, fut.result()
+        return
+
+    pending: dict[Future[R], T] = {}
+    for item in items:
+        fut = submit(item)
+        if not isinstance(fut, Future):
+            # e.g. DummyFuture -- not really concurrent, so no point deferring it
+            yield item, fut.result()
+            continue
+        pending[fut] = item
+        if len(pending) >= window:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                yield pending.pop(fut), fut.result()
+    for fut in as_completed(pending):
+        yield pending[fut], fut.result()
+
+
+def test_bounded_results() -> None:
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def work(x: int) -> int:
+        nonlocal in_flight
+        time.sleep(0.001 * (x % 3))
+        with lock:
+            in_flight -= 1
+        return x * x
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+
+        def submit(x: int) -> Future[int]:
+            nonlocal in_flight, max_in_flight
+            with lock:
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+            return pool.submit(work, x)
+
+        items = list(range(50))
+        assert list(bounded_results(submit, items, window=3)) == [(x, x * x) for x in items]
+        assert max_in_flight <= 3
+
+        unordered = list(bounded_results(submit, items, window=5, ordered=False))
+        assert sorted(unordered) == [(x, x * x) for x in items]
+        assert max_in_flight <= 5
+
+    serial = bounded_results(lambda x: DummyFuture(lambda: x), items, window=2, ordered=False)
+    assert list(serial) == [(x, x) for x in items]